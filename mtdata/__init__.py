@@ -11,9 +11,7 @@ __author__ = 'Thamme Gowda'
 import logging as log
 from pathlib import Path
 import os
-from ruamel.yaml import YAML
 
-yaml = YAML()
 debug_mode = False
 #_log_format = '%(module)s.%(funcName)s:%(lineno)s %(message)s'
 from mtdata.pbar import get_log_handler  # noqa: E402
@@ -29,12 +27,30 @@ def set_third_party_log_level(level=log.WARNING):
 set_third_party_log_level(log.WARNING)
 cache_dir = Path(os.environ.get('MTDATA', '~/.mtdata')).expanduser()
 recipes_dir = Path(os.getenv('MTDATA_RECIPES', '.')).resolve()
-cached_index_file = cache_dir / f'mtdata.index.{__version__}.pkl'
+cached_index_file = cache_dir / f'mtdata.index.{__version__}.idx'
+index_backend = os.getenv('MTDATA_INDEX_BACKEND', 'file')  # file or sqlite; see mtdata.index.sqldb
+download_segments = int(os.getenv('MTDATA_DOWNLOAD_SEGMENTS', '1'))  # >1 enables segmented downloads of large files
+max_bandwidth = os.getenv('MTDATA_MAX_BANDWIDTH', '')  # e.g. 100MB; bytes per second of all downloads of a process
+cache_max_size = os.getenv('MTDATA_CACHE_MAX_SIZE', '')  # e.g. 2TB; size budget of cache, applied after downloads
+remote_zip = os.getenv('MTDATA_REMOTE_ZIP', 'yes').lower() in ('yes', 'true', '1')  # range requests to large zips
+stream_parse = os.getenv('MTDATA_STREAM_PARSE', 'yes').lower() in ('yes', 'true', '1')  # parse while downloading
+mirrors = os.getenv('MTDATA_MIRRORS', '')  # local dirs, cache:<dir> or http URLs of mirrors; see mtdata.mirror
+url_rewrite = os.getenv('MTDATA_URL_REWRITE', '')  # <old prefix>=><new prefix> rules of URLs; see mtdata.mirror
 resource_dir:Path = Path(__file__).parent / 'resource'
 
 from mtdata.pbar import pbar_man  # noqa: E402
 
 
+def __getattr__(name):
+    # ruamel.yaml is slow to import and only needed for recipes; so load it on first access of mtdata.yaml
+    if name == 'yaml':
+        global yaml
+        from ruamel.yaml import YAML
+        yaml = YAML()
+        return yaml
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class MTDataException(Exception):
     pass
 
@@ -52,4 +68,21 @@ class MTDataUserError(MTDataException):
 
 class Defaults:
     FILE_LOCK_TIMEOUT = 2 * 60 * 60  # 2 hours
-    PBAR_REFRESH_INTERVAL = 1    # seconds
\ No newline at end of file
+    PBAR_REFRESH_INTERVAL = 1    # seconds
+    DOWNLOAD_RESUMES = 3  # times a failed download is retried (resumed, if possible) before giving up
+    SEGMENT_MIN_SIZE = 64 * 2**20  # files smaller than this are downloaded in a single stream
+    HOST_CONNECTIONS = 8  # max concurrent connections per host, of a process
+    HTTP_POOL_SIZE = 16  # max keep-alive connections per host, of a process
+    HTTP_RETRIES = 3  # retries of connection errors and 429, 5xx statuses
+    DOWNLOAD_RATE_GUESS = 5 * 10**6  # bytes per second, of hosts without download history
+    REMOTE_ZIP_MIN_SIZE = 64 * 2**20  # smaller zips are downloaded whole
+    REMOTE_ZIP_BLOCK_SIZE = 2**20  # bytes of range requests of remote zips; doubled while reads are sequential
+    REMOTE_ZIP_MAX_READAHEAD = 32 * 2**20  # max bytes of a range request of remote zips
+    STREAM_QUEUE_SIZE = 256  # chunks (16KiB) of a download that are buffered for its parser; see mtdata.streaming
+    RETRY_BACKOFF = 1  # seconds before the first retry of a download; doubled for each retry after
+    RETRY_MAX_WAIT = 60  # max seconds before a retry, including Retry-After of servers
+    STALL_TIMEOUT = 30  # seconds without bytes after which a download is considered stalled, and retried
+    CIRCUIT_FAILURES = 5  # consecutive failures of a host, after which it is paused; see mtdata.retry
+    CIRCUIT_COOLDOWN = 60  # seconds a failing host is paused for
+    HEAD_TTL = 7 * 24 * 3600  # seconds for which content lengths and validators of URLs are reused, without HEAD
+    HEAD_JOBS = 16  # concurrent HEAD requests, e.g. of 'mtdata stats --quick'
\ No newline at end of file
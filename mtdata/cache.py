@@ -8,30 +8,98 @@ import fnmatch
 from dataclasses import dataclass
 from pathlib import Path
 from mtdata.index import Entry
-from mtdata import log, __version__, pbar_man, MTDataException, Defaults
-from mtdata.utils import ZipPath, TarPath, format_byte_size
-from mtdata.parser import Parser
-from typing import List, Union, Dict, Any
+from mtdata import log, pbar_man, MTDataException, Defaults, download_segments, max_bandwidth, cache_max_size, \
+    remote_zip, stream_parse, mirrors, url_rewrite
+from mtdata.utils import ZipPath, TarPath, format_byte_size, parse_byte_size
+from mtdata.parser import Parser, detect_extension
+from mtdata.sessions import headers, get_session, configure_huggingface
+from mtdata.cachedb import CacheDb
+from mtdata.remotezip import open_remote_zip, zip_stats, RangeNotSupported
+from mtdata.streaming import TeeStream, StreamPath, DECOMPRESSORS
+from mtdata.retry import RetryPolicy, check_status, breaker
+from mtdata.mirror import MirrorChain, link_file
+from typing import List, Union, Dict, Any, Optional, Tuple, Callable, Set
 
+import atexit
+import json
+import os
+import shutil
+import socket
+import uuid
 import portalocker
+import hashlib
 from hashlib import md5
 from urllib.parse import urlparse
 import requests
+import datetime
+from contextlib import contextmanager
+import heapq
 import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+OPUS_XCES = 'opus_xces'
+HF_CACHE = str(Path('huggingface', 'datasets'))  # relative to cache root
 
-headers = {'User-Agent': f'mtdata downloader {__version__}; cURL and wget like.'}
+_lease_owners = {}  # (pid, cache root) -> (owner, lock)
+_host_locks: Dict[str, threading.BoundedSemaphore] = {}  # host -> semaphore; see host_semaphore()
+_host_locks_guard = threading.Lock()
+mirror_chain = MirrorChain.parse(mirrors, url_rewrite)  # MTDATA_MIRRORS and MTDATA_URL_REWRITE
+failed_heads: Dict[str, Exception] = {}  # url -> error of its HEAD request; not retried for the rest of the run
 
-OPUS_XCES = 'opus_xces'
+
+def host_semaphore(url: str) -> threading.BoundedSemaphore:
+    """Semaphore that bounds the concurrent connections of this process to the host of url"""
+    host = urlparse(url).hostname or 'nohost'
+    sem = _host_locks.get(host)
+    if sem is None:
+        with _host_locks_guard:  # threads that see a new host at the same time must share one semaphore
+            sem = _host_locks.setdefault(host, threading.BoundedSemaphore(Defaults.HOST_CONNECTIONS))
+    return sem
+
+
+class TokenBucket:
+    """Limits the rate of bytes transferred by all threads of a process; rate=0 is unlimited"""
+
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n_bytes: int):
+        """Waits until n_bytes are allowed by the budget"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # unused budget is saved for at most one second
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - n_bytes
+            self.last = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+bandwidth = TokenBucket(parse_byte_size(max_bandwidth) if max_bandwidth else 0)
+
+
+class NoSegmentSupport(MTDataException):
+    """Server or file is not suitable for segmented download"""
 
 
 @dataclass
 class Cache:
     root: Path
+    mirrors: Optional[MirrorChain] = None  # default: mirror_chain
 
     def __post_init__(self):
         if isinstance(self.root, str):
             self.root = Path(self.root)
+        if self.mirrors is None:
+            self.mirrors = mirror_chain
         log.debug(f"Local cache is at {self.root}")
 
     def get_entry(self, entry: Entry, fix_missing=True) -> Union[Path, List[Path]]:
@@ -44,6 +112,13 @@ class Cache:
                 local = [self.get_local_path(url, fix_missing=fix_missing, entry=entry) for url in entry.url]
             else:
                 assert isinstance(entry.url, str)
+                if fix_missing and entry.is_archive and entry.ext == 'zip':
+                    zip_path = self.get_local_path(entry.url, filename=entry.filename, fix_missing=False)
+                    local = self.get_zip_members(
+                        entry.url, zip_path, entry=entry,
+                        select=lambda names: self.match_globs(names, entry.in_paths, meta=str(entry.did)))
+                    if local is not None:
+                        return local
                 local = self.get_local_path(entry.url, filename=entry.filename, fix_missing=fix_missing, entry=entry)
                 if isinstance(local, Path) and entry.is_archive and (zipfile.is_zipfile(local) or tarfile.is_tarfile(local)):
                     # look inside the archives and get the desired files
@@ -54,18 +129,252 @@ class Cache:
                 log.warning(f'Error while accessing {entry.did} --> {local}')
             raise
 
-    def get_content_length(self, entry: Entry) -> Dict[str, Any]:
-        urls = []
+    def get_entries(self, entries: List[Entry], n_jobs=1) -> Dict[Entry, Union[None, Path, List[Path]]]:
+        """
+        Gets many entries concurrently using n_jobs threads.
+        Connections to each host are bounded by Defaults.HOST_CONNECTIONS, and the transfer rate of all downloads
+        by the bandwidth budget (MTDATA_MAX_BANDWIDTH). Entries that share files wait for each other on file locks.
+        :return: entry -> local paths; None for entries that failed
+        """
+        entries = self.schedule(entries, n_jobs=n_jobs)
+        result = {}
+        status = dict(total=len(entries), success=0, failed=0)
+        with pbar_man.counter(desc="Downloads", total=len(entries)) as overall_pbar, \
+                ThreadPoolExecutor(max_workers=n_jobs, thread_name_prefix='download') as pool:
+            futures = {pool.submit(self.get_entry, entry): entry for entry in entries}
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    result[entry] = future.result()
+                    status['success'] += 1
+                    log.info(f"[{status['success']}/{status['total']}] Downloaded {entry.did}")
+                except Exception as exc:
+                    result[entry] = None
+                    status['failed'] += 1
+                    log.warning(f"Failed to download {entry.did}: {exc} Total failed: {status['failed']}")
+                finally:
+                    overall_pbar.update()
+        log.info(f"Downloaded {status['success']} datasets. Failed to download {status['failed']}")
+        return result
+
+    def is_streamable(self, entry: Entry) -> bool:
+        """Checks if entry can be parsed while it is downloaded; see stream_entry()"""
+        if not stream_parse or not isinstance(entry.url, str) or entry.is_archive or entry.in_ext == OPUS_XCES \
+                or urlparse(entry.url).hostname == 'huggingface.co':
+            return False
+        ext = entry.in_ext or detect_extension(entry.filename)
+        suffix = Path(entry.filename).suffix
+        return ext.split('.')[0] in ('txt', 'tsv') and (suffix in DECOMPRESSORS or suffix.lstrip('.') in ('txt', 'tsv')) \
+            and not self.is_cached(entry.url, filename=entry.filename) \
+            and not self.find_in_mirror(entry.url, filename=entry.filename)
+
+    @contextmanager
+    def stream_entry(self, entry: Entry):
+        """
+        Local path(s) of entry, for parsing, as in get_entry(). If the entry is plain text or TSV (optionally .gz or .xz)
+        and not in the cache, it is parsed while it is downloaded: the bytes are teed to the cache file and to the
+        yielded StreamPath, which can be read once. The file is marked valid only after both the download and the
+        with-block (i.e. the parsing) succeed. The download lock of the file is held until then.
+        """
+        if not self.is_streamable(entry):
+            yield self.get_entry(entry)
+            return
+        url = entry.url
+        local = self.get_local_path(url, filename=entry.filename, fix_missing=False)
+        valid_flag = self.get_flag_file(local)
+        lock_file = valid_flag.with_suffix('._lock')
+        local.parent.mkdir(parents=True, exist_ok=True)
+        self.lease(local)
+        with portalocker.Lock(lock_file, 'w', timeout=Defaults.FILE_LOCK_TIMEOUT):
+            if not (valid_flag.exists() and local.exists()):
+                if self.read_part_meta(self.get_part_file(local), url):
+                    # resumes from the middle, so the stream would lack the beginning; parse after download
+                    self.download_locked(url, local, entry=entry)
+                else:
+                    log.info(f"Downloading and parsing: {url} → {local}")
+                    stream = TeeStream(path=local)
+                    thread = threading.Thread(target=stream.run, name='download', daemon=True, args=(
+                        lambda: self.download_locked(url, local, entry=entry, on_chunk=stream.put),))
+                    thread.start()
+                    suffix = Path(local.name).suffix
+                    try:
+                        yield StreamPath(local.name, stream, compression=suffix if suffix in DECOMPRESSORS else '')
+                        stream.drain()  # in case the parser stopped early; raises error of download, if any
+                    except BaseException:
+                        stream.cancel()
+                        raise
+                    finally:
+                        thread.join()
+                    valid_flag.touch()
+                    lock_file.unlink()
+                    self.db.touch(self.rel_path(local), size=local.stat().st_size, url=url, did=str(entry.did))
+                    return
+                valid_flag.touch()
+                lock_file.unlink()
+        self.db.touch(self.rel_path(local), size=local.stat().st_size, url=url, did=str(entry.did))
+        yield local
+
+    def schedule(self, entries: List[Entry], n_jobs=1) -> List[Entry]:
+        """
+        Orders entries for download by n_jobs workers: the largest first, so that a big file does not start last
+        and prolong the total time; and consecutive entries are from different hosts where possible.
+        Logs the predicted total time.
+        Sizes are from earlier HEAD requests and downloads (see CacheDb) or new HEAD requests; cached files have 0 size.
+        """
+        urls = {}  # url -> filename
+        for entry in entries:
+            for url, filename in self.get_urls(entry):
+                urls.setdefault(url, filename)
+        pending = [url for url, filename in urls.items()
+                   if urlparse(url).hostname != 'huggingface.co' and not self.is_cached(url, filename=filename)]
+
+        lengths = {url: head and head['length'] or 0 for url, head in self.heads(pending, n_jobs=n_jobs).items()}
+
+        host_queues = defaultdict(list)   # host -> [(-size, position, entry)]
+        sizes = {}
+        for i, entry in enumerate(entries):
+            sizes[entry] = sum(lengths.pop(url, 0) for url, _ in self.get_urls(entry))  # count shared files once
+            host = self.get_host(entry)
+            heapq.heappush(host_queues[host], (-sizes[entry], i, entry))
+        heads = [(q[0][0], q[0][1], host) for host, q in host_queues.items()]
+        heapq.heapify(heads)
+        result, last_host = [], None
+        while heads:
+            head = heapq.heappop(heads)
+            if head[2] == last_host and heads:  # interleave hosts
+                head = heapq.heapreplace(heads, head)
+            last_host = head[2]
+            queue = host_queues[last_host]
+            result.append(heapq.heappop(queue)[2])
+            if queue:
+                heapq.heappush(heads, (queue[0][0], queue[0][1], last_host))
+        self.predict_time(result, sizes, n_jobs=n_jobs)
+        return result
+
+    def predict_time(self, entries: List[Entry], sizes: Dict[Entry, int], n_jobs=1) -> float:
+        """Predicts the time (seconds) to download entries in the given order by n_jobs workers"""
+        rates = {}
+        for entry in entries:
+            host = self.get_host(entry)
+            if host not in rates:
+                rates[host] = self.db.host_rate(host) or Defaults.DOWNLOAD_RATE_GUESS
+        workers = [0.0] * min(n_jobs, len(entries) or 1)  # finish times
+        for entry in entries:
+            heapq.heapreplace(workers, workers[0] + sizes[entry] / rates[self.get_host(entry)])
+        total_bytes = sum(sizes.values())
+        seconds = max(workers)
+        if bandwidth.rate:
+            seconds = max(seconds, total_bytes / bandwidth.rate)
+        if total_bytes:
+            log.info(f"To download: {format_byte_size(total_bytes)} of {sum(1 for e in entries if sizes[e])}"
+                     f" datasets with {n_jobs} jobs; predicted time: {datetime.timedelta(seconds=round(seconds))}")
+        return seconds
+
+    @staticmethod
+    def get_urls(entry: Entry) -> List[Tuple[str, Optional[str]]]:
+        """URLs of entry, and their file names (None means the URL's file name)"""
         if entry.in_ext == OPUS_XCES:
             aln_url, (l1_url, l2_url) = entry.url, entry.in_paths
-            urls += [l1_url, l2_url, aln_url]
-        else:
-            if isinstance(entry.url, (list, tuple)):
-                urls += entry.url
-            else:
-                assert isinstance(entry.url, str)
-                urls.append(entry.url)
-        lengths = [(url, self.get_url_content_length(url)) for url in urls]
+            return [(l1_url, None), (l2_url, None), (aln_url, None)]
+        if isinstance(entry.url, (list, tuple)):
+            return [(url, None) for url in entry.url]
+        assert isinstance(entry.url, str)
+        return [(entry.url, entry.filename)]
+
+    @staticmethod
+    def get_host(entry: Entry) -> str:
+        url = entry.url if isinstance(entry.url, str) else entry.url[0]
+        return urlparse(url).hostname or 'nohost'
+
+    def is_cached(self, url: str, filename=None) -> bool:
+        """Checks if url is downloaded to cache; not applicable to huggingface datasets"""
+        assert urlparse(url).hostname != 'huggingface.co'
+        local = self.get_local_path(url, filename=filename, fix_missing=False)
+        return self.get_flag_file(local).exists() and local.exists()
+
+    @property
+    def db(self) -> CacheDb:
+        return CacheDb.get(self.root)
+
+    def url_content_length(self, url: str) -> int:
+        """Content length of url; HEAD request is made if it is not known from earlier requests or downloads"""
+        return self.head(url)['length']
+
+    def head(self, url: str, ranges=False) -> Dict[str, Any]:
+        """
+        Content length, etag, last_modified and range support of url, from earlier requests or downloads in the last
+        Defaults.HEAD_TTL seconds (see CacheDb), or from a new HEAD request. HEAD requests are retried and
+        counted by the circuit breaker, the same as downloads (see mtdata.retry); a failed one is not sent again
+        in this run, and its error is raised again.
+        :param ranges: if range support is needed; earlier downloads do not tell it, so a HEAD request is made
+        """
+        head = self.db.get_head(url)
+        if head and time.time() - head['time'] < Defaults.HEAD_TTL and not (ranges and head['ranges'] is None):
+            return head
+        mirrored = self.find_in_mirror(url)
+        if mirrored:
+            return dict(length=mirrored.stat().st_size, etag=None, last_modified=None, ranges=None)
+        if url in failed_heads:
+            raise failed_heads[url]
+        try:
+            head = self.try_sources(url, self.head_source)
+        except Exception as e:
+            failed_heads[url] = e
+            raise
+        if head['length']:
+            self.db.put_head(url, **head)
+        return head
+
+    @classmethod
+    def head_source(cls, source: str) -> Dict[str, Any]:
+        """Content length, etag, last_modified and range support of source (a URL, or its mirror) from a HEAD request,
+        which is retried and counted by the circuit breaker; not cached"""
+        resp = RetryPolicy(retries=Defaults.HTTP_RETRIES).run(source, lambda: cls.head_request(source),
+                                                               desc=f'HEAD {source}')
+        return dict(length=int(resp.headers.get('Content-Length') or '0'), etag=resp.headers.get('ETag'),
+                    last_modified=resp.headers.get('Last-Modified'),
+                    ranges=resp.headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+    @staticmethod
+    def head_request(url: str) -> requests.Response:
+        log.debug(f"HEAD {url}")
+        with host_semaphore(url):
+            return check_status(url, get_session(url).head(url, headers=headers, allow_redirects=True, timeout=(5, 30)))
+
+    def try_sources(self, url: str, func: Callable[[str], Any]) -> Any:
+        """Calls func with the URLs of url in the mirror chain (see mtdata.mirror), until one succeeds"""
+        sources = self.mirrors.remote_urls(url)
+        if not sources:
+            raise MTDataException(f'{url} is not in any mirror, and it is rewritten to a local path')
+        for i, source in enumerate(sources):
+            try:
+                return func(source)
+            except Exception as e:
+                if i == len(sources) - 1:
+                    raise
+                log.info(f'{source} failed: {e}\n trying {sources[i + 1]}')
+
+    def heads(self, urls: List[str], n_jobs=Defaults.HEAD_JOBS) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Concurrent head() of urls, with n_jobs threads; None for urls whose HEAD request failed"""
+        urls = list(dict.fromkeys(urls))
+
+        def get_head(url):
+            try:
+                return self.head(url)
+            except Exception as e:
+                log.warning(f'HEAD {url} failed: {e}')
+                return None
+        with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+            return dict(zip(urls, pool.map(get_head, urls)))
+
+    def get_content_length(self, entry: Entry, heads: Dict[str, Optional[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Content lengths of URLs of entry
+        :param heads: from heads(); HEAD requests are made for urls that are missing
+        """
+        urls = [url for url, _ in self.get_urls(entry)]
+        heads = heads or {}
+        lengths = [(url, heads[url]['length'] if heads.get(url) else self.url_content_length(url)) for url in urls]
         total_bytes = sum(x[1] for x in lengths)
         stats = dict(id = str(entry.did),
                      total_bytes=total_bytes,
@@ -73,11 +382,17 @@ class Cache:
                      urls=dict(lengths))
         return stats
 
-    @classmethod
-    def get_url_content_length(cls, url: str) -> int:
-        log.debug(f"HEAD {url}")
-        length = requests.head(url).headers.get('content-length') or '0'
-        return int(length)
+    def get_content_lengths(self, entries: List[Entry], n_jobs=Defaults.HEAD_JOBS) -> List[Dict[str, Any]]:
+        """get_content_length() of many entries, with concurrent HEAD requests; failed entries have 'error'"""
+        heads = self.heads([url for entry in entries for url, _ in self.get_urls(entry)], n_jobs=n_jobs)
+        result = []
+        for entry in entries:
+            failed = [url for url, _ in self.get_urls(entry) if not heads[url]]
+            if failed:
+                result.append(dict(id=str(entry.did), error=f'HEAD failed: {" ".join(failed)}'))
+            else:
+                result.append(self.get_content_length(entry, heads=heads))
+        return result
 
     def get_stats(self, entry: Entry) -> Dict[str, Any]:
         path = self.get_entry(entry)
@@ -138,18 +453,312 @@ class Cache:
             #  I have considered not adding the dependency but there are a lot of file formats and
             # some are sharded datasets which require custom logic, and my custom code might not be future proof
             return self.get_hf_dataset(url, entry=entry)
-        filename = filename or url.split('/')[-1]
-        assert hostname and filename
-        mdf5_sum = md5(url.encode('utf-8')).hexdigest()
-        local = self.root / hostname / mdf5_sum[:4] / mdf5_sum[4:] / filename
+        local = self.root / self.url_path(url, filename=filename)
         if fix_missing:
+            self.lease(local)   # before download(), which checks if it exists; see gc()
             try:
                 self.download(url, local, entry=entry)
             except:
                 log.error(f'Error downloading {entry and entry.did} | url={url} | path={local}')
                 raise
+            self.db.touch(self.rel_path(local), size=local.stat().st_size, url=url, did=entry and str(entry.did))
         return local
 
+    @staticmethod
+    def url_path(url: str, filename=None) -> Path:
+        """Path of url, relative to cache root"""
+        hostname = urlparse(url).hostname or 'nohost'
+        filename = filename or url.split('/')[-1]
+        assert hostname and filename
+        mdf5_sum = md5(url.encode('utf-8')).hexdigest()
+        return Path(hostname, mdf5_sum[:4], mdf5_sum[4:], filename)
+
+    def find_in_mirror(self, url: str, filename=None) -> Optional[Path]:
+        """Local file of url in the mirror chain; None if no mirror has it (or it has to be downloaded)"""
+        if not self.mirrors or urlparse(url).hostname == 'huggingface.co':
+            return None
+        return self.mirrors.find(url, str(self.url_path(url, filename=filename)))
+
+    def link_from_mirror(self, url: str, save_at: Path, entry=None) -> bool:
+        """Adds the file of url at save_at from a local mirror, if any has it, without copying"""
+        mirrored = self.mirrors and self.mirrors.find(url, self.rel_path(save_at))
+        if not mirrored:
+            return False
+        method = link_file(mirrored, save_at)
+        log.info(f"Added from mirror ({method}): {mirrored} → {save_at}")
+        self.db.add_file(self.rel_path(save_at), url=url, size=save_at.stat().st_size, did=entry and str(entry.did))
+        return True
+
+    def rel_path(self, path: Path) -> str:
+        """Path relative to cache root, as stored in the manifest"""
+        return str(path.relative_to(self.root))
+
+    def scan(self) -> int:
+        """Adds files of cache that are missing in the manifest, e.g. downloaded by older versions of mtdata
+        :return: number of files added
+        """
+        known = self.db.paths()
+        count = 0
+        for flag in self.root.glob('*/*/*/*._valid'):
+            path = flag.with_name(flag.name[:-len('._valid')])
+            if path.is_file() and self.rel_path(path) not in known:
+                self.db.touch(self.rel_path(path), size=path.stat().st_size)
+                count += 1
+        return count
+
+    def get_lease_owner(self) -> str:
+        """
+        Lease owner id of this process. The owner holds a lock on root/.leases/<owner> while the process runs,
+        so that gc() can tell leases of running processes from those of processes that ended without releasing them.
+        """
+        key = (os.getpid(), self.root)
+        if key not in _lease_owners:
+            owner = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+            lease_file = self.root / '.leases' / owner
+            lease_file.parent.mkdir(parents=True, exist_ok=True)
+            lock = portalocker.Lock(lease_file, 'w', timeout=0, fail_when_locked=True)
+            lock.acquire()
+            _lease_owners[key] = (owner, lock)
+            atexit.register(self.release_leases, final=True)
+        return _lease_owners[key][0]
+
+    def lease(self, path: Path):
+        """Marks path as in use by this process, so gc() will not remove it"""
+        self.db.add_lease(self.rel_path(path), self.get_lease_owner())
+
+    def release_leases(self, final=False):
+        """Releases all leases of this process; final=True also releases the lease owner lock"""
+        key = (os.getpid(), self.root)
+        if key not in _lease_owners:
+            return
+        owner, lock = _lease_owners[key]
+        self.db.drop_leases(owner)
+        if final:
+            _lease_owners.pop(key)
+            lock.release()
+            (self.root / '.leases' / owner).unlink(missing_ok=True)
+
+    def live_leases(self, unit: Optional[Dict[str, Any]] = None) -> List[str]:
+        """
+        Paths leased by running processes; leases of ended processes are removed
+        :param unit: if given, only the owners of leases in unit (see get_gc_units()) are checked
+        """
+        result = []
+        for owner, paths in self.db.leases().items():
+            if unit and not self.in_use(unit, paths):
+                continue
+            lease_file = self.root / '.leases' / owner
+            if lease_file.exists():
+                try:
+                    with portalocker.Lock(lease_file, 'a', timeout=0, fail_when_locked=True):
+                        pass
+                except portalocker.exceptions.LockException:
+                    result.extend(paths)  # owner is running
+                    continue
+                lease_file.unlink(missing_ok=True)
+            log.debug(f'Removing stale leases of {owner}')
+            self.db.drop_leases(owner)
+        return result
+
+    def get_gc_units(self) -> List[Dict[str, Any]]:
+        """
+        Units of eviction: directory of each cached file, which also has its flags and extracted content (including
+        members of remote zips), and datasets of huggingface cache.
+        :return: list of dict(path, size, accessed, files), least recently used first; paths are relative to root
+        """
+        units = {}
+        for rec in self.db.files():
+            if not (self.root / rec['path']).exists():  # deleted manually
+                self.db.remove_file(rec['path'])
+                continue
+            unit_dir = str(Path(*Path(rec['path']).parts[:3]))  # host/md5[:4]/md5[4:]
+            unit = units.setdefault(unit_dir, dict(path=unit_dir, accessed=rec['accessed'], files=[]))
+            unit['accessed'] = max(unit['accessed'], rec['accessed'])
+            unit['files'].append(rec['path'])
+        hf_dir = self.root / HF_CACHE
+        if hf_dir.exists():
+            for child in hf_dir.iterdir():
+                if child.is_dir() and not child.name.startswith('.'):
+                    path = self.rel_path(child)
+                    units[path] = dict(path=path, accessed=child.stat().st_mtime, files=[])
+        for unit in units.values():
+            unit['size'] = dir_size(self.root / unit['path'])
+        return sorted(units.values(), key=lambda unit: unit['accessed'])
+
+    def gc(self, max_size: int, dry_run=False) -> List[Dict[str, Any]]:
+        """
+        Evicts least recently used files until the cache fits in max_size bytes.
+        Files that are leased by running processes (see lease()) or being downloaded are not evicted.
+        Evicting a file also removes its extracted content.
+        :return: the evicted units; see get_gc_units()
+        """
+        units = self.get_gc_units()
+        total = sum(unit['size'] for unit in units)
+        log.info(f'Cache size: {format_byte_size(total)}; max size: {format_byte_size(max_size)}')
+        evicted = []
+        leases = self.live_leases()  # leases made after this are caught by evict()
+        for unit in units:
+            if total <= max_size:
+                break
+            if self.in_use(unit, leases):
+                continue
+            if dry_run or self.evict(unit):
+                total -= unit['size']
+                evicted.append(unit)
+                log.info(f'{"Would evict" if dry_run else "Evicted"} {format_byte_size(unit["size"])}'
+                         f' {self.root / unit["path"]}')
+        if total > max_size:
+            log.warning(f'Cache size {format_byte_size(total)} is over {format_byte_size(max_size)};'
+                        f' the rest of the files are in use')
+        return evicted
+
+    @staticmethod
+    def in_use(unit: Dict[str, Any], leases: List[str]) -> bool:
+        prefix = unit['path'] + os.sep
+        return any(path == unit['path'] or path.startswith(prefix) or path == HF_CACHE and unit['path'].startswith(path)
+                   for path in leases)
+
+    def unit_downloads(self, unit: Dict[str, Any]) -> List[Path]:
+        """Downloaded files of unit; extracted members of remote zips map to the zip files"""
+        result = set()
+        for path in unit['files']:
+            path = self.root.joinpath(*Path(path).parts[:4])
+            if path.name.endswith('-extracted'):
+                path = path.with_name(path.name[:-len('-extracted')])
+            result.add(path)
+        return sorted(result)
+
+    def evict(self, unit: Dict[str, Any]) -> bool:
+        """Removes unit, unless it is being downloaded or leased; returns True if removed"""
+        unit_dir = self.root / unit['path']
+        locks = []
+        try:
+            for path in self.unit_downloads(unit):  # lock out downloads
+                lock_file = self.get_flag_file(path).with_suffix('._lock')
+                lock = portalocker.Lock(lock_file, 'w', timeout=0, fail_when_locked=True)
+                lock.acquire()
+                locks.append(lock)
+        except portalocker.exceptions.LockException:
+            for lock in locks:
+                lock.release()
+            return False
+        try:
+            # invalidate first, then check leases: a process that leases after this check will see files as missing
+            flags = [self.get_flag_file(self.root / path) for path in unit['files']]
+            flags = [flag for flag in flags if flag.exists()]
+            for flag in flags:
+                flag.unlink()
+            if self.in_use(unit, self.live_leases(unit=unit)):
+                for flag in flags:
+                    flag.touch()
+                return False
+            for path in unit['files']:
+                self.db.remove_file(path)
+            shutil.rmtree(unit_dir, ignore_errors=True)
+            return True
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def verify(self, n_jobs=1) -> Dict[str, List[str]]:
+        """
+        Checks content of cached files against checksums in the manifest, using n_jobs threads.
+        Mismatched files are moved to root/.quarantine and removed from the cache, so they are downloaded again.
+        Files without checksums (e.g. cached by older versions) get their checksums recorded.
+        :return: dict(ok=[paths], failed=[paths], added=[paths]); paths are relative to root
+        """
+        files = self.db.files()
+        result = dict(ok=[], failed=[], added=[])
+
+        def check(rec):
+            path = self.root / rec['path']
+            if not path.exists():
+                return rec, None
+            algo = rec['checksum'] and rec['checksum'].split(':')[0]
+            return rec, file_checksum(path, algo=algo)
+
+        with pbar_man.counter(desc="Verify", total=sum(rec['size'] for rec in files) // 2**20, unit='MiB') as pbar, \
+                ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for rec, checksum in pool.map(check, files):
+                pbar.update(incr=rec['size'] // 2**20)
+                if checksum is None:   # deleted manually
+                    self.db.remove_file(rec['path'])
+                elif not rec['checksum']:
+                    self.db.set_checksum(rec['path'], checksum)
+                    result['added'].append(rec['path'])
+                elif rec['checksum'] == checksum and rec['size'] == (self.root / rec['path']).stat().st_size:
+                    result['ok'].append(rec['path'])
+                else:
+                    log.warning(f"Checksum mismatch: {self.root / rec['path']} ; expected {rec['checksum']},"
+                                f" got {checksum}")
+                    self.quarantine(rec['path'])
+                    result['failed'].append(rec['path'])
+        return result
+
+    def quarantine(self, path: str):
+        """Moves a cached file to root/.quarantine, and removes it from the cache"""
+        local = self.root / path
+        valid_flag = self.get_flag_file(local)
+        with portalocker.Lock(valid_flag.with_suffix('._lock'), 'w', timeout=Defaults.FILE_LOCK_TIMEOUT):
+            valid_flag.unlink(missing_ok=True)
+            dest = self.root / '.quarantine' / path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(local, dest)
+            self.db.remove_file(path)
+        log.info(f"Quarantined {local} → {dest}")
+
+    def dedupe(self) -> int:
+        """
+        Replaces duplicate files (same size and checksum) in the cache with hardlinks to one copy.
+        :return: number of bytes freed
+        """
+        freed = 0
+        for paths in self.db.duplicates():
+            src = self.root / paths[0]
+            for path in paths[1:]:
+                dest = self.root / path
+                if not src.exists() or not dest.exists() or os.path.samefile(src, dest):
+                    continue
+                tmp = dest.with_name(dest.name + f'.tmp{os.getpid()}')
+                try:
+                    os.link(src, tmp)
+                except OSError as e:   # e.g. on different file systems
+                    log.warning(f"Unable to link {src} → {dest}: {e}")
+                    continue
+                os.replace(tmp, dest)
+                freed += dest.stat().st_size
+                log.info(f"Deduplicated {dest} → {src}")
+        return freed
+
+    def auto_gc(self):
+        """Applies the cache size budget of MTDATA_CACHE_MAX_SIZE, if set"""
+        if not cache_max_size:
+            return
+        self.release_leases()   # this process is done with the files
+        self.gc(parse_byte_size(cache_max_size))
+
+    def list_files(self) -> List[Dict[str, Any]]:
+        """Files in the cache, as recorded in the manifest; most recently accessed first"""
+        return self.db.files()
+
+    def cached_entries(self, entries: List[Entry]) -> Dict[Entry, bool]:
+        """Checks which entries are in the cache, according to the manifest; no file system access"""
+        paths = self.db.paths()
+        result = {}
+        for entry in entries:
+            if self.get_host(entry) == 'huggingface.co':
+                result[entry] = False  # managed by HF datasets library
+                continue
+            result[entry] = all(self.in_manifest(self.get_local_path(url, filename=filename, fix_missing=False), paths)
+                                for url, filename in self.get_urls(entry))
+        return result
+
+    def in_manifest(self, path: Path, paths: Set[str]) -> bool:
+        """Checks if path, or its members fetched from remote zip, are in the manifest paths"""
+        path = self.rel_path(path)
+        prefix = path + '-extracted' + os.sep
+        return path in paths or any(p.startswith(prefix) for p in paths)
+
     def get_hf_dataset(self, url: str, entry=None):
         # dataset lib has a lot of transient dependencies, so lazily load it
         #  and only when needed
@@ -161,7 +770,8 @@ class Cache:
         hf_id = entry.meta["orig_id"]
         config = entry.meta.get("config", None)
         split = entry.meta.get("split", None)
-        cache_dir = self.root / 'huggingface' / 'datasets'
+        cache_dir = self.root / HF_CACHE
+        self.lease(cache_dir)
 
         if isinstance(config, list):
             # Cross-config alignment: load two configs, join by a shared field
@@ -178,6 +788,7 @@ class Cache:
         if data_files:
             args['data_files'] = data_files
             args.pop('name', None)  # data_files and name are mutually exclusive
+        configure_huggingface()
         log.debug(f"Loading dataset {hf_id} with args: {args}")
         ds = load_dataset(hf_id, **args)
         if split is None and hasattr(ds, 'keys'):
@@ -198,8 +809,10 @@ class Cache:
         join_field = entry.meta.get("join_field", "id")
         src_config, tgt_config = configs
 
-        cache_dir = self.root / 'huggingface' / 'datasets'
+        cache_dir = self.root / HF_CACHE
+        self.lease(cache_dir)
         common_args = dict(cache_dir=cache_dir, streaming=False, trust_remote_code=False)
+        configure_huggingface()
         log.debug(f"Loading cross-config: {hf_id} [{src_config}] + [{tgt_config}]")
         ds1 = load_dataset(hf_id, name=src_config, split=split, **common_args)
         ds2 = load_dataset(hf_id, name=tgt_config, split=split, **common_args)
@@ -233,12 +846,127 @@ class Cache:
         return result
 
     def opus_xces_format(self, entry, fix_missing=True) -> List[Path]:
+        """
+        Alignment file and zip files of both languages. Only the docs referred by the alignment file are needed,
+        so if possible, they are fetched from the zips (see get_zip_members) and their directory is returned instead.
+        """
         assert entry.in_ext == OPUS_XCES
-        l1_url, l2_url = entry.in_paths
         align_file = self.get_local_path(entry.url, fix_missing=fix_missing, entry=entry)
-        l1_path = self.get_local_path(l1_url, fix_missing=fix_missing, entry=entry)
-        l2_path = self.get_local_path(l2_url, fix_missing=fix_missing, entry=entry)
-        return [align_file, l1_path, l2_path]
+        result = [align_file]
+        docs = None
+        for i, url in enumerate(entry.in_paths):
+            path = self.get_local_path(url, fix_missing=False)
+            if fix_missing:
+                if docs is None:
+                    from mtdata.opus_xces import OpusXcesParser
+                    docs = OpusXcesParser.doc_paths(
+                        align_file, preprocessing=OpusXcesParser.get_preprocessing(entry.in_paths[0]))
+                members = self.get_zip_members(url, path, entry=entry,
+                                               select=lambda names: sorted(docs[i].intersection(names)))
+                if members is not None:
+                    path = self.get_extracted_dir(path)
+                else:
+                    path = self.get_local_path(url, fix_missing=True, entry=entry)
+            result.append(path)
+        return result
+
+    @staticmethod
+    def get_extracted_dir(zip_path: Path) -> Path:
+        return zip_path.with_name(zip_path.name + '-extracted')
+
+    def get_zip_members(self, url: str, zip_path: Path, select: Callable[[List[str]], List[str]], entry=None) \
+            -> Optional[List[Path]]:
+        """
+        Gets members of the zip file at url without downloading all of it: the central directory and the selected
+        members are read with range requests (see mtdata.remotezip), and the members are extracted to
+        get_extracted_dir(zip_path). The member listing is cached in <zip_path>.members.json.
+        :param zip_path: local path of zip file, as in get_local_path()
+        :param select: maps the member names to the needed ones
+        :return: paths of the selected members; None if the zip should be downloaded instead, i.e., it is downloaded
+          already, it is small, or its server does not support range requests
+        """
+        if not remote_zip or self.get_flag_file(zip_path).exists() or self.mirrors.find(url, self.rel_path(zip_path)):
+            return None
+        out_dir = self.get_extracted_dir(zip_path)
+        members_file = zip_path.with_name(zip_path.name + '.members.json')
+        listing = self.read_json(members_file)
+        if listing:
+            wanted = select(listing['members'])
+            self.lease(zip_path)  # before checking that they exist; see evict()
+            if all((out_dir / name).exists() for name in wanted):
+                for name in wanted:
+                    self.db.touch(self.rel_path(out_dir / name), size=(out_dir / name).stat().st_size)
+                return [out_dir / name for name in wanted]
+        try:
+            head = self.head(url, ranges=True)
+        except Exception as e:
+            log.debug(f'Remote zip access is skipped: {url} ; {e}')
+            return None
+        size = head['length']
+        if not head['ranges'] or size < Defaults.REMOTE_ZIP_MIN_SIZE:
+            return None
+        validator = head['etag'] or head['last_modified']
+        source = self.mirrors.remote_urls(url)[0]
+        lock_file = self.get_flag_file(zip_path).with_suffix('._lock')
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        with portalocker.Lock(lock_file, 'w', timeout=Defaults.FILE_LOCK_TIMEOUT):
+            if self.get_flag_file(zip_path).exists():   # downloaded by other process while we waited
+                return None
+            self.lease(zip_path)
+            listing = self.read_json(members_file)
+            if listing and (listing['size'], listing['validator']) != (size, validator):
+                log.info(f'{url} has changed; removing members extracted earlier')
+                shutil.rmtree(out_dir, ignore_errors=True)
+                listing = None
+            try:
+                with host_semaphore(source), open_remote_zip(source, size=size, validator=validator,
+                                                          on_read=bandwidth.consume) as zip_file:
+                    if not listing:
+                        listing = dict(size=size, validator=validator,
+                                       members=[info.filename for info in zip_file.infolist() if not info.is_dir()])
+                        self.write_json(members_file, listing)
+                    wanted = select(listing['members'])
+                    for name in wanted:
+                        self.extract_zip_member(zip_file, name, out_dir, url=url, entry=entry)
+                    log.info(f'Read {len(wanted)} of {len(listing["members"])} members of {url};'
+                             f' transferred {format_byte_size(zip_stats(zip_file)["bytes"])} of {format_byte_size(size)}')
+            except (RangeNotSupported, requests.exceptions.RequestException, zipfile.BadZipFile) as e:
+                log.warning(f'Unable to read members of remote zip {url} ; {e}\n Downloading the whole zip')
+                return None
+        return [out_dir / name for name in wanted]
+
+    def extract_zip_member(self, zip_file: zipfile.ZipFile, name: str, out_dir: Path, url: str, entry=None):
+        target = out_dir / name
+        if name.startswith('/') or '..' in name.split('/'):
+            raise MTDataException(f'Attempted Path Traversal in Zip File: {name}')
+        if target.exists():
+            return target
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + f'.tmp{os.getpid()}')
+        hasher = new_hasher()
+        start_time = time.time()
+        with zip_file.open(name) as inp, open(tmp, 'wb') as out:
+            for chunk in iter(lambda: inp.read(2**20), b''):
+                hasher.update(chunk)
+                out.write(chunk)
+        os.replace(tmp, target)
+        self.db.add_file(self.rel_path(target), url=f'{url}#{name}', size=target.stat().st_size,
+                         seconds=time.time() - start_time, did=entry and str(entry.did),
+                         checksum=format_checksum(hasher))
+        return target
+
+    @staticmethod
+    def read_json(path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_json(path: Path, data: Dict[str, Any]):
+        tmp = path.with_name(path.name + f'.tmp{os.getpid()}')
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, path)
 
     def get_local_in_paths(self, path: Path, entry: Entry,):
         in_paths = entry.in_paths
@@ -251,7 +979,11 @@ class Cache:
         else:
             raise MTDataException(f'Unable to read {entry.did}; the file is neither zip nor tar')
 
-    def download(self, url: str, save_at: Path, timeout=(5, 10), entry=None):
+    def get_part_file(self, file: Path):
+        """Partial content of file while it is being downloaded"""
+        return file.with_name(file.name + '.part')
+
+    def download(self, url: str, save_at: Path, timeout=None, entry=None):
 
         valid_flag = self.get_flag_file(save_at)
         lock_file = valid_flag.with_suffix("._lock")
@@ -264,33 +996,310 @@ class Cache:
             # check if downloaded by  other parallel process
             if valid_flag.exists() and save_at.exists():
                 return save_at
-            log.debug(f"GET {url} → {save_at}")
-            try:
-                resp = requests.get(url=url, allow_redirects=True, headers=headers, stream=True,
-                                    timeout=timeout)
-            except requests.exceptions.SSLError as e:
-                log.warning(f"SSL verification failed for {url}: {e}; retrying without verification")
-                resp = requests.get(url=url, allow_redirects=True, headers=headers, stream=True,
-                                    timeout=timeout, verify=False)
-            assert resp.status_code == 200, resp.status_code
-            buf_size = 2 ** 14
-            tot_bytes = int(resp.headers.get('Content-Length', '0'))
-            parts = url.split('/')
-            desc = [entry and f'{entry.did} |' or '',
-                    tot_bytes and (format_byte_size(tot_bytes) + "|") or "",
-                    parts[2][:24], '...', parts[-1][-24:], # host ... filename
-                    ]
-            desc = ''.join(desc)
-            with pbar_man.counter(total=tot_bytes//2**10, unit='KiB',
-                                  desc=f"{desc}"
-                                  ) as pbar, open(save_at, 'wb', buffering=2**24) as out:
-                for chunk in resp.iter_content(chunk_size=buf_size):
-                    out.write(chunk)
-                    pbar.update(incr=buf_size//2**10)
+            self.download_locked(url, save_at, timeout=timeout, entry=entry)
             valid_flag.touch()
             lock_file.unlink()
             return save_at
 
+    def download_locked(self, url: str, save_at: Path, timeout=None, entry=None, on_chunk=None):
+        """
+        Downloads url to save_at, and records it in the manifest; the caller holds the download lock of save_at,
+        and marks it valid. The file is linked from a local mirror if one has it; else it is downloaded from the
+        HTTP mirrors, and then from the (rewritten) url. See mtdata.mirror
+        :param timeout: (connect, read) timeouts of requests; read timeout detects stalls
+        :param on_chunk: called with (position, bytes) of each chunk, in order; disables segmented download
+        """
+        save_at.parent.mkdir(parents=True, exist_ok=True)  # in case gc() removed it while we waited
+        if self.link_from_mirror(url, save_at, entry=entry):
+            return save_at
+        return self.try_sources(url, lambda source: self.download_from(
+            url, source, save_at, timeout=timeout, entry=entry, on_chunk=on_chunk))
+
+    def download_from(self, url: str, source: str, save_at: Path, timeout=None, entry=None, on_chunk=None):
+        """Downloads url from source, which is url or its mirror; see download_locked()"""
+        timeout = timeout or (5, Defaults.STALL_TIMEOUT)
+        part_file = self.get_part_file(save_at)
+        start_time = time.time()
+        checksum = None
+        if download_segments > 1 and not on_chunk and breaker.is_closed(source) \
+                and not self.read_part_meta(part_file, source):
+            try:
+                self.download_segmented(url, part_file, n_segments=download_segments, timeout=timeout,
+                                        entry=entry, source=source)
+                checksum = file_checksum(part_file)  # segments arrive out of order, so hash after
+            except NoSegmentSupport as e:
+                log.debug(f"Segmented download is skipped: {e}")
+            except requests.exceptions.RequestException as e:
+                log.warning(f"Segmented download failed: {source} ; {e}\n Falling back to single stream")
+        if not checksum:
+            def download_part():  # resumes from where the previous attempt stopped, if possible
+                with host_semaphore(source):
+                    return self.download_part(source, part_file, timeout=timeout, entry=entry, on_chunk=on_chunk)
+            checksum = RetryPolicy().run(source, download_part, desc=f'Download of {source}')
+        meta = self.read_part_meta(part_file, source)
+        os.replace(part_file, save_at)
+        self.get_part_meta_file(part_file).unlink(missing_ok=True)
+        size = save_at.stat().st_size
+        self.db.put_head(url, size, etag=meta.get('etag'), last_modified=meta.get('last_modified'))
+        seconds = time.time() - start_time
+        self.db.add_transfer(urlparse(source).hostname or 'nohost', size, seconds)
+        self.db.add_file(self.rel_path(save_at), url=url, size=size, seconds=seconds,
+                         did=entry and str(entry.did), checksum=checksum)
+        return save_at
+
+    @staticmethod
+    def get_part_meta_file(part_file: Path):
+        return part_file.with_name(part_file.name + '.json')
+
+    @classmethod
+    def read_part_meta(cls, part_file: Path, url: str) -> Dict[str, Any]:
+        """Metadata of a partial download of url, if it can be resumed; else an empty dict"""
+        meta_file = cls.get_part_meta_file(part_file)
+        if not part_file.exists() or not meta_file.exists() or not part_file.stat().st_size:
+            return {}
+        try:
+            meta = json.loads(meta_file.read_text())
+        except ValueError:
+            return {}
+        if meta.get('url') != url or not (meta.get('etag') or meta.get('last_modified')):
+            return {}
+        return meta
+
+    @staticmethod
+    def http_get(url: str, timeout, headers=headers) -> requests.Response:
+        try:
+            return get_session(url).get(url=url, allow_redirects=True, headers=headers, stream=True,
+                                        timeout=timeout)
+        except requests.exceptions.SSLError as e:
+            log.warning(f"SSL verification failed for {url}: {e}; retrying without verification")
+            return get_session(url).get(url=url, allow_redirects=True, headers=headers, stream=True, timeout=timeout,
+                                verify=False)
+
+    @staticmethod
+    def pbar_desc(url: str, tot_bytes: int, entry=None) -> str:
+        parts = url.split('/')
+        desc = [entry and f'{entry.did} |' or '',
+                tot_bytes and (format_byte_size(tot_bytes) + "|") or "",
+                parts[2][:24], '...', parts[-1][-24:], # host ... filename
+                ]
+        return ''.join(desc)
+
+    def download_part(self, url: str, part_file: Path, timeout=(5, Defaults.STALL_TIMEOUT), entry=None,
+                      on_chunk=None):
+        """
+        Downloads url to part_file. If part_file has content from an earlier attempt, and the server supports
+        range requests, the download is resumed from where it stopped.
+        Resumption is conditional (If-Range) on the ETag or Last-Modified of the earlier attempt,
+        so the content is downloaded from the beginning if the file on the server has changed.
+        :param on_chunk: called with (position, bytes) of each chunk, after it is written to part_file
+        :return: checksum of the content; see format_checksum()
+        """
+        meta = self.read_part_meta(part_file, url)
+        offset = meta and part_file.stat().st_size or 0
+        req_headers = dict(headers)
+        if offset:
+            req_headers['Range'] = f'bytes={offset}-'
+            # weak etags are not allowed in If-Range
+            etag = meta.get('etag')
+            req_headers['If-Range'] = etag if etag and not etag.startswith('W/') else meta['last_modified']
+        log.debug(f"GET {url} → {part_file} {offset and f'from byte {offset}' or ''}")
+        resp = self.http_get(url, timeout=timeout, headers=req_headers)
+        if offset and resp.status_code == 206:
+            start, tot_bytes = parse_content_range(resp.headers.get('Content-Range'))
+            if start != offset:
+                log.warning(f"Cannot resume {url}: requested byte {offset}, but got {start}; restarting")
+                resp.close()
+                part_file.unlink()
+                return self.download_part(url, part_file, timeout=timeout, entry=entry, on_chunk=on_chunk)
+        elif offset and resp.status_code == 416:  # range not satisfiable; maybe the earlier attempt was complete
+            resp.close()
+            _, tot_bytes = parse_content_range(resp.headers.get('Content-Range'))
+            if tot_bytes == offset:
+                return file_checksum(part_file)
+            log.warning(f"Cannot resume {url}: {offset} bytes on disk, but server has {tot_bytes}; restarting")
+            part_file.unlink()
+            return self.download_part(url, part_file, timeout=timeout, entry=entry, on_chunk=on_chunk)
+        else:
+            check_status(url, resp)
+            if offset:
+                log.info(f"Server did not resume {url}; content may have changed. Restarting")
+            offset = 0
+            tot_bytes = int(resp.headers.get('Content-Length', '0'))
+            self.get_part_meta_file(part_file).write_text(json.dumps(dict(
+                url=url, etag=resp.headers.get('ETag'), last_modified=resp.headers.get('Last-Modified'),
+                length=tot_bytes)))
+        buf_size = 2 ** 14
+        hasher = new_hasher()
+        if offset:
+            file_checksum(part_file, hasher=hasher)
+        with pbar_man.counter(total=tot_bytes//2**10, unit='KiB',
+                              desc=self.pbar_desc(url, tot_bytes, entry=entry)
+                              ) as pbar, open(part_file, 'ab' if offset else 'wb', buffering=2**24) as out:
+            offset and pbar.update(incr=offset//2**10)
+            for chunk in resp.iter_content(chunk_size=buf_size):
+                bandwidth.consume(len(chunk))
+                out.write(chunk)
+                hasher.update(chunk)
+                if on_chunk:
+                    on_chunk(offset, chunk)
+                offset += len(chunk)
+                pbar.update(incr=len(chunk)//2**10)
+        size = part_file.stat().st_size
+        if tot_bytes and size != tot_bytes:
+            raise requests.exceptions.ChunkedEncodingError(
+                f'Incomplete download of {url}: got {size:,} of {tot_bytes:,} bytes')
+        return format_checksum(hasher)
+
+
+    def download_segmented(self, url: str, part_file: Path, n_segments: int, timeout=(5, Defaults.STALL_TIMEOUT),
+                           entry=None, source: Optional[str] = None):
+        """
+        Downloads url to part_file as n_segments byte ranges over concurrent connections.
+        Ranges are written at their positions in a preallocated file. A range request that fails midway
+        is resumed from the last received byte, up to Defaults.DOWNLOAD_RESUMES times.
+        :param source: URL to download from, which is url or its mirror; default is url
+        :raises NoSegmentSupport: if the file is small, the server does not support range requests, or HEAD failed
+        """
+        if not hasattr(os, 'pwrite'):
+            raise NoSegmentSupport('os.pwrite is not available on this platform')
+        source = source or url
+        try:
+            head = self.head(url, ranges=True) if source == url else self.head_source(source)
+        except Exception as e:
+            raise NoSegmentSupport(f'HEAD {source} failed: {e}')
+        tot_bytes = head['length']
+        if not head['ranges']:
+            raise NoSegmentSupport(f'{source} does not accept range requests')
+        if tot_bytes < max(Defaults.SEGMENT_MIN_SIZE, n_segments):
+            raise NoSegmentSupport(f'{source} has {tot_bytes:,} bytes; less than {Defaults.SEGMENT_MIN_SIZE:,}')
+        etag = head['etag']
+        validator = etag if etag and not etag.startswith('W/') else head['last_modified']
+        url = source  # ranges are requested from source, following its redirects
+        seg_size = math.ceil(tot_bytes / n_segments)
+        ranges = [(start, min(start + seg_size, tot_bytes) - 1) for start in range(0, tot_bytes, seg_size)]
+        log.debug(f"GET {url} → {part_file} in {len(ranges)} segments")
+        self.get_part_meta_file(part_file).unlink(missing_ok=True)   # partial content is not resumable
+        pbar_lock, failed = threading.Lock(), threading.Event()
+
+        def get_range(fd, pbar, start, end):
+            attempt = 0
+            while start <= end:
+                req_headers = dict(headers, Range=f'bytes={start}-{end}')
+                if validator:
+                    req_headers['If-Range'] = validator
+                try:
+                    with host_semaphore(url), self.http_get(url, timeout=timeout, headers=req_headers) as resp:
+                        if resp.status_code != 206 or parse_content_range(resp.headers.get('Content-Range'))[0] != start:
+                            raise requests.exceptions.RequestException(
+                                f'Expected bytes {start}-{end}, but got {resp.status_code} '
+                                f'{resp.headers.get("Content-Range")}; the file might have changed')
+                        for chunk in resp.iter_content(chunk_size=2 ** 16):
+                            if failed.is_set():  # another segment has failed
+                                return
+                            chunk = chunk[:end + 1 - start]
+                            bandwidth.consume(len(chunk))
+                            os.pwrite(fd, chunk, start)
+                            start += len(chunk)
+                            with pbar_lock:
+                                pbar.update(incr=len(chunk) // 2**10)
+                        if start <= end:
+                            raise requests.exceptions.ChunkedEncodingError(
+                                f'Incomplete range {start}-{end} of {url}')
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout) as e:
+                    attempt += 1
+                    if attempt > Defaults.DOWNLOAD_RESUMES:
+                        failed.set()
+                        raise
+                    log.debug(f"Segment of {url} interrupted at byte {start}: {e}; resuming")
+                    time.sleep(RetryPolicy().wait_time(attempt))
+                except BaseException:
+                    failed.set()
+                    raise
+
+        with open(part_file, 'wb') as out, pbar_man.counter(
+                total=tot_bytes // 2**10, unit='KiB', desc=self.pbar_desc(url, tot_bytes, entry=entry)) as pbar:
+            fd = out.fileno()
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, tot_bytes)
+            else:
+                out.truncate(tot_bytes)
+            try:
+                with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                    futures = [pool.submit(get_range, fd, pbar, start, end) for start, end in ranges]
+                    for future in futures:
+                        future.result()
+            except BaseException:
+                out.close()
+                part_file.unlink(missing_ok=True)
+                raise
+        size = part_file.stat().st_size
+        if size != tot_bytes:
+            part_file.unlink()
+            raise requests.exceptions.ChunkedEncodingError(
+                f'Segmented download of {url} is {size:,} bytes; expected {tot_bytes:,}')
+        return part_file
+
+
+def new_hasher():
+    """Hash function of content checksums: xxhash (xxh3_128) if installed; else SHA-256 of stdlib"""
+    try:
+        import xxhash
+        return xxhash.xxh3_128()
+    except ImportError:
+        return hashlib.sha256()
+
+
+def format_checksum(hasher) -> str:
+    """e.g. sha256:<hex digest>; the prefix is the hash function"""
+    name = 'xxh3_128' if type(hasher).__module__.startswith('xxhash') else hasher.name
+    return f'{name}:{hasher.hexdigest()}'
+
+
+def file_checksum(path: Path, hasher=None, algo: str = None) -> str:
+    """Checksum of a file's content. Uses hasher if given (which is updated), else new hasher of algo or the default"""
+    if hasher is None:
+        if algo and algo.startswith('xxh'):
+            import xxhash
+            hasher = getattr(xxhash, algo)()
+        elif algo:
+            hasher = hashlib.new(algo)
+        else:
+            hasher = new_hasher()
+    with open(path, 'rb') as inp:
+        while True:
+            buf = inp.read(2 ** 20)
+            if not buf:
+                break
+            hasher.update(buf)
+    return format_checksum(hasher)
+
+
+def dir_size(path: Path) -> int:
+    """Bytes of files in path, recursively; symlinks are not followed"""
+    if not path.is_dir():
+        return path.lstat().st_size if path.exists() else 0
+    total = 0
+    for parent, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(parent, name)).st_size
+    return total
+
+
+def parse_content_range(value: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Parses Content-Range header value, e.g. 'bytes 100-199/1000' -> (100, 1000);  'bytes */1000' -> (None, 1000)
+    :return: (first byte position, total length); None for parts that are unknown
+    """
+    if not value:
+        return None, None
+    unit, _, spec = value.strip().partition(' ')
+    assert unit == 'bytes', f'Unsupported Content-Range {value}'
+    span, _, total = spec.partition('/')
+    start = None if span == '*' else int(span.split('-')[0])
+    total = None if total in ('', '*') else int(total)
+    return start, total
+
 
 def right_replace(string, old, new):
     """
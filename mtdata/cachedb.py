@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# SQLite database of download cache metadata; stored at <cache root>/mtdata.cache.sqlite
+#  heads: content length, validators and range support of URLs, from HEAD requests and completed downloads
+#  hosts: bytes and seconds of completed downloads per host, to estimate download rates
+#  files: manifest of cached files, with paths relative to cache root; file_dids: dataset ids that use the files
+#  leases: paths in use by running processes (owners); see Cache.lease() and Cache.gc()
+#  The database is shared by threads and processes; writes are serialized by SQLite locks.
+#
+# Created: 10/18/26
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS heads (
+    url TEXT PRIMARY KEY,
+    length INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    time REAL NOT NULL,
+    ranges INTEGER
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    url TEXT,
+    size INTEGER NOT NULL,
+    checksum TEXT,
+    downloaded REAL,
+    accessed REAL NOT NULL,
+    throughput REAL
+);
+CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed);
+CREATE TABLE IF NOT EXISTS file_dids (
+    path TEXT NOT NULL,
+    did TEXT NOT NULL,
+    PRIMARY KEY (path, did)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    path TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    PRIMARY KEY (path, owner)
+);
+"""
+
+FILE_COLUMNS = ('path', 'url', 'size', 'checksum', 'downloaded', 'accessed', 'throughput')
+
+
+class CacheDb:
+
+    instances = {}  # (pid, path) -> CacheDb
+    _lock = threading.Lock()
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.executescript(SCHEMA)
+        if 'ranges' not in [row[1] for row in self.con.execute('PRAGMA table_info(heads)')]:  # older schema
+            self.con.execute('ALTER TABLE heads ADD COLUMN ranges INTEGER')
+
+    @classmethod
+    def get(cls, root: Path) -> 'CacheDb':
+        """Database of cache at root; one instance per process"""
+        key = (os.getpid(), Path(root))
+        if key not in cls.instances:
+            with cls._lock:
+                if key not in cls.instances:
+                    cls.instances[key] = cls(Path(root) / 'mtdata.cache.sqlite')
+        return cls.instances[key]
+
+    def execute(self, sql: str, params=()) -> list:
+        with self.lock:
+            return self.con.execute(sql, params).fetchall()
+
+    def get_head(self, url: str) -> Optional[Dict[str, Any]]:
+        rows = self.execute('SELECT length, etag, last_modified, time, ranges FROM heads WHERE url = ?', (url,))
+        if not rows:
+            return None
+        head = dict(zip(('length', 'etag', 'last_modified', 'time', 'ranges'), rows[0]))
+        head['ranges'] = None if head['ranges'] is None else bool(head['ranges'])
+        return head
+
+    def put_head(self, url: str, length: int, etag: str = None, last_modified: str = None, ranges: bool = None):
+        """
+        :param ranges: if url supports range requests; None if unknown
+        """
+        self.execute('INSERT OR REPLACE INTO heads (url, length, etag, last_modified, time, ranges)'
+                     ' VALUES (?, ?, ?, ?, ?, ?)',
+                     (url, length, etag, last_modified, time.time(), None if ranges is None else int(ranges)))
+
+    def add_transfer(self, host: str, n_bytes: int, seconds: float):
+        """Records a download of n_bytes from host that took seconds"""
+        self.execute('INSERT INTO hosts VALUES (?, ?, ?) ON CONFLICT (host) DO UPDATE'
+                     ' SET bytes = bytes + excluded.bytes, seconds = seconds + excluded.seconds',
+                     (host, n_bytes, seconds))
+
+    def host_rate(self, host: str) -> Optional[float]:
+        """Average download rate from host in bytes per second; None if unknown"""
+        rows = self.execute('SELECT bytes, seconds FROM hosts WHERE host = ?', (host,))
+        if not rows or rows[0][1] <= 0:
+            return None
+        return rows[0][0] / rows[0][1]
+
+    def add_file(self, path: str, url: Optional[str], size: int, seconds: float = None, did: str = None,
+                 checksum: str = None):
+        """Records a downloaded file; path is relative to cache root"""
+        now = time.time()
+        throughput = size / seconds if seconds else None
+        with self.lock:
+            with self.con:
+                self.con.execute('BEGIN')
+                self.con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (path, url, size, checksum, now, now, throughput))
+                if did:
+                    self.con.execute('INSERT OR IGNORE INTO file_dids VALUES (?, ?)', (path, did))
+
+    def touch(self, path: str, size: int, url: str = None, did: str = None):
+        """Records an access of a cached file; adds it to manifest if missing, e.g. cached by older versions"""
+        with self.lock:
+            with self.con:
+                self.con.execute('BEGIN')
+                self.con.execute('INSERT INTO files (path, url, size, accessed) VALUES (?, ?, ?, ?)'
+                                 ' ON CONFLICT (path) DO UPDATE SET accessed = excluded.accessed',
+                                 (path, url, size, time.time()))
+                if did:
+                    self.con.execute('INSERT OR IGNORE INTO file_dids VALUES (?, ?)', (path, did))
+
+    def get_file(self, path: str) -> Optional[Dict[str, Any]]:
+        rows = self.execute(f'SELECT {", ".join(FILE_COLUMNS)} FROM files WHERE path = ?', (path,))
+        return rows and dict(zip(FILE_COLUMNS, rows[0])) or None
+
+    def files(self) -> List[Dict[str, Any]]:
+        """All files in the manifest, with their dataset ids; most recently accessed first"""
+        rows = self.execute(f"SELECT {', '.join('f.' + c for c in FILE_COLUMNS)}, GROUP_CONCAT(d.did, ' ')"
+                            ' FROM files f LEFT JOIN file_dids d ON f.path = d.path'
+                            ' GROUP BY f.path ORDER BY f.accessed DESC')
+        return [dict(zip(FILE_COLUMNS + ('dids',), row)) for row in rows]
+
+    def paths(self) -> Set[str]:
+        return set(path for path, in self.execute('SELECT path FROM files'))
+
+    def remove_file(self, path: str):
+        with self.lock:
+            with self.con:
+                self.con.execute('BEGIN')
+                self.con.execute('DELETE FROM files WHERE path = ?', (path,))
+                self.con.execute('DELETE FROM file_dids WHERE path = ?', (path,))
+
+    def add_lease(self, path: str, owner: str):
+        self.execute('INSERT OR IGNORE INTO leases VALUES (?, ?)', (path, owner))
+
+    def leases(self) -> Dict[str, Set[str]]:
+        """owner -> leased paths"""
+        result = {}
+        for path, owner in self.execute('SELECT path, owner FROM leases'):
+            result.setdefault(owner, set()).add(path)
+        return result
+
+    def drop_leases(self, owner: str):
+        self.execute('DELETE FROM leases WHERE owner = ?', (owner,))
+
+    def set_checksum(self, path: str, checksum: str):
+        self.execute('UPDATE files SET checksum = ? WHERE path = ?', (checksum, path))
+
+    def duplicates(self) -> List[List[str]]:
+        """Groups of paths that have the same size and checksum"""
+        rows = self.execute("SELECT GROUP_CONCAT(path, '\n') FROM files WHERE checksum IS NOT NULL"
+                            " GROUP BY checksum, size HAVING COUNT(*) > 1")
+        return [sorted(paths.split('\n')) for paths, in rows]
@@ -7,7 +7,6 @@ import concurrent.futures
 import json
 from itertools import zip_longest
 from pathlib import Path
-import random
 from typing import Dict, List, Tuple, Union
 
 import portalocker
@@ -20,6 +19,7 @@ from mtdata.entry import DatasetId, Entry, LangPair
 from mtdata.index import INDEX
 from mtdata.iso.bcp47 import BCP47Tag, bcp47
 from mtdata.parser import Parser
+from mtdata.plan import Plan, make_plan
 from mtdata.utils import IO
 
 DEF_COMPRESS = 'gz'
@@ -85,40 +85,21 @@ class Dataset:
         """
         if n_jobs == 1:
             return [cache.get_entry(ent) for ent in entries]
-        import multiprocessing as mp
         log.info(f"Downloading {len(entries)} datasets in parallel with {n_jobs} jobs")
-        result = {}
-        entries = list(entries) # make a copy
-        # shuffle to hit different servers at the same time
-        random.seed(42)
-        random.shuffle(entries)
-        status = dict(total=len(entries), success=0, failed=0)
-        progress_queue = mp.Queue()
-        with pbar_man.counter(desc="Downloads", total=len(entries)) as overall_pbar:
-            with pbar_man.consume_remote(progress_queue):
-                with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs,
-                        initializer=_worker_init, initargs=(progress_queue, log.WARNING)) as executor:
-                    futures_to_entry = {executor.submit(cache.get_entry, entry): entry for entry in entries}
-                    for future in concurrent.futures.as_completed(futures_to_entry.keys()):
-                        entry:Entry = futures_to_entry[future]
-                        try:
-                            paths = future.result()   # paths, ignore
-                            result[entry] = paths
-                            status['success'] += 1
-                            log.info(f"[{status['success']}/{status['total']}] Downloaded {entry.did}")
-                        except Exception as exc:
-                            result[entry] = None
-                            status['failed'] += 1
-                            log.warning(f"Failed to download {entry.did}: {exc} Total failed: {status['failed']}")
-                        finally:
-                            overall_pbar.update()
-        log.info(f"Downloaded {status['success']} datasets. Failed to download {status['failed']}")
-        return result
+        return cache.get_entries(entries, n_jobs=n_jobs)
+
+    @classmethod
+    def plan(cls, out_dir: Path, dataset_ids: Dict[str, List[DatasetId]], cache_dir: Path = CACHE_DIR,
+             merge_train=False, compress=False, n_jobs=1) -> Plan:
+        """Estimates bytes to download, extract and write for preparing a dataset, and checks free disk space"""
+        entries = [(name, ent) for name in DATA_FIELDS for ent in cls.resolve_entries(dataset_ids.get(name) or [])]
+        return make_plan(Cache(cache_dir), entries, out_dir=out_dir, merge_train=merge_train, compress=compress,
+                         n_jobs=n_jobs)
 
     @classmethod
     def prepare(cls, langs, out_dir: Path, dataset_ids=Dict[str, List[DatasetId]],
                 cache_dir: Path = CACHE_DIR, merge_train=False, drop_noise: Tuple[bool, bool] = (True, False),
-                compress=False, drop_dupes=False, drop_tests=False, fail_on_error=False, n_jobs=1):
+                compress=False, drop_dupes=False, drop_tests=False, fail_on_error=False, n_jobs=1, check_space=False):
         drop_train_noise, drop_test_noise = drop_noise
         assert langs, 'langs required'
         assert dataset_ids
@@ -132,7 +113,12 @@ class Dataset:
         for ent in all_entries:
             if not ent.is_compatible(langs):
                 raise MTDataUserError(f'Dataset {ent.did} is not compatible for {"-".join(map(str, langs))}')
+        if check_space:  # fail now, rather than hours later when the disk is full
+            cls.plan(out_dir, dataset_ids=dataset_ids, cache_dir=cache_dir, merge_train=merge_train,
+                     compress=compress, n_jobs=n_jobs).check()
         if n_jobs > 1:
+            # all are downloaded in this process, which enforces the bandwidth budget and connections per host;
+            #  the limits are per process, so streaming in the n_jobs workers of phase 2 would multiply them
             cls.parallel_download(all_entries, Cache(cache_dir), n_jobs=n_jobs)
 
         dataset = cls(dir=out_dir, langs=langs, cache_dir=cache_dir, drop_train_noise=drop_train_noise,
@@ -201,6 +187,7 @@ class Dataset:
                 cite = cite or '%% UNKNOWN'
                 fh.write(f"%% {ent.did}\n{cite}\n\n")
         log.info(f"Created references at {refs_file}")
+        dataset.cache.auto_gc()
         return dataset
 
     def hash_all_bitexts(self, paired_files):
@@ -278,37 +265,37 @@ class Dataset:
         if flag_file.exists():
             pbar_man.emit_log(log.INFO, f"{flag_file} exists. Skipping")
             return -1, -1
-        cache_path = self.cache.get_entry(entry)
-        parser = Parser(cache_path, ext=entry.in_ext or None, ent=entry)
-        out_path, meta_file = self.get_paths(dirpath, entry, compress=compress)
-        pbar_man.emit_log(log.INFO, f"Writing {entry.did} to {out_path}")
-        io_args = dict(encoding='utf-8', errors='ignore')
-        with pbar_man.counter(unit='line', desc=f"Processing {entry.did}") as pbar, \
-                IO.writer(out_path, **io_args) as out, IO.writer(meta_file, **io_args) as out_meta:
-            count, skips = 0, 0
-            has_meta = None
-            for row in parser.read_segs(show_pbar=False):
-                if has_meta is None:
-                    has_meta = bool(isinstance(row, (list, tuple)) and len(row) > 1)
-                sentence = row[0] if isinstance(row, (list, tuple)) else row
-                sentence = sentence.strip().replace('\t', ' ').replace('\r', ' ') if sentence else ''
-                if not sentence:
-                    skips += 1
-                    pbar.update()
-                    continue
-                out.write(sentence + '\n')
-                if has_meta:
-                    meta = json.dumps(row[1], ensure_ascii=False, indent=None).replace('\t', ' ').replace('\r', ' ')
-                    out_meta.write(meta + '\n')
-                count += 1
-                pbar.update(write_count=count)
-            msg = f'Looks like an error. {count} segs are valid {skips} are invalid: {entry}'
-            assert count > 0, msg
-            if skips > count:
-                pbar_man.emit_log(log.WARNING, msg)
-                pbar_man.emit_log(log.INFO, f"{entry}: Skips : {skips:,}/{count:,} => {100 * skips / count:.4f}%")
-            if not has_meta and meta_file.exists():
-                meta_file.unlink()
+        with self.cache.stream_entry(entry) as cache_path:
+            parser = Parser(cache_path, ext=entry.in_ext or None, ent=entry)
+            out_path, meta_file = self.get_paths(dirpath, entry, compress=compress)
+            pbar_man.emit_log(log.INFO, f"Writing {entry.did} to {out_path}")
+            io_args = dict(encoding='utf-8', errors='ignore')
+            with pbar_man.counter(unit='line', desc=f"Processing {entry.did}") as pbar, \
+                    IO.writer(out_path, **io_args) as out, IO.writer(meta_file, **io_args) as out_meta:
+                count, skips = 0, 0
+                has_meta = None
+                for row in parser.read_segs(show_pbar=False):
+                    if has_meta is None:
+                        has_meta = bool(isinstance(row, (list, tuple)) and len(row) > 1)
+                    sentence = row[0] if isinstance(row, (list, tuple)) else row
+                    sentence = sentence.strip().replace('\t', ' ').replace('\r', ' ') if sentence else ''
+                    if not sentence:
+                        skips += 1
+                        pbar.update()
+                        continue
+                    out.write(sentence + '\n')
+                    if has_meta:
+                        meta = json.dumps(row[1], ensure_ascii=False, indent=None).replace('\t', ' ').replace('\r', ' ')
+                        out_meta.write(meta + '\n')
+                    count += 1
+                    pbar.update(write_count=count)
+                msg = f'Looks like an error. {count} segs are valid {skips} are invalid: {entry}'
+                assert count > 0, msg
+                if skips > count:
+                    pbar_man.emit_log(log.WARNING, msg)
+                    pbar_man.emit_log(log.INFO, f"{entry}: Skips : {skips:,}/{count:,} => {100 * skips / count:.4f}%")
+                if not has_meta and meta_file.exists():
+                    meta_file.unlink()
         flag_file.touch()
         return count, skips
 
@@ -321,6 +308,7 @@ class Dataset:
         if lang1.is_compatible(lang2):
             raise Exception(f"Unable to merge for {lang1}-{lang2}; it can result in unpredictable behavior.")
         paired_files = {}
+        parts_list = []
         for path in dir_path.glob("*.*"):
             if path.name.startswith("."):
                 continue
@@ -328,10 +316,10 @@ class Dataset:
             assert len(parts) >= 2, f'Invalid file name {path.name}; Unable to merge parts'
             if parts[-1] == DEF_COMPRESS:
                 parts = parts[:-1]
-            *did, ext = parts  # did can have a dot e.g. version 7.1
-            did = '.'.join(did)
-            # dids, ext = parts[:2]
-            ext = bcp47(ext)
+            parts_list.append((path, parts))
+        exts = bcp47.parse_many(parts[-1] for _, parts in parts_list)
+        for (path, parts), ext in zip(parts_list, exts):
+            did = '.'.join(parts[:-1])  # did can have a dot e.g. version 7.1
             if did not in paired_files:
                 paired_files[did] = [None, None]
             if lang1.is_compatible(ext):
@@ -527,44 +515,44 @@ class Dataset:
         if flag_file.exists():
             pbar_man.emit_log(log.INFO, f"{flag_file} exists. Skipping")
             return -1, -1
-        path = self.cache.get_entry(entry)
-        parser = Parser(path, ext=entry.in_ext or None, ent=entry)
-        l1, l2, meta_file = self.get_paths(dir_path, entry, compress=compress)
-        io_args = dict(encoding='utf-8', errors='ignore')
-        with pbar_man.counter(unit='line', desc=f"Processing {entry.did}") as pbar, \
-                IO.writer(l1, **io_args) as f1, IO.writer(l2, **io_args) as f2, IO.writer(meta_file, **io_args) as f3:
-            count, skips, noise = 0, 0, 0
-            has_meta = None
-            for rec in parser.read_segs(show_pbar=False):
-                if has_meta is None:
-                    has_meta = bool(len(rec) > 2)
-                if len(rec) < 2:
-                    skips += 1
-                    pbar.update()
-                    continue
-                if drop_noise and entry.is_noisy(seg1=rec[0], seg2=rec[1]):
-                    skips += 1
-                    noise += 1
-                    pbar.update()
-                    continue
-                sent1, sent2 = rec[0].strip(), rec[1].strip()
-                if not sent1 or not sent2:
-                    skips += 1
-                    pbar.update()
-                    continue
-                f1.write(sent1.replace('\t', ' ').replace('\r', ' ') + '\n')
-                f2.write(sent2.replace('\t', ' ').replace('\r', ' ') + '\n')
-                if has_meta:
-                    f3.write(json.dumps(rec[2], ensure_ascii=False, indent=None) + '\n')
-                count += 1
-                pbar.update(write_count=count)
-            msg = f'Looks like an error. {count} segs are valid {skips} are invalid: {entry}'
-            assert count > 0, msg
-            if skips > count:
-                pbar_man.emit_log(log.WARNING, msg)
-            if noise > 0:
-                pbar_man.emit_log(log.INFO, f"{entry}: Noise : {noise:,}/{count:,} => {100 * noise / count:.4f}%")
-            pbar_man.emit_log(log.INFO, f"wrote {count} lines to {l1} == {l2}")
+        with self.cache.stream_entry(entry) as path:
+            parser = Parser(path, ext=entry.in_ext or None, ent=entry)
+            l1, l2, meta_file = self.get_paths(dir_path, entry, compress=compress)
+            io_args = dict(encoding='utf-8', errors='ignore')
+            with pbar_man.counter(unit='line', desc=f"Processing {entry.did}") as pbar, \
+                    IO.writer(l1, **io_args) as f1, IO.writer(l2, **io_args) as f2, IO.writer(meta_file, **io_args) as f3:
+                count, skips, noise = 0, 0, 0
+                has_meta = None
+                for rec in parser.read_segs(show_pbar=False):
+                    if has_meta is None:
+                        has_meta = bool(len(rec) > 2)
+                    if len(rec) < 2:
+                        skips += 1
+                        pbar.update()
+                        continue
+                    if drop_noise and entry.is_noisy(seg1=rec[0], seg2=rec[1]):
+                        skips += 1
+                        noise += 1
+                        pbar.update()
+                        continue
+                    sent1, sent2 = rec[0].strip(), rec[1].strip()
+                    if not sent1 or not sent2:
+                        skips += 1
+                        pbar.update()
+                        continue
+                    f1.write(sent1.replace('\t', ' ').replace('\r', ' ') + '\n')
+                    f2.write(sent2.replace('\t', ' ').replace('\r', ' ') + '\n')
+                    if has_meta:
+                        f3.write(json.dumps(rec[2], ensure_ascii=False, indent=None) + '\n')
+                    count += 1
+                    pbar.update(write_count=count)
+                msg = f'Looks like an error. {count} segs are valid {skips} are invalid: {entry}'
+                assert count > 0, msg
+                if skips > count:
+                    pbar_man.emit_log(log.WARNING, msg)
+                if noise > 0:
+                    pbar_man.emit_log(log.INFO, f"{entry}: Noise : {noise:,}/{count:,} => {100 * noise / count:.4f}%")
+                pbar_man.emit_log(log.INFO, f"wrote {count} lines to {l1} == {l2}")
         if not has_meta and meta_file.exists():
             meta_file.unlink()
         flag_file.touch()
@@ -3,35 +3,84 @@
 # Author: Thamme Gowda [tg (at) isi (dot) edu]
 # Created: 4/8/20
 import collections
-import pickle
+import concurrent.futures
+from hashlib import md5
 from pathlib import Path
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Mapping, Optional, Set, Tuple
 import json
 import importlib
+import importlib.util
 import os
 
 import portalocker
-from pybtex.database import parse_file as parse_bib_file
 
-from mtdata import log, cached_index_file, __version__, resource_dir
-from mtdata.entry import Entry, DatasetId
+from mtdata import log, cached_index_file, __version__, resource_dir, MTDataException, index_backend
+from mtdata.entry import Entry, DatasetId, DID_DELIM
 from mtdata.iso.bcp47 import bcp47, BCP47Tag
+from mtdata.iso.lookup import lookup_file as iso_lookup_file
+from mtdata.index.store import EntryTable, IndexWriter, IndexFormatError, pair_key
+from mtdata.utils import LazyProxy
 
 REFS_FILE = resource_dir / "refs.bib"
+SEGMENTS_DIR = cached_index_file.with_suffix('.segments')   # one index file per module
+# changes to these invalidate all segments: code that stores entries, parses languages (bcp47) and
+#  detects file extensions (parser), which all modules use
+_pkg_dir = Path(__file__).parent.parent
+CORE_FILES = [Path(__file__), Path(__file__).parent / 'store.py', _pkg_dir / 'entry.py', _pkg_dir / 'parser.py',
+              _pkg_dir / 'iso' / '__init__.py', _pkg_dir / 'iso' / 'bcp47.py', _pkg_dir / 'iso' / 'lookup.py',
+              iso_lookup_file]
+
+
+def fingerprint(*paths: Path) -> str:
+    """Hash of content of files; missing files are hashed by name only"""
+    hash = md5()
+    for path in paths:
+        hash.update(path.name.encode('utf-8'))
+        if path.exists():
+            hash.update(path.read_bytes())
+    return hash.hexdigest()
 
 
 class Index:
 
     obj = None  # singleton object
 
-    def __init__(self):
-        self.entries: Dict[DatasetId, Entry] = {}  # unique dids
+    # provider modules and the resource files (in resource_dir) they read.
+    # Each module's entries are stored as a separate segment, keyed by fingerprint of its source and resources
+    SUB_MODULES: Dict[str, Tuple[str, ...]] = {
+        ".statmt": (),
+        ".paracrawl": (),
+        ".tilde": (),
+        ".joshua_indian": (),
+        ".unitednations": (),
+        ".wikimatrix": (),
+        ".other": (),
+        ".neulab_tedtalks": (),
+        ".elrc_share": ('elrc_share.tsv',),
+        ".ai4bharat": (),
+        ".eu": (),
+        ".linguatools": (),
+        ".anuvaad": ('anuvaad.tsv',),
+        ".allenai_nllb": ('allenai_nllb.json',),
+        ".flores": (),
+        ".opus.opus_index": ('opus_index.tsv',),
+        ".opus.opus100": (),
+        ".leipzig": ('leipzig_de.txt',),
+        ".huggingface": ('huggingface-datasets.jsonl',),
+    }
+
+    def __init__(self, entries: Optional[Mapping[DatasetId, Entry]] = None):
+        # dict while building the index; memory mapped EntryTable when loaded from cache
+        self.entries: Mapping[DatasetId, Entry] = {} if entries is None else entries  # unique dids
         self.papers = {}  # unique
-        self.ref_db = ReferenceDb()
         self.version = __version__
 
+    @property
+    def ref_db(self) -> 'ReferenceDb':
+        return ReferenceDb()
+
     @classmethod
-    def get_instance(cls):
+    def get_instance(cls, n_jobs=1):
         if not cls.obj:
             if not cached_index_file.exists():
                 log.info("Creating a fresh index object")
@@ -40,23 +89,31 @@ class Index:
                 with portalocker.Lock(lock_file, "w", timeout=60) as fh:
                     # got lock, check cache is not created by parallel processes while we waited
                     if not cached_index_file.exists():
-                        obj = Index()
                         log.info("Indexing all datasets...")
-                        obj.load_all()
-                        log.info(f"Caching my index file at {cached_index_file}")
-                        with open(cached_index_file, "wb") as out:
-                            pickle.dump(obj, out)
-                        obj.store_index(cached_index_file.with_suffix('.jsonl'))
+                        cls.build(cached_index_file, n_jobs=n_jobs)
+                        log.info(f"Cached my index file at {cached_index_file}")
+                        cls.load(cached_index_file).store_index(cached_index_file.with_suffix('.jsonl'))
 
             assert cached_index_file.exists()
             log.debug(f"Loading index from cache {cached_index_file}")
-            with open(cached_index_file, "rb") as inp:
-                obj = pickle.load(inp)
-
-            assert isinstance(obj, cls), f"{cached_index_file} isnt valid. please move or remove it"
-            cls.obj = obj
+            cls.obj = cls.load(cached_index_file)
         return cls.obj
-    
+
+    @classmethod
+    def load(cls, path: Path) -> 'Index':
+        """Opens index file; entries are read lazily from a memory map"""
+        try:
+            table = EntryTable(path)
+        except IndexFormatError as e:
+            raise MTDataException(str(e)) from e
+        return cls(entries=table)
+
+    def save(self, path: Path):
+        writer = IndexWriter()
+        for ent in self.entries.values():
+            writer.add_entry(ent)
+        writer.write(path)
+
     def store_index(self, path, format='jsonl'):
         assert format in ('jsonl',) #TODO support tsv
         with open(path, 'w', encoding='utf8') as out:
@@ -68,48 +125,91 @@ class Index:
                 count += 1
 
         log.info(f'Wrote {count:,} entries to {path}')
-            
-    def load_all(self):
-       
-        sub_modules = [
-            ".statmt",
-            ".paracrawl",
-            ".tilde",
-            ".joshua_indian",
-            ".unitednations",
-            ".wikimatrix",
-            ".other",
-            ".neulab_tedtalks",
-            ".elrc_share",
-            ".ai4bharat",
-            ".eu",
-            ".linguatools",
-            ".anuvaad",
-            ".allenai_nllb",
-            ".flores",
-            ".opus.opus_index",
-            ".opus.opus100",
-            ".leipzig",
-            ".huggingface",
-        ]
+
+    @classmethod
+    def get_sub_modules(cls) -> Dict[str, List[Path]]:
+        """Gets module names mapped to the files that make up their fingerprint"""
+        sub_modules = {}
+        for mod_name, resources in cls.SUB_MODULES.items():
+            source = Path(importlib.util.find_spec(mod_name, package=__name__).origin)
+            # __init__.py of packages between this package and module, e.g. opus/__init__.py of .opus.opus_index
+            packages = [source.parents[i] / '__init__.py' for i in range(mod_name.count('.') - 1)]
+            sub_modules[mod_name] = CORE_FILES + packages + [source] + [resource_dir / res for res in resources]
         # modules from CWD
         for p in Path('.').glob('mtdata*.py'):
-            module = p.name.replace('.py', '')
-            sub_modules.append(module)
-        #sub_modules = ['.statmt']
-        for mod_name in sub_modules:
-            module = importlib.import_module(mod_name, package=__name__)
-            log.info(f'Loading module {mod_name}' )
-            if hasattr(module, 'load_all'):
-                getattr(module, 'load_all')(self)
-            else:
-                log.warning(f'skipping {module}.. no load_all() found')
+            sub_modules[p.stem] = CORE_FILES + [p]
+        return sub_modules
+
+    def load_module(self, mod_name: str):
+        module = importlib.import_module(mod_name, package=__name__)
+        log.info(f'Loading module {mod_name}' )
+        if hasattr(module, 'load_all'):
+            getattr(module, 'load_all')(self)
+        else:
+            log.warning(f'skipping {module}.. no load_all() found')
+
+    @classmethod
+    def get_segment(cls, mod_name: str, files: List[Path]) -> Path:
+        """Gets the index segment of a module; (re)creates it when it is missing or its files have changed"""
+        seg_name = mod_name.lstrip('.')
+        path = SEGMENTS_DIR / f'{seg_name}.{fingerprint(*files)}.idx'
+        if path.exists():
+            log.info(f'Module {mod_name} is unchanged; reusing {path.name}')
+            return path
+        obj = cls()
+        obj.load_module(mod_name)
+        SEGMENTS_DIR.mkdir(parents=True, exist_ok=True)
+        obj.save(path)
+        return path
+
+    @classmethod
+    def build(cls, path: Path, n_jobs=1):
+        """Builds the index at path by merging segments of all modules. Only the outdated segments are rebuilt.
+        :param path: path to store the index
+        :param n_jobs: number of worker processes that build segments of modules in parallel
+        """
+        sub_modules = cls.get_sub_modules()
+        if n_jobs > 1:
+            log.info(f"Building index segments of {len(sub_modules)} modules with {n_jobs} jobs")
+            seg_files = {}
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {executor.submit(cls.get_segment, mod_name, files): mod_name
+                           for mod_name, files in sub_modules.items()}
+                for future in concurrent.futures.as_completed(futures):
+                    seg_files[futures[future]] = future.result()
+            segments = [seg_files[mod_name] for mod_name in sub_modules]  # same order as serial build
+        else:
+            segments = [cls.get_segment(mod_name, files) for mod_name, files in sub_modules.items()]
+        # segments dir is shared by all working dirs, so only the older fingerprints of these modules are removed;
+        #  the segments of mtdata*.py plugins of other dirs are kept
+        seg_names = {mod_name.lstrip('.') for mod_name in sub_modules}
+        for seg_file in SEGMENTS_DIR.glob('*.idx'):
+            if seg_file not in segments and seg_file.name.rsplit('.', 2)[0] in seg_names:
+                log.debug(f'Removing outdated segment {seg_file.name}')
+                seg_file.unlink()
+        cls.merge(segments, path)
 
+    @classmethod
+    def merge(cls, segments: List[Path], path: Path):
+        """Merges index segments into a single index file; checks for duplicates and citations"""
+        writer = IndexWriter()
+        seen = set()
         counts = collections.defaultdict(int)
-        for e in self.entries.values():
-            counts[e.did.group] += 1
+        for seg_file in segments:
+            with EntryTable(seg_file) as table:
+                for row in range(len(table)):
+                    did = table.did_str(row)
+                    assert did not in seen, f"{did} is a duplicate"
+                    seen.add(did)
+                    group, name, version, langs, payload = table.raw_row(row)
+                    state = json.loads(payload)
+                    cite = state.get('cite')
+                    cls.check_cite(tuple(cite) if cite else None)
+                    writer.add_row(group, name, version, langs, payload, did_str=did, url=state.get('url'))
+                    counts[group] += 1
+        writer.write(path)
         items = list(sorted(counts.items(), key=lambda x: x[1], reverse=True))
-        items += [("Total", len(self))]
+        items += [("Total", len(writer))]
         counts = "\n".join([f"| {n} | {c:,}|" for n, c in items])
         log.info("Index status: %s", ' | '.join(counts.splitlines()))
 
@@ -117,14 +217,19 @@ class Index:
     def n_entries(self) -> int:
         return len(self.entries)
 
+    @staticmethod
+    def check_cite(cite):
+        if cite:
+            assert isinstance(cite, tuple), 'cite field expected to be a tuple of bib keys'
+            ref_db = ReferenceDb()
+            for bib_key in cite:
+                assert bib_key in ref_db, f'Bib key "{bib_key}" not found in refs.bib database'
+
     def add_entry(self, entry: Entry):
         assert isinstance(entry, Entry)
         key = entry.did
         assert key not in self.entries, f"{key} is a duplicate"
-        if entry.cite:
-            assert isinstance(entry.cite, tuple), 'cite field expected to be a tuple of bib keys'
-            for bib_key in entry.cite:
-                assert bib_key in self.ref_db, f'Bib key "{bib_key}" not found in refs.bib database'
+        self.check_cite(entry.cite)
         self.entries[key] = entry
 
     def __add__(self, e):
@@ -169,31 +274,68 @@ class Index:
 
 
 class ReferenceDb:
+    """
+    Bibtex references of datasets from refs.bib. Parsing and rendering refs.bib with pybtex is slow,
+    so the rendered bibtex strings (see get_bibtex()) are cached alongside the index, and refs.bib is parsed
+    with pybtex only when it changes, or when the parsed entries are accessed (see __getitem__()).
+    """
 
     _instance = None  # singleton instance
 
     def __new__(cls, file=REFS_FILE):
         if cls._instance is None:
-            cls._instance = super(ReferenceDb, cls).__new__(cls)
+            obj = super(ReferenceDb, cls).__new__(cls)
             assert file.exists(), f"{file} does not exist"
-            cls._instance.db = parse_bib_file(file, bib_format="bibtex")
-            log.debug(f"loaded {len(cls._instance)} references from {file}")
+            obj.file = file
+            obj.bibtex = cls.load_bibtex(file, cache_file=cached_index_file.with_suffix('.bib.json'))
+            obj._keys = {key.lower(): key for key in obj.bibtex}   # bibtex keys are case insensitive
+            obj._db = None
+            cls._instance = obj
+            log.debug(f"loaded {len(obj)} references from {file}")
         return cls._instance
 
+    @classmethod
+    def load_bibtex(cls, file: Path, cache_file: Path) -> Dict[str, str]:
+        """Loads key -> bibtex string map from cache_file; (re)creates it when file has changed"""
+        source = md5(file.read_bytes()).hexdigest()
+        if cache_file.exists():
+            try:
+                cache = json.loads(cache_file.read_text(encoding='utf-8'))
+                if cache.get('source') == source:
+                    return cache['bibtex']
+            except ValueError as e:
+                log.warning(f'Ignoring invalid cache {cache_file}: {e}')
+        from pybtex.database import parse_file as parse_bib_file
+        db = parse_bib_file(file, bib_format="bibtex")
+        bibtex = {key: entry.to_string(bib_format="bibtex") for key, entry in db.entries.items()}
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(cache_file.name + f'.tmp{os.getpid()}')
+        tmp_file.write_text(json.dumps(dict(source=source, bibtex=bibtex), ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_file, cache_file)
+        return bibtex
+
+    @property
+    def db(self):
+        """pybtex BibliographyData of the file; parsed on first access"""
+        if self._db is None:
+            from pybtex.database import parse_file as parse_bib_file
+            self._db = parse_bib_file(self.file, bib_format="bibtex")
+        return self._db
+
     def __getitem__(self, item):
         return self.db.entries[item]
 
     def __contains__(self, item):
-        return item in self.db.entries
+        return item.lower() in self._keys
 
     def __len__(self):
-        return len(self.db.entries)
+        return len(self.bibtex)
 
     def get_bibtex(self, key: str) -> str:
-        return self[key].to_string(bib_format="bibtex")
+        return self.bibtex[self._keys[key.lower()]]
 
     def keys(self):
-        return self.db.entries.keys()
+        return self.bibtex.keys()
 
 
 def is_compatible(lang1: Union[str, BCP47Tag], lang2: Union[str, BCP47Tag]):
@@ -216,7 +358,7 @@ def bitext_lang_match(pair1, pair2, fuzzy_match=False, strict=False) -> bool:
 
 
 def get_entries(langs=None, names=None, not_names=None, fuzzy_match=False, 
-                groups=None, not_groups=None, strict=False) -> List[Entry]:
+                groups=None, not_groups=None, strict=False, query=None, min_score=0.75) -> List[Entry]:
     """
     :param langs: language pairs  to select eg ('en', 'de')
     :param names:  names to select
@@ -224,33 +366,93 @@ def get_entries(langs=None, names=None, not_names=None, fuzzy_match=False,
     :param groups: groups to select
     :param not_groups: groups to exlcude
     :param fuzzy_match
+    :param query: free text to search in dataset ids and urls; tolerates typos and partial words.
+      When given, the results are ranked by relevance to the query
+    :param min_score: when query is given, drop the results that score below this fraction of the best score
     :return: list of dataset entries that match the criteria
     """
-    # TODO: our index has grown too big; improve search with fuzzy matches
-    select = list(INDEX.get_entries())
+    filters = dict(langs=langs, names=names, not_names=not_names, fuzzy_match=fuzzy_match,
+                   groups=groups, not_groups=not_groups, strict=strict)
+    if index_backend == 'sqlite':
+        from mtdata.index.sqldb import SqlIndex
+        db = SqlIndex.get_instance()
+        if not query:
+            return db.select(**filters)
+        return [db.entry(r) for r in rank_rows(db.ids(**filters), query, min_score=min_score)]
+    rows = select_rows(**filters)
+    if query:
+        rows = rank_rows(rows, query, min_score=min_score)
+    return [INDEX.entries.entry(r) for r in rows]
+
+
+def select_rows(langs=None, names=None, not_names=None, fuzzy_match=False,
+                groups=None, not_groups=None, strict=False) -> List[int]:
+    """Rows of INDEX.entries that match the filters; see get_entries()"""
+    table: EntryTable = INDEX.entries
+    # candidate rows are obtained from posting lists, so the cost is proportional to the result size
+    select: Optional[Set[int]] = None   # None => all rows
+
+    def _restrict(rows):
+        nonlocal select
+        select = set(rows) if select is None else select.intersection(rows)
+
     if groups:
-        groups = set(g.lower() for g in groups)
-        select = [e for e in select if e.did.group.lower() in groups]
-    if not_groups:
-        not_groups = set(g.lower() for g in not_groups)
-        select = [e for e in select if e.did.group.lower() not in not_groups]
+        _restrict(row for g in set(g.lower() for g in groups)
+                  for row in table.posting('group', table.string_id(g)))
     if names:
-        names = set(n.lower() for n in names)
-        select = [e for e in select if e.did.name in names]
+        _restrict(row for n in set(n.lower() for n in names)
+                  for row in table.posting('name', table.string_id(n)))
     if langs:
+        assert 1 <= len(langs) <= 2
+        # region and script variants are resolved as union of posting lists of all compatible tags
+        compat_tags = [table.compatible_tags(lang) for lang in langs]
         if len(langs) == 2:
-            select = [e for e in select if 2 == len(e.did.langs)\
-                and bitext_lang_match(langs, e.did.langs, fuzzy_match=fuzzy_match, strict=strict)]
-        else: # monolingual
-            assert len(langs) == 1
-            lang: BCP47Tag = langs[0]
-            select = [e for e in select if 1 == len(e.did.langs) and lang.is_compatible(e.did.langs[0])]
+            keys = set(pair_key(t1, t2) for t1 in compat_tags[0] for t2 in compat_tags[1])
+        else:  # monolingual
+            keys = set(pair_key(t1) for t1 in compat_tags[0])
+        _restrict(row for key in keys for row in table.posting('langs', key))
 
+    rows = range(len(table)) if select is None else sorted(select)
+    group_col, name_col = table.section('group'), table.section('name')
+    if not_groups:
+        not_groups = set(g.lower() for g in not_groups)
+        rows = [r for r in rows if table.string(group_col[r]).lower() not in not_groups]
+    if langs and len(langs) == 2:
+        # candidates are compatible on both sides; now check the order (strict) or exact match (not fuzzy)
+        rows = [r for r in rows if bitext_lang_match(langs, table.langs(r), fuzzy_match=fuzzy_match, strict=strict)]
     if not_names:
         if not isinstance(not_names, set):
             not_names = set(not_names)
-        select = [e for e in select if e.did.name not in not_names]
-    return select
+        rows = [r for r in rows if table.string(name_col[r]) not in not_names]
+    return list(rows)
+
+
+def rank_rows(rows: List[int], query: str, min_score=0.75) -> List[int]:
+    """Rows that match the query, sorted by relevance; see get_entries()"""
+    scores = INDEX.entries.search(query)
+    rows = [r for r in rows if r in scores]
+    cutoff = min_score * max((scores[r] for r in rows), default=0)
+    # sort is stable; ties stay in index order
+    return sorted((r for r in rows if scores[r] >= cutoff), key=lambda r: -scores[r])
+
+
+def count_entries(by: str, **filters) -> Dict[str, int]:
+    """Number of entries that match filters of get_entries(), grouped by langs, name, or group"""
+    assert by in ('langs', 'name', 'group'), f'Cannot count by {by}'
+    if index_backend == 'sqlite':
+        from mtdata.index.sqldb import SqlIndex
+        return SqlIndex.get_instance().count(by, **filters)
+    table: EntryTable = INDEX.entries
+    if by == 'langs':
+        key = lambda r: DID_DELIM.join(tag.tag for tag in table.langs(r))
+    else:
+        col = table.section(by)
+        key = lambda r: table.string(col[r])
+    counts = collections.defaultdict(int)
+    for row in select_rows(**filters):
+        counts[key(row)] += 1
+    return dict(counts)
 
 
-INDEX: Index = Index.get_instance()
+# loaded on first access
+INDEX: Index = LazyProxy(Index.get_instance)
@@ -7,7 +7,9 @@ from typing import List, Dict, Any
 
 import requests
 
-from mtdata import resource_dir, log, yaml
+from mtdata import resource_dir, log, yaml, Defaults
+from mtdata.sessions import get_session
+from mtdata.retry import RetryPolicy, raise_transient
 from mtdata.index import Index, DatasetId, Entry
 
 QUERY_URL = "https://huggingface.co/datasets-json"
@@ -127,7 +129,8 @@ def query_datasets(page_num=0):
         params["p"] = page_num
         url_with_parms = f"{QUERY_URL}?{requests.compat.urlencode(params)}"
         log.info(f"GET {url_with_parms}")
-        response = requests.get(url_with_parms)
+        response = RetryPolicy(retries=Defaults.HTTP_RETRIES).run(
+            url_with_parms, lambda: raise_transient(url_with_parms, get_session(url_with_parms).get(url_with_parms)))
         if response.status_code != 200:
             msg = ' '.join(response.text.splitlines())
             log.warning(f"Failed to fetch data: {response.status_code}; text: {msg}")
@@ -150,7 +153,8 @@ def enrich_metadata(meta):
     configs = meta.get("config", [])
     readme_url = README_URL.format(repo_id=meta["id"])
     log.info(f"GET {readme_url}")
-    readme_text = requests.get(readme_url).text
+    readme_text = RetryPolicy(retries=Defaults.HTTP_RETRIES).run(
+        readme_url, lambda: raise_transient(readme_url, get_session(readme_url).get(readme_url))).text
     yaml_config_text = ""
     parts = readme_text.split("---")
     if len(parts) < 3:
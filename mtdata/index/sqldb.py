@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# SQLite backend for the dataset index; enabled by MTDATA_INDEX_BACKEND=sqlite
+#  The database is derived from the index file (mtdata.index.<version>.idx) and is rebuilt when that changes.
+#  Entry ids are the same as row numbers of the index file.
+#  Filters of "mtdata list" and aggregations of "mtdata report" run as SQL queries on indexed columns.
+#  Connections are read-only, so many processes can query the catalog at the same time.
+#
+# Created: 10/18/26
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import portalocker
+
+from mtdata import log, cached_index_file, Defaults
+from mtdata.entry import Entry, DatasetId, DID_DELIM
+from mtdata.iso.bcp47 import BCP47Tag
+from mtdata.index.store import EntryTable, payload_entry
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE tags (tag TEXT PRIMARY KEY, lang TEXT NOT NULL, script TEXT, region TEXT);
+CREATE TABLE entries (
+    id INTEGER PRIMARY KEY,
+    did TEXT NOT NULL UNIQUE,
+    "group" TEXT NOT NULL,
+    group_lower TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    lang1 TEXT NOT NULL,
+    lang2 TEXT,
+    base1 TEXT NOT NULL,
+    base2 TEXT,
+    langs TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX entries_group ON entries (group_lower);
+CREATE INDEX entries_name ON entries (name);
+CREATE INDEX entries_version ON entries (version);
+CREATE INDEX entries_lang1 ON entries (base1, base2);
+CREATE INDEX entries_lang2 ON entries (base2, base1);
+"""
+
+# column names of report aggregations
+COUNT_COLUMNS = {'langs': 'langs', 'name': 'name', 'group': '"group"'}
+
+
+def qmarks(n: int) -> str:
+    return ', '.join('?' * n)
+
+
+class SqlIndex:
+    """Read only SQL view of the index"""
+
+    obj = None  # singleton object
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.con = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        self._tags: Dict[str, BCP47Tag] = {}
+
+    @staticmethod
+    def source_stamp(index_file: Path) -> str:
+        """Identifies the version of the index file that the database is derived from"""
+        stat = index_file.stat()
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+    @classmethod
+    def is_valid(cls, path: Path, stamp: str) -> bool:
+        """Checks that database exists and is derived from the index file with stamp"""
+        if not path.exists():
+            return False
+        con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            row = con.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            con.close()
+        return bool(row) and row[0] == stamp
+
+    @classmethod
+    def get_instance(cls) -> 'SqlIndex':
+        if not cls.obj:
+            from mtdata.index import Index
+            Index.get_instance()   # creates the index file if missing
+            path = cached_index_file.with_suffix('.sqlite')
+            stamp = cls.source_stamp(cached_index_file)
+            if not cls.is_valid(path, stamp):
+                with portalocker.Lock(path.with_suffix('._lock'), 'w', timeout=Defaults.FILE_LOCK_TIMEOUT):
+                    # check again, parallel processes may have created it while we waited
+                    if not cls.is_valid(path, stamp):
+                        with EntryTable(cached_index_file) as table:
+                            cls.create(table, path, stamp=stamp)
+            cls.obj = cls(path)
+        return cls.obj
+
+    @classmethod
+    def create(cls, table: EntryTable, path: Path, stamp: str = ''):
+        """Creates database at path from the index table"""
+        log.info(f'Creating SQLite index at {path}')
+        tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+        if tmp_path.exists():
+            tmp_path.unlink()
+        con = sqlite3.connect(tmp_path)
+        try:
+            con.executescript(SCHEMA)
+            tags = set()
+            rows = []
+            for row in range(len(table)):
+                group, name, version, _, payload = table.raw_row(row)
+                langs = table.langs(row)
+                tags.update(langs)
+                tag2 = langs[1] if len(langs) > 1 else None
+                rows.append((row, table.did_str(row), group, group.lower(), name, version,
+                             langs[0].tag, tag2 and tag2.tag, langs[0].lang, tag2 and tag2.lang,
+                             DID_DELIM.join(tag.tag for tag in langs), payload.decode('utf-8')))
+            con.executemany(f'INSERT INTO entries VALUES ({qmarks(12)})', rows)
+            con.executemany(f'INSERT INTO tags VALUES ({qmarks(4)})',
+                            [(tag.tag, tag.lang, tag.script, tag.region) for tag in tags])
+            con.execute("INSERT INTO meta VALUES ('source', ?)", (stamp,))
+            con.commit()
+        finally:
+            con.close()
+        os.replace(tmp_path, path)
+
+    def get_tag(self, tag: str) -> BCP47Tag:
+        val = self._tags.get(tag)
+        if val is None:
+            lang, script, region = self.con.execute(
+                'SELECT lang, script, region FROM tags WHERE tag = ?', (tag,)).fetchone()
+            val = self._tags[tag] = BCP47Tag(lang=lang, script=script, region=region)
+        return val
+
+    def lang_pairs(self, langs: Sequence[BCP47Tag], fuzzy_match=False, strict=False) -> List[Tuple[str, ...]]:
+        """Language tags (pairs) in the index that match langs; same semantics as get_entries()"""
+        from mtdata.index import bitext_lang_match
+        if len(langs) == 2:
+            x, y = langs
+            sql = 'SELECT DISTINCT lang1, lang2 FROM entries WHERE base1 = ? AND base2 = ?'
+            candidates = self.con.execute(sql, (x.lang, y.lang)).fetchall()
+            if not strict and x.lang != y.lang:
+                candidates += self.con.execute(sql, (y.lang, x.lang)).fetchall()
+            return [pair for pair in candidates if bitext_lang_match(
+                langs, tuple(self.get_tag(t) for t in pair), fuzzy_match=fuzzy_match, strict=strict)]
+        else:  # monolingual
+            assert len(langs) == 1
+            candidates = self.con.execute(
+                'SELECT DISTINCT lang1 FROM entries WHERE base1 = ? AND base2 IS NULL', (langs[0].lang,)).fetchall()
+            return [tag for tag in candidates if langs[0].is_compatible(self.get_tag(tag[0]))]
+
+    def where(self, langs=None, names=None, not_names=None, fuzzy_match=False,
+              groups=None, not_groups=None, strict=False) -> Tuple[str, list]:
+        """SQL where clause and its params for the filters of get_entries()"""
+        clauses, params = [], []
+        if groups:
+            groups = set(g.lower() for g in groups)
+            clauses.append(f'group_lower IN ({qmarks(len(groups))})')
+            params += groups
+        if not_groups:
+            not_groups = set(g.lower() for g in not_groups)
+            clauses.append(f'group_lower NOT IN ({qmarks(len(not_groups))})')
+            params += not_groups
+        if names:
+            names = set(n.lower() for n in names)
+            clauses.append(f'name IN ({qmarks(len(names))})')
+            params += names
+        if not_names:
+            not_names = set(not_names)
+            clauses.append(f'name NOT IN ({qmarks(len(not_names))})')
+            params += not_names
+        if langs:
+            pairs = self.lang_pairs(langs, fuzzy_match=fuzzy_match, strict=strict)
+            if not pairs:
+                clauses.append('0')
+            elif len(langs) == 2:
+                clauses.append(f'(lang1, lang2) IN (VALUES {", ".join(["(?, ?)"] * len(pairs))})')
+                params += [tag for pair in pairs for tag in pair]
+            else:
+                clauses.append(f'lang2 IS NULL AND lang1 IN ({qmarks(len(pairs))})')
+                params += [tag for tag, in pairs]
+        return ' AND '.join(clauses) or '1', params
+
+    ENTRY_COLUMNS = '"group", name, version, lang1, lang2, payload'
+
+    def make_entry(self, group, name, version, lang1, lang2, payload) -> Entry:
+        langs = (self.get_tag(lang1),) if lang2 is None else (self.get_tag(lang1), self.get_tag(lang2))
+        return payload_entry(DatasetId(group=group, name=name, version=version, langs=langs), payload)
+
+    def select(self, **filters) -> List[Entry]:
+        """Entries that match the filters; see where()"""
+        where, params = self.where(**filters)
+        sql = f'SELECT {self.ENTRY_COLUMNS} FROM entries WHERE {where} ORDER BY id'
+        return [self.make_entry(*row) for row in self.con.execute(sql, params)]
+
+    def ids(self, **filters) -> List[int]:
+        """Ids of entries that match the filters; see where()"""
+        where, params = self.where(**filters)
+        return [row for row, in self.con.execute(f'SELECT id FROM entries WHERE {where} ORDER BY id', params)]
+
+    def entry(self, id: int) -> Entry:
+        row = self.con.execute(f'SELECT {self.ENTRY_COLUMNS} FROM entries WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return self.make_entry(*row)
+
+    def count(self, column: str, **filters) -> Dict[str, int]:
+        """Number of entries that match filters, grouped by column (langs, name or group)"""
+        col = COUNT_COLUMNS[column]
+        where, params = self.where(**filters)
+        sql = f'SELECT {col}, COUNT(*) FROM entries WHERE {where} GROUP BY {col} ORDER BY MIN(id)'
+        return dict(self.con.execute(sql, params).fetchall())
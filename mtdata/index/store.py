@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+#
+# Compact, memory-mapped on-disk format for the dataset index.
+#  Strings (group, name, version, language subtags) are interned into a string table;
+#  per-entry fields are stored as fixed width columns, and the remaining Entry fields
+#  (url, in_paths, cite, meta, ...) are stored as a JSON blob per row, along with the names of tuple fields
+#  and the class of entry, when it is a subclass of Entry (e.g. NoisyEntry).
+#  Entry objects are built lazily, only for the rows that are accessed.
+#
+# Layout:  MAGIC | uint32 header length | JSON header | sections (8-byte aligned)
+#
+# Inverted indices (aka posting lists) are stored in CSR form as three sections:
+#   <name>.keys (sorted int64), <name>.offsets (int64, len(keys)+1), <name>.ids (int32)
+#   group: lowercase group string id -> row ids
+#   name: name string id -> row ids
+#   lang: base language string id -> tag ids  (e.g. eng -> [eng, eng_US, eng_GB, ...])
+#   langs: unordered pair of tag ids -> row ids; see pair_key()
+#   token: token (string id) of dataset id or url -> row ids
+#   trigram: trigram of token -> token string ids; see trigrams()
+#
+# Created: 10/18/26
+
+import importlib
+import json
+import mmap
+from bisect import bisect_left
+from functools import lru_cache
+from collections import defaultdict
+import os
+import re
+import struct
+import sys
+from array import array
+from collections.abc import Mapping, ValuesView
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple, Type, Union
+
+from mtdata import log, __version__
+from mtdata.entry import Entry, DatasetId, DID_DELIM
+from mtdata.iso.bcp47 import BCP47Tag
+
+MAGIC = b'MTDIDX03'
+NONE = -1  # null value in int columns
+ALIGN = 8
+
+# Entry fields that go into JSON payload; did is stored in columns, is_archive is derived
+PAYLOAD_FIELDS = ('url', 'filename', 'ext', 'in_paths', 'in_ext', 'cite', 'cols', 'meta')
+TUPLES_KEY = '_tuples'  # payload fields that are tuples, as json has no tuples
+CLASS_KEY = '_class'    # module:qualname of entry class; absent for Entry
+
+TagParts = Tuple[str, Optional[str], Optional[str]]   # (lang, script, region)
+
+
+POSTINGS = ('group', 'name', 'lang', 'langs', 'token')
+TOKEN_DELIM = re.compile(r'[\W_]+')
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+def pair_key(tag1: int, tag2: int = NONE) -> int:
+    """Key for unordered pair of tag ids; tag2 is NONE for monolingual"""
+    if tag2 != NONE and tag2 < tag1:
+        tag1, tag2 = tag2, tag1
+    return (tag1 << 32) | (tag2 & 0xFFFFFFFF)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric tokens of text; e.g. Statmt-news_commentary-16 -> [statmt, news, commentary, 16]"""
+    return [tok for tok in TOKEN_DELIM.split(text.lower()) if tok]
+
+
+def trigrams(token: str) -> Set[int]:
+    """Trigrams of token padded on both sides, each packed into an int (21 bits per char).
+    Left side is padded twice, so that prefixes share more trigrams than suffixes"""
+    padded = f'  {token} '
+    return {(ord(a) << 42) | (ord(b) << 21) | ord(c) for a, b, c in zip(padded, padded[1:], padded[2:])}
+
+
+def entry_payload(entry: Entry) -> bytes:
+    state = {}
+    for field in PAYLOAD_FIELDS:
+        val = getattr(entry, field)
+        if val:
+            state[field] = val
+    tuples = [field for field, val in state.items() if isinstance(val, tuple)]
+    if tuples:
+        state[TUPLES_KEY] = tuples
+    if type(entry) is not Entry:
+        state[CLASS_KEY] = f'{type(entry).__module__}:{type(entry).__qualname__}'
+    return json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+@lru_cache(maxsize=None)
+def entry_class(name: Optional[str]) -> Type[Entry]:
+    """Gets entry class from its name (module:qualname); Entry if name is None, or if the class can not be imported"""
+    if not name:
+        return Entry
+    mod_name, qualname = name.split(':', maxsplit=1)
+    try:
+        cls = importlib.import_module(mod_name)
+        for attr in qualname.split('.'):
+            cls = getattr(cls, attr)
+    except (ImportError, AttributeError) as e:
+        log.warning(f'Unable to load entry class {name}: {e}; using {Entry.__name__} in its place')
+        return Entry
+    return cls
+
+
+def payload_entry(did: DatasetId, payload: Union[bytes, str]) -> Entry:
+    """Inverse of entry_payload()"""
+    state = json.loads(payload)
+    cls = entry_class(state.pop(CLASS_KEY, None))
+    for field in state.pop(TUPLES_KEY, ()):
+        state[field] = tuple(state[field])
+    return cls(did=did, **state)
+
+
+class IndexWriter:
+    """Accumulates index rows in columns and writes them to a file"""
+
+    def __init__(self):
+        self.strings: Dict[str, int] = {}
+        self.tags: Dict[TagParts, int] = {}
+        self.tag_cols = array('i')
+        self.group = array('i')
+        self.name = array('i')
+        self.version = array('i')
+        self.lang1 = array('i')
+        self.lang2 = array('i')
+        self.payload_offsets = array('q', [0])
+        self.payloads: List[bytes] = []
+        self.ids: List[str] = []
+        self.postings: Dict[str, Dict[int, List[int]]] = {name: defaultdict(list) for name in POSTINGS}
+
+    def __len__(self):
+        return len(self.group)
+
+    def intern(self, string: Optional[str]) -> int:
+        if string is None:
+            return NONE
+        idx = self.strings.get(string)
+        if idx is None:
+            idx = self.strings[string] = len(self.strings)
+        return idx
+
+    def intern_tag(self, tag: Optional[TagParts]) -> int:
+        if tag is None:
+            return NONE
+        idx = self.tags.get(tag)
+        if idx is None:
+            idx = self.tags[tag] = len(self.tags)
+            self.tag_cols.extend(self.intern(part) for part in tag)
+            self.postings['lang'][self.intern(tag[0])].append(idx)
+        return idx
+
+    def add_entry(self, entry: Entry):
+        did = entry.did
+        langs = [(lang.lang, lang.script, lang.region) for lang in did.langs]
+        self.add_row(did.group, did.name, did.version, langs, entry_payload(entry), did_str=str(did),
+                     url=entry.url)
+
+    def add_row(self, group: str, name: str, version: str, langs: List[TagParts], payload: bytes,
+                did_str: str, url: Union[None, str, Sequence[str]] = None):
+        assert 1 <= len(langs) <= 2, f'Expected one or two languages, but given {langs}'
+        row = len(self)
+        self.group.append(self.intern(group))
+        self.name.append(self.intern(name))
+        self.version.append(self.intern(version))
+        self.lang1.append(self.intern_tag(langs[0]))
+        self.lang2.append(self.intern_tag(langs[1] if len(langs) > 1 else None))
+        self.postings['group'][self.intern(group.lower())].append(row)
+        self.postings['name'][self.name[row]].append(row)
+        self.postings['langs'][pair_key(self.lang1[row], self.lang2[row])].append(row)
+        urls = [url] if isinstance(url, str) else (url or [])
+        for token in set(tokenize(' '.join([did_str, *urls]))):
+            self.postings['token'][self.intern(token)].append(row)
+        self.payloads.append(payload)
+        self.payload_offsets.append(self.payload_offsets[-1] + len(payload))
+        self.ids.append(did_str)
+
+    @staticmethod
+    def posting_sections(name, posting: Dict[int, List[int]]) -> Dict[str, Tuple[str, bytes]]:
+        keys = array('q', sorted(posting))
+        offsets = array('q', [0])
+        ids = array('i')
+        for key in keys:
+            ids.extend(posting[key])
+            offsets.append(len(ids))
+        return {f'{name}.keys': ('q', keys.tobytes()),
+                f'{name}.offsets': ('q', offsets.tobytes()),
+                f'{name}.ids': ('i', ids.tobytes())}
+
+    def sections(self) -> Dict[str, Tuple[str, bytes]]:
+        strings = list(self.strings)   # dict preserves insertion order == ids
+        str_data = [s.encode('utf-8') for s in strings]
+        str_offsets = array('q', [0])
+        for s in str_data:
+            str_offsets.append(str_offsets[-1] + len(s))
+        sorted_strs = array('i', sorted(range(len(strings)), key=strings.__getitem__))
+        sorted_rows = array('i', sorted(range(len(self.ids)), key=self.ids.__getitem__))
+        postings = {}
+        for name, posting in self.postings.items():
+            postings.update(self.posting_sections(name, posting))
+        grams = defaultdict(list)
+        for tok_id in sorted(self.postings['token']):
+            for gram in trigrams(strings[tok_id]):
+                grams[gram].append(tok_id)
+        postings.update(self.posting_sections('trigram', grams))
+        return dict(
+            str_offsets=('q', str_offsets.tobytes()),
+            str_data=('B', b''.join(str_data)),
+            sorted_strs=('i', sorted_strs.tobytes()),
+            tags=('i', self.tag_cols.tobytes()),
+            group=('i', self.group.tobytes()),
+            name=('i', self.name.tobytes()),
+            version=('i', self.version.tobytes()),
+            lang1=('i', self.lang1.tobytes()),
+            lang2=('i', self.lang2.tobytes()),
+            payload_offsets=('q', self.payload_offsets.tobytes()),
+            payload_data=('B', b''.join(self.payloads)),
+            sorted_rows=('i', sorted_rows.tobytes()),
+            **postings,
+        )
+
+    def write(self, path: Path):
+        """Writes to a temporary file and then moves it to path, so readers never see a partial file"""
+        sections = self.sections()
+        layout = {}
+        offset = 0   # relative to the start of data i.e., the aligned end of header
+        for name, (typecode, data) in sections.items():
+            layout[name] = [offset, len(data), typecode]
+            offset += len(data) + (-len(data) % ALIGN)
+        header = dict(version=__version__, byteorder=sys.byteorder, n_entries=len(self),
+                      n_strings=len(self.strings), n_tags=len(self.tags), sections=layout)
+        header = json.dumps(header).encode('utf-8')
+        tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+        with open(tmp_path, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<I', len(header)))
+            out.write(header)
+            out.write(b'\0' * (-out.tell() % ALIGN))
+            for typecode, data in sections.values():
+                out.write(data)
+                out.write(b'\0' * (-len(data) % ALIGN))
+        os.replace(tmp_path, path)
+        log.debug(f'Wrote {len(self):,} entries to {path}')
+
+
+class _EntryValues(ValuesView):
+
+    def __iter__(self):
+        return self._mapping.iter_entries()
+
+
+class EntryTable(Mapping):
+    """Read only mapping of DatasetId -> Entry, backed by a memory mapped index file"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = buf = memoryview(self._mm)
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise IndexFormatError(f'{path} is not a valid index file. Please move or remove it')
+        header_len, = struct.unpack('<I', buf[len(MAGIC):len(MAGIC) + 4])
+        header_end = len(MAGIC) + 4 + header_len
+        self.header = json.loads(bytes(buf[len(MAGIC) + 4:header_end]))
+        if self.header['byteorder'] != sys.byteorder:
+            raise IndexFormatError(f'{path} was created on a {self.header["byteorder"]}-endian machine;'
+                                   f' please move or remove it')
+        data_start = header_end + (-header_end % ALIGN)
+        self._sections = {}
+        for name, (offset, length, typecode) in self.header['sections'].items():
+            view = buf[data_start + offset: data_start + offset + length]
+            self._sections[name] = view if typecode == 'B' else view.cast(typecode)
+        self.n_entries = self.header['n_entries']
+        self._str_offsets = self._sections['str_offsets']
+        self._str_data = self._sections['str_data']
+        self._str_cache: Dict[int, str] = {}
+        self._tag_cache: Dict[int, BCP47Tag] = {}
+
+    def close(self):
+        for view in self._sections.values():
+            view.release()
+        self._sections.clear()
+        self._buf.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def section(self, name) -> memoryview:
+        return self._sections[name]
+
+    def string(self, idx: int) -> Optional[str]:
+        if idx == NONE:
+            return None
+        val = self._str_cache.get(idx)
+        if val is None:
+            val = str(self._str_data[self._str_offsets[idx]:self._str_offsets[idx + 1]], 'utf-8')
+            self._str_cache[idx] = val
+        return val
+
+    def string_id(self, string: str) -> int:
+        """Binary search for string in string table; returns its id or NONE if not found"""
+        sorted_strs = self._sections['sorted_strs']
+        lo, hi = 0, len(sorted_strs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_val = self.string(sorted_strs[mid])
+            if mid_val < string:
+                lo = mid + 1
+            elif mid_val > string:
+                hi = mid
+            else:
+                return sorted_strs[mid]
+        return NONE
+
+    def posting(self, name: str, key: int) -> memoryview:
+        """Get ids from the posting list of name; empty when key is not found"""
+        keys = self._sections[f'{name}.keys']
+        ids = self._sections[f'{name}.ids']
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            offsets = self._sections[f'{name}.offsets']
+            return ids[offsets[i]:offsets[i + 1]]
+        return ids[0:0]
+
+    def match_tokens(self, token: str, min_sim: float) -> Dict[int, float]:
+        """Tokens in the index that are similar to token; tolerates typos and matches prefixes.
+        Similarity is the fraction of trigrams of token found in the candidate, scaled down
+        by up to a quarter for the candidate's trigrams that are not in token.
+        :return: token string id -> similarity in [min_sim, 1]
+        """
+        query_grams = trigrams(token)
+        overlaps = defaultdict(int)
+        for gram in query_grams:
+            for tok_id in self.posting('trigram', gram):
+                overlaps[tok_id] += 1
+        result = {}
+        for tok_id, overlap in overlaps.items():
+            recall = overlap / len(query_grams)
+            if recall < min_sim:
+                continue
+            sim = recall * (0.75 + 0.25 * overlap / len(trigrams(self.string(tok_id))))
+            if sim >= min_sim:
+                result[tok_id] = sim
+        return result
+
+    def search(self, query: str, min_sim: float = 0.6) -> Dict[int, float]:
+        """Finds rows whose dataset id or url have tokens similar to tokens of query.
+        :return: row -> score; score is the sum of best similarity of each query token
+        """
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            best: Dict[int, float] = {}
+            for tok_id, sim in self.match_tokens(token, min_sim=min_sim).items():
+                for row in self.posting('token', tok_id):
+                    if best.get(row, 0) < sim:
+                        best[row] = sim
+            for row, sim in best.items():
+                scores[row] += sim
+        return scores
+
+    def compatible_tags(self, tag: BCP47Tag) -> List[int]:
+        """Ids of tags that are compatible with tag; e.g. eng -> [eng, eng_US, eng_GB, ...]"""
+        candidates = self.posting('lang', self.string_id(tag.lang))
+        return [idx for idx in candidates if tag.is_compatible(self.tag(idx))]
+
+    def tag_parts(self, tag_idx: int) -> TagParts:
+        tags = self._sections['tags']
+        return tuple(self.string(tags[3 * tag_idx + i]) for i in range(3))
+
+    def tag(self, tag_idx: int) -> BCP47Tag:
+        val = self._tag_cache.get(tag_idx)
+        if val is None:
+            lang, script, region = self.tag_parts(tag_idx)
+            val = self._tag_cache[tag_idx] = BCP47Tag(lang=lang, script=script, region=region)
+        return val
+
+    def langs(self, row: int) -> Tuple[BCP47Tag, ...]:
+        lang1, lang2 = self._sections['lang1'][row], self._sections['lang2'][row]
+        if lang2 == NONE:
+            return (self.tag(lang1),)
+        return self.tag(lang1), self.tag(lang2)
+
+    def did(self, row: int) -> DatasetId:
+        return DatasetId(group=self.string(self._sections['group'][row]),
+                         name=self.string(self._sections['name'][row]),
+                         version=self.string(self._sections['version'][row]),
+                         langs=self.langs(row))
+
+    def did_str(self, row: int) -> str:
+        """Same as str(self.did(row)), but without creating DatasetId"""
+        lang1, lang2 = self._sections['lang1'][row], self._sections['lang2'][row]
+        parts = [self.string(self._sections['group'][row]), self.string(self._sections['name'][row]),
+                 self.string(self._sections['version'][row]), self.tag(lang1).tag]
+        if lang2 != NONE:
+            parts.append(self.tag(lang2).tag)
+        return DID_DELIM.join(parts)
+
+    def raw_row(self, row: int) -> Tuple[str, str, str, List[TagParts], bytes]:
+        """(group, name, version, langs, payload) of a row; the same args as IndexWriter.add_row"""
+        langs = [self.tag_parts(self._sections['lang1'][row])]
+        if self._sections['lang2'][row] != NONE:
+            langs.append(self.tag_parts(self._sections['lang2'][row]))
+        return (self.string(self._sections['group'][row]), self.string(self._sections['name'][row]),
+                self.string(self._sections['version'][row]), langs, self.payload(row))
+
+    def payload(self, row: int) -> bytes:
+        offsets = self._sections['payload_offsets']
+        return bytes(self._sections['payload_data'][offsets[row]:offsets[row + 1]])
+
+    def entry(self, row: int) -> Entry:
+        return payload_entry(self.did(row), self.payload(row))
+
+    def find(self, did: DatasetId) -> int:
+        """Binary search for did; returns row number or NONE if not found"""
+        key = str(did)
+        sorted_rows = self._sections['sorted_rows']
+        lo, hi = 0, len(sorted_rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self.did_str(sorted_rows[mid])
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return sorted_rows[mid]
+        return NONE
+
+    def iter_entries(self) -> Iterator[Entry]:
+        for row in range(self.n_entries):
+            yield self.entry(row)
+
+    def __getitem__(self, did: DatasetId) -> Entry:
+        row = self.find(did)
+        if row == NONE:
+            raise KeyError(did)
+        return self.entry(row)
+
+    def __contains__(self, did) -> bool:
+        return isinstance(did, DatasetId) and self.find(did) != NONE
+
+    def __iter__(self) -> Iterator[DatasetId]:
+        for row in range(self.n_entries):
+            yield self.did(row)
+
+    def __len__(self):
+        return self.n_entries
+
+    def values(self):
+        return _EntryValues(self)
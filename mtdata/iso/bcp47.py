@@ -12,10 +12,11 @@
 import json
 import sys
 from collections import namedtuple
+from itertools import count
 from pathlib import Path
-from typing import Optional, Union, Tuple
-from functools import lru_cache
+from typing import Optional, Union, Tuple, Dict, Iterable, List
 from mtdata.iso import iso3_code
+from mtdata.iso.lookup import get_tables
 
 MULTI_LANG = 'mul'      # multilang; compatible with any lang
 
@@ -32,6 +33,22 @@ def load_json(path: Path):
         return json.load(fp)
 
 
+# Compatibility checks are repeated in hot loops (index search, TMX parsing, dataset preparation);
+# so they are memoized in tables keyed by interned ids of tags.
+_TAG_IDS: Dict['BCP47Tag', int] = {}
+_TAG_ID_SEQ = count()  # next() on it is atomic, unlike len(_TAG_IDS)
+_COMPAT: Dict[Tuple[int, int], bool] = {}
+_COMPAT_SWAP: Dict[Tuple[int, int, int, int], Tuple[bool, bool]] = {}
+
+
+def tag_id(tag: 'BCP47Tag') -> int:
+    """Interned id of tag; equal tags get the same id"""
+    idx = _TAG_IDS.get(tag)
+    if idx is None:
+        idx = _TAG_IDS.setdefault(tag, next(_TAG_ID_SEQ))
+    return idx
+
+
 class BCP47Tag(namedtuple('BCP47Tag', ('lang', 'script', 'region', 'tag'))):
     __slots__ = ()
     joiner = '_'  # per BCP47, we must use '-' hyphen not underscore, but we use '-' to separate languages e.g. eng-deu
@@ -54,9 +71,15 @@ class BCP47Tag(namedtuple('BCP47Tag', ('lang', 'script', 'region', 'tag'))):
         return self.tag > other.tag
 
     def is_compatible(self, lang2: Union[str, 'BCP47Tag']):
-
         if isinstance(lang2, str):
             lang2 = bcp47(lang2)
+        key = (tag_id(self), tag_id(lang2))
+        val = _COMPAT.get(key)
+        if val is None:
+            val = _COMPAT[key] = self._is_compatible(lang2)
+        return val
+
+    def _is_compatible(self, lang2: 'BCP47Tag'):
         # exact same tag => true
         if self.tag == lang2.tag:
             return True
@@ -79,6 +102,17 @@ class BCP47Tag(namedtuple('BCP47Tag', ('lang', 'script', 'region', 'tag'))):
     @classmethod
     def check_compat_swap(cls, pair1: Tuple['BCP47Tag', 'BCP47Tag'], pair2:  Tuple['BCP47Tag', 'BCP47Tag'],
                           fail_on_incompat=False) -> Tuple[bool, bool]:
+        key = tuple(tag_id(tag) for tag in (*pair1, *pair2))
+        result = _COMPAT_SWAP.get(key)
+        if result is None:
+            result = _COMPAT_SWAP[key] = cls._check_compat_swap(pair1, pair2)
+        if not result[0] and fail_on_incompat:
+            raise Exception(f'Unable to match langs : {pair1} x {pair2}')
+        return result
+
+    @classmethod
+    def _check_compat_swap(cls, pair1: Tuple['BCP47Tag', 'BCP47Tag'], pair2:  Tuple['BCP47Tag', 'BCP47Tag']
+                           ) -> Tuple[bool, bool]:
         a, b = pair1
         aa, bb = pair2
         # we cant support multiling on both sides
@@ -105,27 +139,33 @@ class BCP47Tag(namedtuple('BCP47Tag', ('lang', 'script', 'region', 'tag'))):
             elif b.is_compatible(aa):
                 compat = True,
                 swap = True
-        if not compat and fail_on_incompat:
-            raise Exception(f'Unable to match langs : {pair1} x {pair2}')
         # else False, False
         return compat, swap
 
 
 class BCP47Parser:
 
-    def __init__(self, data, script_handle=DEF_SCRIPT_HANDLE):
+    def __init__(self, data=None, script_handle=DEF_SCRIPT_HANDLE):
         """_summary_
 
         Args:
-            data: bcp47.json
+            data: bcp47.json; Defaults to the precompiled lookup tables (see mtdata.iso.lookup), which are much faster to load
             script_handle: How to handle scripts. Defaults to 'supress_default'.
                 * supress_default -- supress default script and retain non defaults
                 * supress_all -- supress all scripts
                 * express -- retain script (if exists) or fill in the default script (if known)
         """
-        self.data = data
         assert script_handle in SCRIPT_HANDLES
         self.script_handle = script_handle
+        self._cache: Dict[str, BCP47Tag] = {}   # unbounded; there are only so many tags in the world
+        if data is None:
+            tables = get_tables()
+            self.scripts = tables['scripts']
+            self.countries = tables['countries']
+            self.languages = tables['languages']
+            self.default_scripts = tables['default_scripts']
+            return
+        self.data = data
         assert all(key in data for key in ['languages', 'scripts', 'countries']), 'malformed bcp4.json data'
         self.scripts = {code: name for code, name in data['scripts']}
         self.countries = {code: name for code, name in data['countries']}
@@ -138,7 +178,6 @@ class BCP47Parser:
             assert script_code in self.scripts
             self.default_scripts[code3] = script_code
 
-    @lru_cache(maxsize=10000)
     def parse(self, tag) -> BCP47Tag:
         """
         Parameters
@@ -149,6 +188,12 @@ class BCP47Parser:
         -------
             BCP47Tag
         """
+        val = self._cache.get(tag)
+        if val is None:
+            val = self._cache[tag] = self._parse(tag)
+        return val
+
+    def _parse(self, tag) -> BCP47Tag:
         code_orig = tag
         tag = tag.replace('_', '-').strip()
         assert tag
@@ -193,6 +238,26 @@ class BCP47Parser:
 
         return BCP47Tag(lang=lang, script=script, region=region)
 
+    def parse_many(self, tags: Iterable[Union[str, BCP47Tag]]) -> List[BCP47Tag]:
+        """
+        Parses many tags at once; each distinct tag is parsed only once
+        Parameters
+        ----------
+        tags : tags to be parsed; may include already parsed BCP47Tag objects
+
+        Returns
+        -------
+            list of BCP47Tag, in the same order as tags
+        """
+        cache = self._cache
+        result = []
+        for tag in tags:
+            val = tag if isinstance(tag, BCP47Tag) else cache.get(tag)
+            if val is None:
+                val = cache[tag] = self._parse(tag)
+            result.append(val)
+        return result
+
     def try_parse(self, tag, default=None):
         """
         Tries to parse a language tag; upon failure, returns the default value
@@ -224,9 +289,8 @@ class BCP47Parser:
 
 
 data_file = Path(__file__).parent / "bcp47.json"
-bcp47_data = load_json(data_file)
-bcp47 = BCP47Parser(data=bcp47_data)
-bcp47e = BCP47Parser(data=bcp47_data, script_handle=SH_EXPRESS)
+bcp47 = BCP47Parser()
+bcp47e = BCP47Parser(script_handle=SH_EXPRESS)
 
 
 def main():
@@ -244,7 +308,7 @@ def main():
     p.add_argument('-p', "--pipe", action='store_true', help="Pipe mode. Read stdin, map code, and write to stdout.")
 
     args = vars(p.parse_args())
-    bcp47 = BCP47Parser(data=bcp47_data, script_handle=args['script_handle'].lower())
+    bcp47 = BCP47Parser(script_handle=args['script_handle'].lower())
     if args['pipe']:
         for line in sys.stdin:
             tag = bcp47(line.strip())
@@ -3,10 +3,6 @@
 #
 # Author: Thamme Gowda
 # Created: 10/12/21
-from mtdata.iso.iso639_3 import CODES as iso3_codes, name_to_code
-from mtdata.iso.iso639_2 import CODE2_TO_3, code2_to_code3_name
-from mtdata.iso.iso639_1 import ISO693_1_to_3 as code1_to_3
-from mtdata.iso.custom import CUSTOM_TO_3 as custom_to_3
 
 
 def iso3_code(lang: str, fail_error=False, default=None) -> str:
@@ -20,20 +16,12 @@ def iso3_code(lang: str, fail_error=False, default=None) -> str:
     lang = lang.lower()
     part1 = lang.split('-')[0]     # BCP47
     lookups = (lang, part1) if lang != part1 else (lang,)
+    from mtdata.iso.lookup import get_tables
+    iso3 = get_tables()['iso3']   # precompiled from ISO 639-3, 639-2, 639-1 and custom codes and names
     for lang in lookups:
-        if lang in iso3_codes:
-            return lang
-        if lang in CODE2_TO_3:
-            _, name = code2_to_code3_name(lang)
-            iso3_code = name_to_code(name)
-            if iso3_code:
-                return iso3_code
-        if lang in code1_to_3:
-            return code1_to_3[lang]
-        if name_to_code(lang, None):
-            return name_to_code(lang)
-        if lang in custom_to_3:  # at last
-            return custom_to_3[lang]
+        code = iso3.get(lang)
+        if code:
+            return code
 
     if fail_error:
         raise Exception(f"Unable to find ISO 639-3 code for '{lang}'. "
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Precompiled lookup tables of ISO 639 and BCP47 codes.
+#  Parsing iso639_*.py and bcp47.json at import time is slow, so they are compiled into lookup.bin,
+#  which is memory mapped and binary searched on demand. After updating any of the SOURCES, rebuild it:
+#       python -m mtdata.iso.lookup
+#
+# Layout: MAGIC | uint32 header length | JSON header | tables (4-byte aligned)
+#   Each table has n records sorted by key: (n+1) uint32 offsets | blob of b'key\0value' records
+#   iso3: lowercase language code or name -> ISO 639-3 code; see iso3_code()
+#   languages: ISO 639-3 code -> ISO 639-1 code (may be empty)
+#   scripts: ISO 15924 code -> name
+#   countries: ISO 3166 code -> name
+#   default_scripts: ISO 639-3 code -> ISO 15924 code of the default (i.e. suppressed) script
+#
+# Created: 10/18/26
+
+import json
+import mmap
+from array import array
+import struct
+import sys
+from collections.abc import Mapping
+from hashlib import md5
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+MAGIC = b'MTDISO01'
+ALIGN = 4
+TABLES = ('iso3', 'languages', 'scripts', 'countries', 'default_scripts')
+iso_dir = Path(__file__).parent
+lookup_file = iso_dir / 'lookup.bin'
+SOURCES = [iso_dir / name for name in ('iso639_1.py', 'iso639_2.py', 'iso639_3.py', 'custom.py', 'bcp47.json')]
+
+
+class Table(Mapping):
+    """Read only str -> str mapping over sorted records of a buffer"""
+
+    def __init__(self, buf: memoryview, n: int):
+        self.n = n
+        self._offsets = buf[:4 * (n + 1)].cast('I')
+        if sys.byteorder != 'little':  # file is little endian
+            self._offsets = array('I', self._offsets)
+            self._offsets.byteswap()
+        self._blob = buf[4 * (n + 1):]
+        self._memo: Dict[str, Optional[str]] = {}   # the same few keys are looked up often
+
+    def _record(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])
+
+    def get(self, key: str, default=None) -> Optional[str]:
+        if key not in self._memo:
+            self._memo[key] = self._search(key)
+        val = self._memo[key]
+        return default if val is None else val
+
+    def _search(self, key: str) -> Optional[str]:
+        key = key.encode('utf-8')
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, mid_val = self._record(mid).split(b'\0', maxsplit=1)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return mid_val.decode('utf-8')
+        return None
+
+    def __getitem__(self, key: str) -> str:
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self.get(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self.n):
+            yield self._record(i).split(b'\0', maxsplit=1)[0].decode('utf-8')
+
+    def __len__(self) -> int:
+        return self.n
+
+
+def sources_hash() -> str:
+    hash = md5()
+    for path in SOURCES:
+        hash.update(path.read_bytes())
+    return hash.hexdigest()
+
+
+def resolve_iso3(lang: str) -> Optional[str]:
+    """Resolves lowercase code or name to ISO 639-3 code using the source tables; this is slow"""
+    from mtdata.iso.iso639_3 import CODES as iso3_codes, name_to_code
+    from mtdata.iso.iso639_2 import CODE2_TO_3, code2_to_code3_name
+    from mtdata.iso.iso639_1 import ISO693_1_to_3 as code1_to_3
+    from mtdata.iso.custom import CUSTOM_TO_3 as custom_to_3
+    if lang in iso3_codes:
+        return lang
+    if lang in CODE2_TO_3:
+        _, name = code2_to_code3_name(lang)
+        iso3_code = name_to_code(name)
+        if iso3_code:
+            return iso3_code
+    if lang in code1_to_3:
+        return code1_to_3[lang]
+    if name_to_code(lang, None):
+        return name_to_code(lang)
+    if lang in custom_to_3:  # at last
+        return custom_to_3[lang]
+    return None
+
+
+def compile_tables() -> bytes:
+    """Compiles SOURCES into the lookup file format"""
+    from mtdata.iso.iso639_3 import CODES as iso3_codes, NAMES
+    from mtdata.iso.iso639_2 import CODE2_TO_3
+    from mtdata.iso.iso639_1 import ISO693_1_to_3 as code1_to_3
+    from mtdata.iso.custom import CUSTOM_TO_3 as custom_to_3
+
+    candidates = set(iso3_codes) | set(CODE2_TO_3) | set(code1_to_3) | set(custom_to_3)
+    candidates.update(name.lower() for name in NAMES)
+    iso3 = {}
+    for key in candidates:
+        code = resolve_iso3(key)
+        if code:
+            iso3[key] = code
+
+    data = json.loads((iso_dir / 'bcp47.json').read_text(encoding='utf-8'))
+    languages = {code3: code2 for code3, code2, name in data['languages']}
+    default_scripts = {}
+    for lang_code, script_code, lang_name in data['default_scripts']:
+        lang_code = lang_code.lower()
+        code3 = iso3.get(lang_code) or iso3.get(lang_code.split('-')[0])
+        assert code3, f'Unable to find ISO 639-3 code for {lang_code}'
+        default_scripts[code3] = script_code
+    tables = dict(iso3=iso3, languages=languages, scripts=dict(data['scripts']),
+                  countries=dict(data['countries']), default_scripts=default_scripts)
+    for code3 in languages:  # validation
+        assert iso3.get(code3) == code3, f'{code3} is not an ISO 639-3 code'
+    assert all(script in tables['scripts'] for script in default_scripts.values())
+
+    layout, chunks, offset = {}, [], 0
+    for name in TABLES:
+        records = [f'{key}\0{val}'.encode('utf-8') for key, val in tables[name].items()]
+        records.sort(key=lambda rec: rec.split(b'\0', maxsplit=1)[0])
+        offsets = [0]
+        for rec in records:
+            offsets.append(offsets[-1] + len(rec))
+        chunk = struct.pack(f'<{len(offsets)}I', *offsets) + b''.join(records)
+        chunk += b'\0' * (-len(chunk) % ALIGN)
+        layout[name] = [offset, len(records)]
+        chunks.append(chunk)
+        offset += len(chunk)
+    header = json.dumps(dict(sources=sources_hash(), tables=layout)).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % ALIGN)
+    return MAGIC + struct.pack('<I', len(header)) + header + b''.join(chunks)
+
+
+def load_tables(path: Path = lookup_file) -> Dict[str, Table]:
+    if path.exists():
+        with open(path, 'rb') as fh:
+            buf = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+    else:  # e.g. source checkout without the build step
+        buf = memoryview(compile_tables())
+    assert bytes(buf[:len(MAGIC)]) == MAGIC, f'{path} is not a valid lookup file'
+    header_len, = struct.unpack('<I', buf[len(MAGIC):len(MAGIC) + 4])
+    start = len(MAGIC) + 4 + header_len
+    header = json.loads(bytes(buf[len(MAGIC) + 4:start]))
+    return {name: Table(buf[start + offset:], n) for name, (offset, n) in header['tables'].items()}
+
+
+_tables: Optional[Dict[str, Table]] = None
+
+
+def get_tables() -> Dict[str, Table]:
+    global _tables
+    if _tables is None:
+        _tables = load_tables()
+    return _tables
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(prog='python -m mtdata.iso.lookup',
+                                description="Compiles ISO 639 and BCP47 lookup tables")
+    p.add_argument('-o', '--out', type=Path, default=lookup_file, help="Output file path")
+    args = p.parse_args()
+    data = compile_tables()
+    args.out.write_bytes(data)
+    print(f'Wrote {len(data):,} bytes to {args.out}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,15 @@
 # Created: 4/4/20
 import argparse
 from pathlib import Path
-from collections import defaultdict
 from typing import List, Dict, Mapping, Tuple, Optional
 import json
 import fnmatch
 import subprocess as sp
+import shutil
 import sys
 
 import mtdata
-from mtdata import log, __version__, cache_dir as CACHE_DIR, cached_index_file
+from mtdata import log, __version__, cache_dir as CACHE_DIR, cached_index_file, Defaults
 from mtdata import pbar_man
 from mtdata.entry import DatasetId, Langs, LangPair
 from mtdata.utils import IO, format_byte_size
@@ -20,21 +20,28 @@ from mtdata.utils import IO, format_byte_size
 DEF_N_JOBS = 1
 
 
-def list_data(langs, names, not_names=None, full=False, groups=None, not_groups=None, id_only=False, strict=False):
+def list_data(langs, names, not_names=None, full=False, groups=None, not_groups=None, id_only=False, strict=False,
+              query=None, cached=False):
     from mtdata.index import get_entries
-    entries = get_entries(langs, names, not_names, groups=groups, not_groups=not_groups, fuzzy_match=True, strict=strict)
+    entries = get_entries(langs, names, not_names, groups=groups, not_groups=not_groups, fuzzy_match=True, strict=strict,
+                          query=query)
+    if cached:
+        from mtdata.cache import Cache
+        cached = Cache(CACHE_DIR).cached_entries(entries)
     for i, ent in enumerate(entries):
+        mark = cached and ('cached\t' if cached[ent] else '-\t') or ''
         if id_only:
-            print(ent.did)
+            print(f'{mark}{ent.did}')
         else:
-            print(ent.format(delim='\t'))
+            print(mark + ent.format(delim='\t'))
         if full:
             print(ent.cite or "CITATION_NOT_LISTED", end='\n\n')
     log.info(f"Total {len(entries)} entries")
 
 
 def get_data(langs, out_dir, merge_train=False, compress=False,
-             drop_dupes=False, drop_tests=False, fail_on_error=False, n_jobs=DEF_N_JOBS, **kwargs):
+             drop_dupes=False, drop_tests=False, fail_on_error=False, n_jobs=DEF_N_JOBS, plan=None,
+             space_check=False, **kwargs):
     from mtdata.data import Dataset, DATA_FIELDS
     dataset_ids: Dict[str, List] = {}
     for name in DATA_FIELDS:
@@ -45,10 +52,15 @@ def get_data(langs, out_dir, merge_train=False, compress=False,
         log.debug(f"Args are ignored: {kwargs}")
     assert any(bool(ids) for ids in dataset_ids.values()),\
         f'Required at least one of --train --test --dev --mono-train --mono-test --mono-dev \n given={dataset_ids.keys()}'
+    if plan:
+        print_plan(Dataset.plan(out_dir, dataset_ids=dataset_ids, cache_dir=CACHE_DIR, merge_train=merge_train,
+                                compress=compress, n_jobs=n_jobs), format=plan)
+        return
     dataset = Dataset.prepare(
         langs, dataset_ids=dataset_ids, out_dir=out_dir, cache_dir=CACHE_DIR,
         merge_train=merge_train, compress=compress,
-        drop_dupes=drop_dupes, drop_tests=drop_tests, fail_on_error=fail_on_error, n_jobs=n_jobs)
+        drop_dupes=drop_dupes, drop_tests=drop_tests, fail_on_error=fail_on_error, n_jobs=n_jobs,
+        check_space=space_check)
     cli_sig = f'-l {"-".join(str(l) for l in langs)}'
 
     for name, dids in dataset_ids.items():
@@ -93,15 +105,9 @@ def echo_data(did:DatasetId, delim='\t'):
 
 
 def generate_report(langs, names, not_names=None, format='plain'):
-    from mtdata.index import get_entries
-    entries = get_entries(langs, names, not_names)
-    lang_stats = defaultdict(int)
-    name_stats = defaultdict(int)
-    group_stats = defaultdict(int)
-    for ent in entries:
-        lang_stats[ent.lang_str] += 1
-        name_stats[ent.did.name] += 1
-        group_stats[ent.did.group] += 1
+    from mtdata.index import count_entries
+    lang_stats, name_stats, group_stats = [count_entries(by, langs=langs, names=names, not_names=not_names)
+                                           for by in ('langs', 'name', 'group')]
 
     print("Languages:")
     for key, val in lang_stats.items():
@@ -138,7 +144,7 @@ def list_recipes(id_only=False, delim='\t', format='plain'):
 
 def get_recipe(recipe_id, out_dir: Path, compress=False, drop_dupes=False, 
                drop_tests=False, fail_on_error=False,
-               n_jobs=DEF_N_JOBS, merge_train=True, **kwargs):
+               n_jobs=DEF_N_JOBS, merge_train=True, plan=None, space_check=False, **kwargs):
     if kwargs:
         log.debug(f"Args are ignored: {kwargs}")
     from mtdata.recipe import RECIPES
@@ -148,26 +154,42 @@ def get_recipe(recipe_id, out_dir: Path, compress=False, drop_dupes=False,
 
     data_fields = {f'{k}_dids': v for k, v in recipe.data_fields.items()}
     get_data(langs=recipe.langs, merge_train=merge_train, out_dir=out_dir, compress=compress, drop_dupes=drop_dupes,
-             drop_tests=drop_tests, fail_on_error=fail_on_error, n_jobs=n_jobs, **data_fields)
+             drop_tests=drop_tests, fail_on_error=fail_on_error, n_jobs=n_jobs, plan=plan, space_check=space_check,
+             **data_fields)
+
+
+def print_plan(plan, format='text'):
+    """Prints mtdata.plan.Plan as text or json"""
+    if format == 'json':
+        print(json.dumps(plan.to_json(), indent=2))
+    else:
+        print(plan.format())
 
 
-def show_stats(*dids: DatasetId, quick=False):
+def show_stats(*dids: DatasetId, quick=False, n_jobs=Defaults.HEAD_JOBS):
     from mtdata.index import INDEX as index
     from mtdata.cache import Cache
     cache = Cache(CACHE_DIR)
+    if quick:  # HEAD requests of all datasets are concurrent
+        for stats in cache.get_content_lengths([index[did] for did in dids], n_jobs=n_jobs):
+            print(json.dumps(stats))
+        return
     for did in dids:
         entry = index[did]
-        if quick:
-            stats = cache.get_content_length(entry)
-        else:
-            stats = cache.get_stats(entry)
+        stats = cache.get_stats(entry)
         print(json.dumps(stats))
 
-def cache_datasets(recipes:List[str]=None, dids:List[DatasetId]=None, n_jobs=DEF_N_JOBS):
-    from mtdata.cache import Cache
+def cache_datasets(recipes:List[str]=None, dids:List[DatasetId]=None, n_jobs=DEF_N_JOBS, host_jobs=None,
+                   max_bandwidth=None, plan=None, space_check=False):
+    from mtdata.cache import Cache, bandwidth
+    from mtdata.utils import parse_byte_size
     from mtdata.data import Dataset
     from mtdata.recipe import RECIPES
 
+    if host_jobs:
+        Defaults.HOST_CONNECTIONS = host_jobs
+    if max_bandwidth:
+        bandwidth.rate = parse_byte_size(max_bandwidth)
     cache = Cache(CACHE_DIR)
     all_dids = set()
     if dids:
@@ -189,20 +211,75 @@ def cache_datasets(recipes:List[str]=None, dids:List[DatasetId]=None, n_jobs=DEF
     assert all_dids, 'No datasets found to cache'
     entries = Dataset.resolve_entries(all_dids)
     assert entries, f'No entries found'
+    if plan or space_check:
+        from mtdata.plan import make_plan
+        cache_plan = make_plan(cache, [('cache', ent) for ent in entries], n_jobs=n_jobs)
+        if plan:
+            print_plan(cache_plan, format=plan)
+            return
+        cache_plan.check()
     log.info(f"Going to cache {len(entries)} entries at {cache.root}; n_jobs={n_jobs}")
     Dataset.parallel_download(entries, cache=cache, n_jobs=n_jobs)
+    cache.auto_gc()
+
+
+def list_cache(scan=False):
+    """Prints files in the cache: size, last access time, dataset ids, and path"""
+    from mtdata.cache import Cache
+    from mtdata.utils import format_byte_size
+    import datetime
+    cache = Cache(CACHE_DIR)
+    if scan:
+        log.info(f"Added {cache.scan()} files to cache manifest")
+    files = cache.list_files()
+    for rec in files:
+        accessed = datetime.datetime.fromtimestamp(rec['accessed']).isoformat(sep=' ', timespec='seconds')
+        print(f"{format_byte_size(rec['size'])}\t{accessed}\t{rec['dids'] or '-'}\t{cache.root / rec['path']}")
+    log.info(f"Total {len(files)} files; {format_byte_size(sum(rec['size'] for rec in files))} at {CACHE_DIR}")
 
-def index_datasets():
+
+def verify_cache(verify=True, dedupe=False, n_jobs=DEF_N_JOBS):
+    from mtdata.cache import Cache
+    from mtdata.utils import format_byte_size
+    cache = Cache(CACHE_DIR)
+    if verify:
+        result = cache.verify(n_jobs=n_jobs)
+        log.info(f"Verified {len(result['ok'])} files. Quarantined {len(result['failed'])} files with checksum errors."
+                 f" Recorded checksums of {len(result['added'])} files")
+        if result['failed']:
+            print('\n'.join(result['failed']))
+    if dedupe:
+        log.info(f"Deduplication freed {format_byte_size(cache.dedupe())}")
+
+
+def gc_cache(max_size: str, dry_run=False):
+    """Evicts least recently used files of the cache until it fits in max_size"""
+    from mtdata.cache import Cache
+    from mtdata.utils import parse_byte_size, format_byte_size
+    evicted = Cache(CACHE_DIR).gc(parse_byte_size(max_size), dry_run=dry_run)
+    log.info(f"{'Would evict' if dry_run else 'Evicted'} {len(evicted)} items;"
+             f" {format_byte_size(sum(unit['size'] for unit in evicted))}")
+
+def index_datasets(force=False, n_jobs=DEF_N_JOBS):
     """
     Create or update the dataset index. This deletes action {cached_index_file} only and not the downloaded files.
     Use this if you've modified the mtdata source code and you want to force refresh the dataset index.
+    Only the segments of modules whose source or resource files have changed are rebuilt, unless force=True.
+    Segments are built by n_jobs worker processes.
     """
     if cached_index_file.exists():
         bak_file = cached_index_file.with_suffix(".bak")
         log.info(f"Invalidate index: {cached_index_file} -> {bak_file}")
         cached_index_file.rename(bak_file)
-    # importing the index will recreate the index
-    from mtdata.index import INDEX as index
+    from mtdata.index import Index, SEGMENTS_DIR
+    if force and SEGMENTS_DIR.exists():
+        log.info(f"Removing index segments: {SEGMENTS_DIR}")
+        shutil.rmtree(SEGMENTS_DIR)
+    # loading the index will recreate the index
+    Index.get_instance(n_jobs=n_jobs)
+    if mtdata.index_backend == 'sqlite':
+        from mtdata.index.sqldb import SqlIndex
+        SqlIndex.get_instance()
 
 def score_datasets(cmd: str, langs: LangPair, out_dir: Path, metric_name: str):
     """
@@ -271,6 +348,10 @@ def parse_args():
         'index', formatter_class=MyFormatter,
         help=f"Create or update the dataset index. This deletes action {cached_index_file} only and not the downloaded files. "
             f"Use this if you've modified the mtdata source code and you want to force refresh the dataset index.")
+    index_p.add_argument('-f', '--force', action='store_true',
+                         help="Rebuild index segments of all modules, even the ones that are unchanged.")
+    index_p.add_argument('-j', '--n-jobs', type=int, default=DEF_N_JOBS,
+                         help="Number of worker jobs (processes) to build index segments of modules")
 
     list_p = sub_ps.add_parser('list', formatter_class=MyFormatter)
     list_p.add_argument('-l', '--langs', metavar='L1/L1-L2', type=Langs,
@@ -283,7 +364,12 @@ def parse_args():
     list_p.add_argument('-ng', '--not-groups', metavar='GROUP', nargs='*', help='Exclude these groups')
     list_p.add_argument('-s', '--strict', action='store_true', default=False,
                         help='Strict langpair ordering: eng-deu and deu-eng are treated differently')
+    list_p.add_argument('-q', '--query', metavar='TEXT',
+                        help='Search dataset IDs and URLs; results are ranked and tolerate typos and partial words.'
+                             ' e.g.: news_comm')
     list_p.add_argument('-f', '--full', action='store_true', help='Show Full Citation')
+    list_p.add_argument('-c', '--cached', action='store_true',
+                        help='Add a first column: "cached" if the dataset is in the local cache, else "-"')
     list_p.add_argument('-o', '--out', type=Path, help='This arg is ignored. Only used in "get" subcommand,'
                                                        ' but added here for convenience of switching b/w get and list')
 
@@ -318,6 +404,15 @@ def parse_args():
         parser.add_argument('-dt', f'--drop-tests', dest='drop_tests', action='store_true', default=False,
                             help="Remove dev/test sentences from training sets (if any); valid when --merge")
         parser.add_argument('-o', '--out', dest='out_dir', type=Path, required=True, help='Output directory name')
+        add_plan_args(parser)
+
+    def add_plan_args(parser):
+        parser.add_argument('--plan', nargs='?', const='text', choices=['text', 'json'],
+                            help="Show the bytes to download, extract and write, the disk space needed, and the"
+                                 " predicted time; then exit without downloading")
+        parser.add_argument('--space-check', dest='space_check', action='store_true', default=False,
+                            help="Check free disk space before starting, and fail early if it is not enough."
+                                 " This sends a HEAD request for each URL that is not in the cache")
 
     add_getter_args(get_p)
 
@@ -340,12 +435,33 @@ def parse_args():
     stats_p.add_argument('did', nargs='+', type=DatasetId.parse, help="Show stats of dataset IDs")
     stats_p.add_argument('-q', '--quick', action='store_true',
                          help=("Show quick stats without downloading or parsing dataset."
-                               "This flag sends HEAD request and shows Content-Length"))
+                               "This flag sends HEAD request and shows Content-Length. Content-Lengths are cached"
+                               f" for {Defaults.HEAD_TTL // 3600} hours"))
+    stats_p.add_argument('-j', '--n-jobs', type=int, default=Defaults.HEAD_JOBS,
+                         help="Number of concurrent HEAD requests of --quick")
 
     cache_p = sub_ps.add_parser('cache', formatter_class=MyFormatter)
     cache_p.add_argument('-ri', '--recipe-id', type=str, nargs='*', help='Recipe ID. Glob patterns are supported. Example: "wmt24-*"')
     cache_p.add_argument('-di', '--dataset-id', type=DatasetId.parse, nargs='*', help='Dataset ID')
-    cache_p.add_argument('-j', '--n-jobs', type=int, help="Number of worker jobs (processes)", default=DEF_N_JOBS)
+    cache_p.add_argument('-j', '--n-jobs', type=int, help="Number of concurrent downloads (threads)", default=DEF_N_JOBS)
+    cache_p.add_argument('-ls', '--ls', action='store_true', help="List files in the cache instead of downloading."
+                         " Output columns: size, last access time, dataset IDs, path")
+    cache_p.add_argument('--scan', action='store_true', help="With --ls: find files in the cache that are missing in"
+                         " its manifest, e.g. downloaded by older versions of mtdata")
+    cache_p.add_argument('--gc', action='store_true', help="Evict least recently used files (and their extracted"
+                         " content) until the cache fits in --max-size. Files in use by running mtdata are kept")
+    cache_p.add_argument('--max-size', type=str, default=mtdata.cache_max_size or None,
+                         help="Size budget for --gc, e.g. 2TB. $MTDATA_CACHE_MAX_SIZE sets the default, and is also"
+                              " applied after downloads of get, get-recipe and cache")
+    cache_p.add_argument('--dry-run', action='store_true', help="With --gc: show what would be evicted")
+    cache_p.add_argument('--verify', action='store_true', help="Check cached files against their checksums using"
+                         " --n-jobs threads; mismatches are moved to <cache>/.quarantine and downloaded again when needed")
+    cache_p.add_argument('--dedupe', action='store_true', help="Replace duplicate cached files with hardlinks")
+    cache_p.add_argument('-hj', '--host-jobs', type=int, help="Max concurrent connections to a host",
+                         default=Defaults.HOST_CONNECTIONS)
+    cache_p.add_argument('-bw', '--max-bandwidth', type=str, help="Max download rate (bytes per second) of all"
+                         " downloads, e.g. 100MB. None: $MTDATA_MAX_BANDWIDTH if set, else unlimited")
+    add_plan_args(cache_p)
 
     score_p = sub_ps.add_parser('score', formatter_class=MyFormatter
                                 , help="Score the datasets using the specified scorer")
@@ -385,11 +501,11 @@ def main():
             index_datasets()
 
         if args.task == 'index':
-            index_datasets()
+            index_datasets(force=args.force, n_jobs=args.n_jobs)
         elif args.task == 'list':
             list_data(args.langs, args.names, not_names=args.not_names, full=args.full,
                     groups=args.groups, not_groups=args.not_groups, id_only=args.id,
-                    strict=args.strict)
+                    strict=args.strict, query=args.query, cached=args.cached)
         elif args.task == 'get':
             get_data(**vars(args))
         elif args.task == 'echo':
@@ -401,12 +517,21 @@ def main():
         elif args.task == 'get-recipe':
             get_recipe(**vars(args))
         elif args.task == 'stats':
-            show_stats(*args.did, quick=args.quick)
+            show_stats(*args.did, quick=args.quick, n_jobs=args.n_jobs)
         elif args.task == 'report':
             generate_report(args.langs, names=args.names, not_names=args.not_names)
+        elif args.task == 'cache' and args.ls:
+            list_cache(scan=args.scan)
+        elif args.task == 'cache' and (args.verify or args.dedupe):
+            verify_cache(verify=args.verify, dedupe=args.dedupe, n_jobs=args.n_jobs)
+        elif args.task == 'cache' and args.gc:
+            assert args.max_size, "--max-size is required for --gc"
+            gc_cache(args.max_size, dry_run=args.dry_run)
         elif args.task == 'cache':
             assert args.recipe_id or args.dataset_id, "Need at least one of --recipe-id or --dataset-id"
-            cache_datasets(recipes=args.recipe_id, dids=args.dataset_id, n_jobs=args.n_jobs)
+            cache_datasets(recipes=args.recipe_id, dids=args.dataset_id, n_jobs=args.n_jobs,
+                           host_jobs=args.host_jobs, max_bandwidth=args.max_bandwidth, plan=args.plan,
+                           space_check=args.space_check)
         elif args.task == 'score':
             score_datasets(cmd=args.cmd, langs=args.langs, out_dir=args.out_dir,
                             metric_name=args.metric_name)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Mirrors of dataset files, for hosts without (or with slow) access to the original servers.
+#  MTDATA_MIRRORS is a list of mirrors, separated by spaces or commas, which are looked up in order:
+#    /path/to/dir or file:///path/to/dir : files at <dir>/<host>/<path of URL>, e.g. made by `wget -x`
+#    cache:/path/to/mtdata  : a (read-only) mtdata cache dir, e.g. on a shared file system; only valid files are used
+#    http://host:port/prefix : HTTP server of files at <prefix>/<host>/<path of URL>, e.g. a dir mirror served by
+#                              `python -m http.server`
+#  MTDATA_URL_REWRITE is a list of rules "<old prefix>=><new prefix>", separated by spaces or commas; the first rule
+#    whose prefix matches a URL replaces the original server. The new prefix may be a local dir (/path or file:///path)
+#  Files of local mirrors are added to the cache by hardlink, reflink (copy-on-write clone), or symlink; bytes are
+#  never copied. HTTP mirrors are tried before the original (or rewritten) URL; if one fails, the next is tried.
+#  The cache path of a file stays the same as for its original URL.
+#
+# Created: 10/18/26
+
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse, unquote
+
+from mtdata import log, MTDataException
+
+FICLONE = 0x40049409  # ioctl of Linux for cloning a file (reflink) on btrfs, xfs, etc.
+
+
+def is_local(location: str) -> bool:
+    return location.startswith('/') or location.startswith('file://')
+
+
+def local_path(location: str) -> Path:
+    """Path of a local location, which is a path or a file:// URL"""
+    if location.startswith('file://'):
+        location = unquote(urlparse(location).path)
+    return Path(location)
+
+
+def url_rel_path(url: str) -> Optional[Path]:
+    """<host>/<path> of url, which is its relative path in dir and HTTP mirrors; None if it is unsafe"""
+    parsed = urlparse(url)
+    parts = [parsed.hostname or 'nohost'] + [p for p in unquote(parsed.path).split('/') if p]
+    if '..' in parts or len(parts) < 2:
+        return None
+    return Path(*parts)
+
+
+@dataclass
+class Mirror:
+    kind: str   # dir, cache or http
+    location: str
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Mirror':
+        if spec.startswith('cache:'):
+            return cls('cache', spec[len('cache:'):])
+        if spec.startswith('http://') or spec.startswith('https://'):
+            return cls('http', spec.rstrip('/'))
+        if is_local(spec):
+            return cls('dir', spec)
+        raise MTDataException(f'Invalid mirror: {spec}; expected a dir, cache:<dir> or http(s) URL')
+
+    def find(self, url: str, cache_path: str) -> Optional[Path]:
+        """
+        Local file of url in this mirror, if it exists; None for HTTP mirrors
+        :param cache_path: path of the file, relative to cache root; see Cache.get_local_path()
+        """
+        if self.kind == 'cache':
+            path = local_path(self.location) / cache_path
+            if path.with_name(path.name + '._valid').exists() and path.exists():
+                return path
+        elif self.kind == 'dir':
+            rel_path = url_rel_path(url)
+            path = rel_path and local_path(self.location) / rel_path
+            if path and path.is_file():
+                return path
+        return None
+
+    def remote_url(self, url: str) -> Optional[str]:
+        rel_path = self.kind == 'http' and url_rel_path(url)
+        return rel_path and f'{self.location}/{rel_path.as_posix()}' or None
+
+
+@dataclass
+class MirrorChain:
+    mirrors: List[Mirror] = field(default_factory=list)
+    rewrites: List[Tuple[str, str]] = field(default_factory=list)  # (old prefix, new prefix)
+
+    @classmethod
+    def parse(cls, mirrors: str = '', rewrites: str = '') -> 'MirrorChain':
+        """Parses the values of MTDATA_MIRRORS and MTDATA_URL_REWRITE; see module doc"""
+        rules = []
+        for rule in re.split(r'[\s,]+', rewrites.strip()):
+            if not rule:
+                continue
+            if '=>' not in rule:
+                raise MTDataException(f'Invalid URL rewrite rule: {rule}; expected <old prefix>=><new prefix>')
+            rules.append(tuple(rule.split('=>', maxsplit=1)))
+        return cls(mirrors=[Mirror.parse(spec) for spec in re.split(r'[\s,]+', mirrors.strip()) if spec],
+                   rewrites=rules)
+
+    def __bool__(self):
+        return bool(self.mirrors or self.rewrites)
+
+    def rewrite(self, url: str) -> str:
+        for old, new in self.rewrites:
+            if url.startswith(old):
+                return new + url[len(old):]
+        return url
+
+    def find(self, url: str, cache_path: str) -> Optional[Path]:
+        """Local file of url in the first mirror that has it, or at its rewritten location; None if none has it"""
+        for mirror in self.mirrors:
+            path = mirror.find(url, cache_path)
+            if path:
+                return path
+        new_url = self.rewrite(url)
+        if is_local(new_url) and local_path(new_url).is_file():
+            return local_path(new_url)
+        return None
+
+    def remote_urls(self, url: str) -> List[str]:
+        """URLs to download url from, in order: HTTP mirrors, then the rewritten (or the original) URL"""
+        urls = [mirror.remote_url(url) for mirror in self.mirrors if mirror.kind == 'http']
+        new_url = self.rewrite(url)
+        if not is_local(new_url):
+            urls.append(new_url)
+        return [u for u in urls if u]
+
+
+def reflink(src: Path, dest: Path):
+    import fcntl
+    with open(src, 'rb') as inp, open(dest, 'wb') as out:
+        fcntl.ioctl(out.fileno(), FICLONE, inp.fileno())
+
+
+def link_file(src: Path, dest: Path) -> str:
+    """
+    Makes dest have the content of src without copying bytes: hardlink, else reflink, else symlink (when the
+    file system or permissions do not allow the former)
+    :return: method that worked
+    """
+    tmp = dest.with_name(dest.name + f'.tmp{os.getpid()}')
+    methods = [('hardlink', os.link), ('reflink', reflink), ('symlink', lambda s, d: os.symlink(s.absolute(), d))]
+    for name, method in methods:
+        tmp.unlink(missing_ok=True)
+        try:
+            method(src, tmp)
+        except (OSError, ImportError) as e:
+            log.debug(f'Unable to {name} {src} → {dest}: {e}')
+            continue
+        os.replace(tmp, dest)
+        return name
+    tmp.unlink(missing_ok=True)
+    raise MTDataException(f'Unable to link {src} → {dest}')
@@ -6,11 +6,61 @@ from pathlib import Path
 from mtdata.utils import IO, log
 from xml.etree import ElementTree as ET
 import collections as coll
+import os
 import re
+from typing import Set, Tuple
+
+
+class ExtractedDir:
+    """Directory of files extracted from a zip (see Cache.get_zip_members); has the parts of ZipFile API used here"""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def namelist(self):
+        return [str(p.relative_to(self.path)).replace(os.sep, '/') for p in self.path.rglob('*') if p.is_file()]
+
+    def open(self, name):
+        return open(self.path / name, 'rb')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class OpusXcesParser:
 
+    @staticmethod
+    def get_preprocessing(l1_url: str) -> str:
+        return 'raw' if '/raw/' in l1_url else 'xml'
+
+    @staticmethod
+    def doc_path(doc: str, name='JW300', preprocessing='xml') -> str:
+        """Path of doc of alignment file in the zip file of its language"""
+        return f'{name}/{preprocessing}/' + re.sub(r'\.gz$', '', doc)
+
+    @classmethod
+    def doc_paths(cls, align_file: Path, name='JW300', preprocessing='xml') -> Tuple[Set[str], Set[str]]:
+        """Paths of source and target docs that are referred by alignment file"""
+        src_docs, tgt_docs = set(), set()
+        for d in cls.read_alignments(align_file):
+            src_docs.add(cls.doc_path(d['src_doc'], name=name, preprocessing=preprocessing))
+            tgt_docs.add(cls.doc_path(d['tgt_doc'], name=name, preprocessing=preprocessing))
+        return src_docs, tgt_docs
+
+    @staticmethod
+    def open_container(path: Path):
+        if path.is_dir():
+            return ExtractedDir(path)
+        assert path.is_file() and path.suffix == '.zip', f'{path}'
+        from zipfile import ZipFile
+        return ZipFile(path)
+
     @classmethod
     def read_alignments(cls, align_file: Path):
         assert align_file.is_file(), f'{align_file} not found'
@@ -55,19 +105,16 @@ class OpusXcesParser:
     def read(cls, align_file: Path, l1_dir: Path, l2_dir: Path, name='JW300', min_confidence=0.01,
              preprocessing='xml'):
         doc_aligns = cls.read_alignments(align_file)
-        assert l1_dir.is_file() and l1_dir.suffix == '.zip', f'{l1_dir}'
-        assert l2_dir.is_file() and l2_dir.suffix == '.zip', f'{l2_dir}'
-        from zipfile import ZipFile
         stats = coll.defaultdict(int)
         assert preprocessing in ('xml', 'raw')
         tokenized = preprocessing != 'raw'
 
-        with ZipFile(l1_dir) as l1_zip, ZipFile(l2_dir) as l2_zip:
+        with cls.open_container(l1_dir) as l1_zip, cls.open_container(l2_dir) as l2_zip:
             l1_doc_names = set(l1_zip.namelist())
             l2_doc_names = set(l2_zip.namelist())
             for d in doc_aligns:
-                src_doc_path = f'{name}/{preprocessing}/' + re.sub(r'\.gz$', '', d['src_doc'])
-                tgt_doc_path = f'{name}/{preprocessing}/' + re.sub(r'\.gz$', '', d['tgt_doc'])
+                src_doc_path = cls.doc_path(d['src_doc'], name=name, preprocessing=preprocessing)
+                tgt_doc_path = cls.doc_path(d['tgt_doc'], name=name, preprocessing=preprocessing)
                 if src_doc_path not in l1_doc_names or tgt_doc_path not in l2_doc_names:
                     stats['doc_not_found'] += 1
                     continue
@@ -62,11 +62,9 @@ class Parser:
     def read_segs(self, show_pbar=True):
         readers = []
         if self.ext == 'opus_xces':
-            preprocessing = 'xml'
-            if "/raw/" in self.ent.in_paths[0]:
-                preprocessing = 'raw'
-            align, lang1_dir, lang2_dir = self.paths
             from mtdata.opus_xces import OpusXcesParser
+            preprocessing = OpusXcesParser.get_preprocessing(self.ent.in_paths[0])
+            align, lang1_dir, lang2_dir = self.paths
             reader = OpusXcesParser.read(align, lang1_dir, lang2_dir, preprocessing=preprocessing)
             readers.append(reader)
         else:
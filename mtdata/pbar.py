@@ -6,46 +6,76 @@ import threading
 import time as _time
 from contextlib import contextmanager
 
-from rich.progress import (Progress, TextColumn, BarColumn, TaskProgressColumn,
-    TimeElapsedColumn, TimeRemainingColumn, SpinnerColumn, ProgressColumn)
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.text import Text
+# rich is imported lazily, on first log record or progress bar, to keep "import mtdata" cheap
+_console = None
+
+
+def get_console():
+    global _console
+    if _console is None:
+        from rich.console import Console
+        _console = Console(stderr=True)
+    return _console
+
+
+def _make_columns():
+    from rich.progress import (TextColumn, BarColumn, TaskProgressColumn,
+        TimeElapsedColumn, TimeRemainingColumn, SpinnerColumn, ProgressColumn)
+    from rich.text import Text
+
+    class _CountColumn(ProgressColumn):
+        def render(self, task):
+            unit = task.fields.get('unit', 'it')
+            completed = f"{task.completed:,.0f}"
+            if task.total is None:
+                return Text(f"{completed} {unit}")
+            return Text(f"{completed}/{task.total:,.0f} {unit}")
+
+    class _RateColumn(ProgressColumn):
+        def render(self, task):
+            speed = task.finished_speed or task.speed
+            if speed is None:
+                return Text('')
+            unit = task.fields.get('unit', 'it')
+            if 'write_count' in task.fields and task.elapsed:
+                write_speed = task.fields['write_count'] / task.elapsed
+                return Text(f"r {speed:,.1f} w {write_speed:,.1f} {unit}/s")
+            return Text(f"{speed:,.1f} {unit}/s")
+
+    return [
+        SpinnerColumn(),
+        TextColumn("[bold blue]{task.description}"),
+        BarColumn(bar_width=30),
+        TaskProgressColumn(),
+        _CountColumn(),
+        _RateColumn(),
+        TimeElapsedColumn(),
+        TextColumn("eta"),
+        TimeRemainingColumn(),
+    ]
+
+
+class _ProgressAwareRichHandler(logging.Handler):
+    """Log handler that coordinates with the progress bars.
+    The actual RichHandler is created when the first record is emitted."""
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self._kwargs = kwargs
+        self._handler = None
 
-console = Console(stderr=True)
-
-
-class _CountColumn(ProgressColumn):
-    def render(self, task):
-        unit = task.fields.get('unit', 'it')
-        completed = f"{task.completed:,.0f}"
-        if task.total is None:
-            return Text(f"{completed} {unit}")
-        return Text(f"{completed}/{task.total:,.0f} {unit}")
-
-
-class _RateColumn(ProgressColumn):
-    def render(self, task):
-        speed = task.finished_speed or task.speed
-        if speed is None:
-            return Text('')
-        unit = task.fields.get('unit', 'it')
-        if 'write_count' in task.fields and task.elapsed:
-            write_speed = task.fields['write_count'] / task.elapsed
-            return Text(f"r {speed:,.1f} w {write_speed:,.1f} {unit}/s")
-        return Text(f"{speed:,.1f} {unit}/s")
-
-
-class _ProgressAwareRichHandler(RichHandler):
     def emit(self, record):
+        if self._handler is None:
+            from rich.logging import RichHandler
+            self._handler = RichHandler(console=get_console(), **self._kwargs)
+            self._handler.setFormatter(self.formatter)
         with pbar_man.render_lock():
-            super().emit(record)
+            self._handler.emit(record)
 
 
 def get_log_handler():
     """Return a RichHandler that coordinates with the progress bars."""
-    return _ProgressAwareRichHandler(console=console, show_path=False, show_time=True,
-                                     omit_repeated_times=False)
+    return _ProgressAwareRichHandler(show_path=False, show_time=True, omit_repeated_times=False)
 
 
 class _PbarManager:
@@ -60,22 +90,15 @@ class _PbarManager:
         self._progress = None
         self._active = 0
         self._queue = None  # set in worker processes for remote mode
-        self._columns = [
-            SpinnerColumn(),
-            TextColumn("[bold blue]{task.description}"),
-            BarColumn(bar_width=30),
-            TaskProgressColumn(),
-            _CountColumn(),
-            _RateColumn(),
-            TimeElapsedColumn(),
-            TextColumn("eta"),
-            TimeRemainingColumn(),
-        ]
+        self._columns = None
 
     def _start(self):
         with self._lock:
             if self._progress is None:
-                self._progress = Progress(*self._columns, console=console, auto_refresh=False)
+                from rich.progress import Progress
+                if self._columns is None:
+                    self._columns = _make_columns()
+                self._progress = Progress(*self._columns, console=get_console(), auto_refresh=False)
                 self._progress.start()
             self._active += 1
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Plan of `mtdata get`, `get-recipe` and `cache`, made before anything is downloaded: bytes to download, to extract
+#  from tarballs, and to write to the output dir, per entry; free space on the file systems of cache and output;
+#  and the predicted time.
+#  Download sizes are from the cache db or HEAD requests (see Cache.head()); the rest are estimated from download
+#  sizes with per-format ratios (COMPRESSION_RATIOS, TEXT_RATIOS), so they are rough and err on the larger side.
+#  Remote zips (see Cache.get_zip_members()) are counted as whole downloads, though only some members may be fetched;
+#  once their members are fetched, they are counted as cached.
+#
+# Created: 10/18/26
+
+import datetime
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from mtdata import log, MTDataUserError
+from mtdata.cache import dir_size
+from mtdata.entry import Entry
+from mtdata.parser import detect_extension
+from mtdata.utils import TarPath, format_byte_size
+
+# uncompressed size / compressed size; typical of text
+COMPRESSION_RATIOS = {'gz': 3.0, 'tgz': 3.0, 'bz2': 4.0, 'xz': 4.5, 'zip': 3.0}
+# size of the extracted text / size of the file; markup formats have less text than their size
+TEXT_RATIOS = {'tmx': 0.4, 'opus_xces': 0.3, 'sgm': 0.8, 'wmt21xml': 0.6, 'xlsx': 2.0}
+OUTPUT_COMPRESS = 'gz'   # see data.DEF_COMPRESS
+# output dir (relative to out_dir) of each data field; see Dataset
+OUTPUT_DIRS = dict(train='train-parts', dev='tests', test='tests', mono_train='mono-train-parts',
+                   mono_dev='mono-tests', mono_test='mono-tests')
+
+
+def compression_ratio(ext: str) -> float:
+    """Ratio of uncompressed to compressed size of a file with extension ext, such as tsv.gz, tgz or zip"""
+    return COMPRESSION_RATIOS.get(ext.split('.')[-1], 1.0)
+
+
+@dataclass
+class Plan:
+    entries: List[Dict[str, Any]]   # per entry: id, field, download, extract, output; and error if unknown
+    disks: List[Dict[str, Any]]    # per file system: path, need, free
+    seconds: float                 # predicted download time
+
+    def total(self, key: str) -> int:
+        return sum(ent.get(key, 0) for ent in self.entries)
+
+    def unknown(self) -> List[str]:
+        """Ids of entries whose sizes are unknown"""
+        return [ent['id'] for ent in self.entries if ent.get('error')]
+
+    def shortfalls(self) -> List[Dict[str, Any]]:
+        return [disk for disk in self.disks if disk['need'] > disk['free']]
+
+    def check(self):
+        """Raises MTDataUserError if a file system does not have the space needed"""
+        unknown = self.unknown()
+        if unknown:
+            log.warning(f'Sizes of {len(unknown)} datasets are unknown, and not counted for disk space:'
+                        f' {" ".join(unknown)}')
+        short = self.shortfalls()
+        if short:
+            msg = '\n'.join(f'  {disk["path"]}: need {format_byte_size(disk["need"])},'
+                            f' but only {format_byte_size(disk["free"])} is free' for disk in short)
+            raise MTDataUserError(f'Not enough disk space:\n{msg}\nFree up some space, or use another cache'
+                                  f' dir (MTDATA env var) or output dir. See the plan with --plan.')
+
+    def to_json(self) -> Dict[str, Any]:
+        return dict(entries=self.entries, disks=self.disks, download=self.total('download'),
+                    extract=self.total('extract'), output=self.total('output'), seconds=round(self.seconds))
+
+    def format(self) -> str:
+        lines = ['\t'.join(['id', 'field', 'download', 'extract', 'output'])]
+        for ent in self.entries:
+            if ent.get('error'):
+                lines.append('\t'.join([ent['id'], ent['field'], '?', '?', '?']) + f'\t{ent["error"]}')
+            else:
+                lines.append('\t'.join([ent['id'], ent['field']] +
+                                       [format_byte_size(ent[key]) for key in ('download', 'extract', 'output')]))
+        lines.append('\t'.join(['TOTAL', ''] + [format_byte_size(self.total(key))
+                                                for key in ('download', 'extract', 'output')]))
+        for disk in self.disks:
+            status = 'OK' if disk['need'] <= disk['free'] else 'NOT ENOUGH SPACE'
+            lines.append(f'Disk {disk["path"]}: need {format_byte_size(disk["need"])};'
+                         f' free {format_byte_size(disk["free"])} -- {status}')
+        lines.append(f'Predicted download time: {datetime.timedelta(seconds=round(self.seconds))}')
+        return '\n'.join(lines)
+
+
+def disk_of(path: Path) -> Tuple[Path, int]:
+    """Nearest existing ancestor of path (path may not exist yet), and its device id"""
+    path = Path(path).absolute()
+    while not path.exists():
+        path = path.parent
+    return path, os.stat(path).st_dev
+
+
+def make_plan(cache, entries: List[Tuple[str, Entry]], out_dir: Optional[Path] = None, merge_train=False,
+              compress=False, n_jobs=1) -> Plan:
+    """
+    Plans download, extraction and output of entries
+    :param cache: Cache
+    :param entries: (field, entry) pairs; field is one of data.DATA_FIELDS, or 'cache' for download only
+    :param out_dir: output dir of the dataset; None if nothing is written there (e.g. mtdata cache)
+    :param merge_train: if train parts are merged into a single train file, which doubles their output
+    :param compress: if outputs are compressed
+    :param n_jobs: concurrent downloads, for predicting the time
+    """
+    urls = {}  # url -> filename
+    for _, entry in entries:
+        for url, filename in cache.get_urls(entry):
+            urls.setdefault(url, filename)
+    local_paths = {url: cache.get_local_path(url, filename=filename, fix_missing=False) for url, filename in urls.items()
+                   if urlparse(url).hostname != 'huggingface.co'}
+    cached = {url for url, path in local_paths.items() if cache.is_cached(url, filename=urls[url])}
+    manifest = cache.db.paths()
+    members = {}  # url -> bytes of members of remote zip at url, fetched earlier; same as in Cache.cached_entries()
+    for url in local_paths.keys() - cached:
+        if cache.in_manifest(local_paths[url], manifest):
+            members[url] = dir_size(cache.get_extracted_dir(local_paths[url]))
+            cached.add(url)
+    mirrored = {}  # url -> file in a local mirror, which is linked, not downloaded
+    for url in local_paths.keys() - cached:   # not in this cache
+        path = cache.find_in_mirror(url, filename=urls[url])
+        if path:
+            mirrored[url] = path
+            cached.add(url)
+    heads = cache.heads([url for url in local_paths if url not in cached], n_jobs=n_jobs)
+    n_dev = sum(1 for name, _ in entries if name == 'dev')
+
+    records, sizes, counted = [], {}, set()
+    for name, entry in entries:
+        rec = dict(id=str(entry.did), field=name)
+        records.append(rec)
+        entry_urls = [url for url, _ in cache.get_urls(entry)]
+        missing = [url for url in entry_urls if url not in local_paths or url not in cached and not heads.get(url)]
+        if missing:
+            rec['error'] = f'size unknown: {" ".join(missing)}'
+            sizes.setdefault(entry, 0)
+            continue
+        file_sizes = {url: members[url] if url in members
+                      else mirrored.get(url, local_paths[url]).stat().st_size if url in cached
+                      else heads[url]['length'] for url in entry_urls}
+        rec['download'] = sum(size for url, size in file_sizes.items() if url not in cached and url not in counted)
+        counted.update(entry_urls)   # shared files are downloaded once
+        sizes[entry] = sizes.get(entry, 0) + rec['download']
+        # size of files after decompression, which is the size of extracted members, for archives
+        data_size = sum(size if url in members   # already decompressed
+                        else size * compression_ratio(detect_extension(urls[url] or url.split('/')[-1]))
+                        for url, size in file_sizes.items())
+        rec['extract'] = 0
+        if entry.is_archive and entry.ext != 'zip':   # zips are read in place
+            tar_path = local_paths[entry.url]
+            if not (tar_path.parent / TarPath.extracted_dir_name(tar_path.name)).exists():
+                rec['extract'] = int(data_size)   # at most all members
+            data_size *= compression_ratio(entry.in_ext)
+        data_size *= TEXT_RATIOS.get((entry.in_ext or entry.ext).split('.')[0], 1.0)
+        if compress:
+            data_size /= COMPRESSION_RATIOS[OUTPUT_COMPRESS]
+        rec['output'] = 0
+        if out_dir and name in OUTPUT_DIRS and not (out_dir / OUTPUT_DIRS[name] / f'.valid.{entry.did}').exists():
+            copies = 2 if (name == 'train' and merge_train) or (name == 'dev' and n_dev > 1) else 1
+            rec['output'] = int(data_size * copies)
+
+    needs = {}  # device -> [path, bytes]
+    cache_disk, cache_dev = disk_of(cache.root)
+    needs[cache_dev] = [cache_disk, sum(rec.get('download', 0) + rec.get('extract', 0) for rec in records)]
+    if out_dir:
+        out_disk, out_dev = disk_of(out_dir)
+        needs.setdefault(out_dev, [out_disk, 0])[1] += sum(rec.get('output', 0) for rec in records)
+    disks = [dict(path=str(path), need=need, free=shutil.disk_usage(path).free) for path, need in needs.values()]
+    seconds = cache.predict_time(list(sizes), sizes, n_jobs=n_jobs)
+    return Plan(entries=records, disks=disks, seconds=seconds)
@@ -8,9 +8,10 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Dict, Optional, ClassVar, Tuple, Set
 
-from mtdata import yaml, cache_dir, recipes_dir, log, resource_dir
+from mtdata import cache_dir, recipes_dir, log, resource_dir
 from mtdata.entry import Langs, LangPair, DatasetId, BCP47Tag, bcp47
 from mtdata.data import DATA_FIELDS
+from mtdata.utils import LazyProxy
 
 
 _def_recipes: Path = resource_dir / 'recipes.yml'
@@ -82,6 +83,7 @@ class Recipe:
     @classmethod
     def load(cls, *paths) -> Dict[str, 'Recipe']:
         assert len(paths) > 0
+        from mtdata import yaml
         recipes = {}
         for path in paths:
             log.info(f"Loading recipes from {path}")
@@ -108,4 +110,5 @@ class Recipe:
             paths.extend(_cwd_recipes)
         return cls.load(*paths)
 
-RECIPES = Recipe.load_all()
+# loaded on first access
+RECIPES: Dict[str, Recipe] = LazyProxy(Recipe.load_all)
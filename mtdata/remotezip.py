@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Random access to remote files over HTTP range requests; e.g. zipfile.ZipFile(HttpFile(url)) reads only the
+#  central directory of a remote zip, and then only the members that are opened.
+#  Reads at a new position fetch a block; sequential reads continue the same response, and the read-ahead grows,
+#  so that large members are streamed with few requests.
+#
+# Created: 10/18/26
+
+import io
+import zipfile
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+import requests
+
+from mtdata import log, MTDataException, Defaults
+from mtdata.sessions import headers, get_session
+
+
+class RangeNotSupported(MTDataException):
+    pass
+
+
+class HttpFile(io.RawIOBase):
+    """Read only, seekable file at url; content is fetched with range requests"""
+
+    def __init__(self, url: str, size: int, validator: Optional[str] = None, timeout=(5, 30),
+                 on_read: Optional[Callable[[int], None]] = None):
+        """
+        :param url: URL of the file; the server must support range requests
+        :param size: content length
+        :param validator: ETag or Last-Modified of the file; requests fail if the file on the server has changed
+        :param on_read: called with number of bytes received, e.g. for rate limiting
+        """
+        super().__init__()
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.timeout = timeout
+        self.on_read = on_read
+        self.pos = 0
+        self.n_requests = 0
+        self.n_bytes = 0   # received
+        self._resp: Optional[requests.Response] = None
+        self._resp_pos = self._resp_end = 0   # [start, end) of current response
+        self._readahead = Defaults.REMOTE_ZIP_BLOCK_SIZE
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        assert self.pos >= 0, f'Negative seek position {self.pos}'
+        return self.pos
+
+    def _request(self, n: int):
+        sequential = self._resp is not None and self.pos == self._resp_end
+        self._close_resp()
+        # read-ahead doubles while reads are sequential; resets on seek
+        self._readahead = min(2 * self._readahead, Defaults.REMOTE_ZIP_MAX_READAHEAD) if sequential \
+            else Defaults.REMOTE_ZIP_BLOCK_SIZE
+        end = min(self.size, self.pos + max(n, self._readahead))
+        req_headers = dict(headers, Range=f'bytes={self.pos}-{end - 1}')
+        req_headers['Accept-Encoding'] = 'identity'
+        if self.validator:
+            req_headers['If-Range'] = self.validator
+        resp = get_session(self.url).get(self.url, headers=req_headers, stream=True, timeout=self.timeout)
+        self.n_requests += 1
+        if resp.status_code != 206 or not resp.headers.get('Content-Range', '').startswith(f'bytes {self.pos}-'):
+            resp.close()
+            raise RangeNotSupported(f'Expected bytes {self.pos}-{end - 1} of {self.url}, but got {resp.status_code}'
+                                    f' {resp.headers.get("Content-Range")}; the file may have changed')
+        self._resp, self._resp_pos, self._resp_end = resp, self.pos, end
+
+    def readinto(self, buf) -> int:
+        n = min(len(buf), self.size - self.pos)
+        if n <= 0:
+            return 0
+        if self._resp is None or self._resp_pos != self.pos or self._resp_pos >= self._resp_end:
+            self._request(n)
+        data = self._resp.raw.read(min(n, self._resp_end - self._resp_pos))
+        if not data:
+            raise requests.exceptions.ChunkedEncodingError(f'Unexpected end of response from {self.url}')
+        buf[:len(data)] = data
+        self.pos += len(data)
+        self._resp_pos += len(data)
+        self.n_bytes += len(data)
+        if self.on_read:
+            self.on_read(len(data))
+        return len(data)
+
+    def _close_resp(self):
+        if self._resp is not None:
+            self._resp.close()
+            self._resp = None
+
+    def close(self):
+        self._close_resp()
+        super().close()
+
+
+@contextmanager
+def open_remote_zip(url: str, size: int, validator: Optional[str] = None, **kwargs) -> Iterator[zipfile.ZipFile]:
+    """Opens zip file at url for reading, without downloading all of it; kwargs are for HttpFile"""
+    fileobj = io.BufferedReader(HttpFile(url, size=size, validator=validator, **kwargs),
+                                buffer_size=Defaults.REMOTE_ZIP_BLOCK_SIZE)
+    try:
+        log.debug(f'Reading central directory of {url}')
+        with zipfile.ZipFile(fileobj) as zip_file:
+            yield zip_file
+    finally:
+        fileobj.close()
+
+
+def zip_stats(zip_file: zipfile.ZipFile) -> Dict[str, int]:
+    """Number of requests and bytes received for a zip file opened by open_remote_zip()"""
+    raw = zip_file.fp.raw
+    return dict(requests=raw.n_requests, bytes=raw.n_bytes)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Retry policy of downloads: transient errors (connection errors, stalls, 408, 429 and 5xx statuses) are retried
+#  with exponential backoff and jitter, or after the delay asked by the server in Retry-After.
+#  Failures are counted per host by a circuit breaker; a host that fails Defaults.CIRCUIT_FAILURES times in a row is
+#  not contacted for Defaults.CIRCUIT_COOLDOWN seconds, and then one request is let through to probe it.
+#  Meanwhile, downloads from the host fail fast with HostUnavailable, and downloads from other hosts proceed.
+#  Stalls are detected by the read timeout of requests, Defaults.STALL_TIMEOUT seconds without bytes.
+#
+# Created: 10/18/26
+
+import email.utils
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+from urllib.parse import urlparse
+
+import requests
+
+from mtdata import log, MTDataException, Defaults
+
+T = TypeVar('T')
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class HttpStatusError(MTDataException):
+
+    def __init__(self, url: str, response: requests.Response):
+        super().__init__(f'{url} returned HTTP status {response.status_code}')
+        self.url = url
+        self.status = response.status_code
+        self.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+
+class HostUnavailable(MTDataException):
+    """Host has failed repeatedly, and is not contacted until its cooldown ends"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait, from Retry-After header, which is either seconds or an HTTP date; None if absent or invalid"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def check_status(url: str, response: requests.Response, ok=(200,)) -> requests.Response:
+    """Returns response if its status is ok; else closes it and raises HttpStatusError"""
+    if response.status_code not in ok:
+        if int(response.headers.get('Content-Length', 2**20)) < 2**16:
+            response.content  # read the small body, so that the connection can be reused
+        response.close()
+        raise HttpStatusError(url, response)
+    return response
+
+
+def raise_transient(url: str, response: requests.Response) -> requests.Response:
+    """Raises HttpStatusError if status of response is transient; else returns response"""
+    if response.status_code in RETRY_STATUSES:
+        return check_status(url, response, ok=())
+    return response
+
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, HttpStatusError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                              requests.exceptions.Timeout))
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).hostname or 'nohost'
+
+
+class CircuitBreaker:
+    """Consecutive failures per host; see module doc"""
+
+    def __init__(self, max_failures: int = None, cooldown: float = None):
+        self.max_failures = max_failures or Defaults.CIRCUIT_FAILURES
+        self.cooldown = cooldown or Defaults.CIRCUIT_COOLDOWN
+        self.failures: Dict[str, int] = {}
+        self.opened: Dict[str, float] = {}  # host -> time when the circuit was opened
+        self.probing = set()  # hosts which have a request in flight after cooldown
+        self.lock = threading.Lock()
+
+    def check(self, url: str):
+        """Raises HostUnavailable if requests to the host of url should not be made now"""
+        host = host_of(url)
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return
+            wait = opened + self.cooldown - time.monotonic()
+            if wait > 0 or host in self.probing:
+                raise HostUnavailable(f'{host} failed {self.failures[host]} times in a row; not trying it'
+                                      f' for {max(wait, 0):.0f}s more')
+            self.probing.add(host)  # half-open: let this request through
+
+    def is_closed(self, url: str) -> bool:
+        """Checks if host of url is working normally"""
+        return host_of(url) not in self.opened
+
+    def success(self, url: str):
+        host = host_of(url)
+        with self.lock:
+            if host in self.opened:
+                log.info(f'{host} is back')
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+            self.probing.discard(host)
+
+    def failure(self, url: str):
+        host = host_of(url)
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            self.probing.discard(host)
+            if self.failures[host] >= self.max_failures:
+                if host not in self.opened:
+                    log.warning(f'{host} failed {self.failures[host]} times in a row; pausing requests to it'
+                                f' for {self.cooldown:.0f}s')
+                self.opened[host] = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.failures.clear()
+            self.opened.clear()
+            self.probing.clear()
+
+
+breaker = CircuitBreaker()
+
+
+class RetryPolicy:
+
+    def __init__(self, retries: int = None, backoff: float = None, max_wait: float = None,
+                 breaker: CircuitBreaker = breaker):
+        """
+        :param retries: max retries of a call
+        :param backoff: seconds to wait before the first retry; doubled for each retry after
+        :param max_wait: max seconds to wait before a retry, including Retry-After
+        """
+        self.retries = Defaults.DOWNLOAD_RESUMES if retries is None else retries
+        self.backoff = Defaults.RETRY_BACKOFF if backoff is None else backoff
+        self.max_wait = Defaults.RETRY_MAX_WAIT if max_wait is None else max_wait
+        self.breaker = breaker
+
+    def wait_time(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait before retry number attempt (starts at 1)"""
+        if retry_after is not None:
+            return min(retry_after, self.max_wait)
+        wait = self.backoff * 2 ** (attempt - 1)
+        return min(wait * random.uniform(0.5, 1.0), self.max_wait)  # jitter, so that threads dont retry in sync
+
+    def run(self, url: str, func: Callable[[], T], desc: str = None) -> T:
+        """
+        Calls func, which makes requests to url, and retries it on transient errors.
+        :raises HostUnavailable: if the circuit of host is open
+        """
+        attempt = 0
+        while True:
+            self.breaker.check(url)
+            try:
+                result = func()
+            except Exception as e:
+                if not is_transient(e):
+                    self.breaker.success(url)  # the host responded, or the error is not of the host
+                    raise
+                self.breaker.failure(url)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                wait = self.wait_time(attempt, getattr(e, 'retry_after', None))
+                log.warning(f'{desc or url} failed: {e}\n retrying in {wait:.1f}s [{attempt}/{self.retries}]')
+                time.sleep(wait)
+                continue
+            self.breaker.success(url)
+            return result
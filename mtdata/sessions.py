@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Pool of HTTP sessions, one per host, shared by downloads and HEAD requests of a process.
+#  Sessions keep connections alive, so requests to the same host after the first one skip DNS, TCP and TLS handshakes.
+#  Requests of mtdata are retried by mtdata.retry, which also tracks failing hosts, so the adapters of these sessions
+#  do not retry; nested retries would multiply the attempts (and the time to fail) of an unreachable host.
+#  Sessions of huggingface_hub, whose requests are not retried by mtdata, have retrying adapters; see make_retry().
+#  Worker processes create their own sessions; sessions are never shared across processes.
+#
+# Created: 10/18/26
+
+import os
+import threading
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mtdata import __version__, Defaults
+
+headers = {'User-Agent': f'mtdata downloader {__version__}; cURL and wget like.'}
+
+_sessions: Dict[Tuple[int, str], requests.Session] = {}
+_lock = threading.Lock()
+
+
+def make_retry() -> Retry:
+    return Retry(total=Defaults.HTTP_RETRIES, connect=Defaults.HTTP_RETRIES, read=0,
+                 status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET', 'HEAD'),
+                 backoff_factor=0.5, respect_retry_after_header=True, raise_on_status=False)
+
+
+def make_session(pool_size: int = None, retries=False) -> requests.Session:
+    """
+    New session with keep-alive connection pool of pool_size
+    :param retries: if the adapters retry connection errors and transient statuses; see module doc
+    """
+    pool_size = pool_size or Defaults.HTTP_POOL_SIZE
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=make_retry() if retries else 0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    """Session of this process for the host of url"""
+    key = (os.getpid(), urlparse(url).hostname or 'nohost')
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = make_session()
+    return session
+
+
+def close_sessions():
+    with _lock:
+        for (pid, _), session in list(_sessions.items()):
+            if pid == os.getpid():
+                session.close()
+        _sessions.clear()
+
+
+def configure_huggingface():
+    """Makes huggingface_hub use pooled sessions, if its version has requests backend"""
+    try:
+        from huggingface_hub import configure_http_backend
+    except ImportError:  # not installed, or newer versions which use httpx
+        return False
+    configure_http_backend(backend_factory=lambda: make_session(retries=True))
+    return True
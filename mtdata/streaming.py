@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Parsing of downloads while they are in progress. The downloader tees the bytes to the cache file and to a TeeStream;
+#  the parser reads the stream through StreamPath, a path-like object that IO.reader() can open (decompressing .gz
+#  and .xz). The queue between them is bounded, so the faster side waits for the slower one.
+#  If the download restarts from the beginning (e.g. a retry, and the server ignored the range request), the stream
+#  stops taking chunks, the download continues to the file, and the reader continues from the completed file, after
+#  the bytes it has read; these bytes are checked to be the same in the file. See Cache.stream_entry()
+#
+# Created: 10/18/26
+
+import gzip
+import io
+import lzma
+import queue
+import threading
+import zlib
+from pathlib import Path
+from typing import Callable, Optional
+
+from mtdata import log, MTDataException, Defaults
+
+DECOMPRESSORS = {
+    '.gz': lambda stream: gzip.GzipFile(fileobj=stream, mode='rb'),
+    '.xz': lambda stream: lzma.LZMAFile(stream),
+}
+
+
+class StreamCancelled(MTDataException):
+    pass
+
+
+class TeeStream(io.RawIOBase):
+    """Bytes of a download, readable while the download is in progress"""
+
+    def __init__(self, max_chunks: int = None, path: Optional[Path] = None):
+        """
+        :param path: file to which the download is saved; the reader continues from it if the download restarts
+        """
+        super().__init__()
+        self.queue = queue.Queue(maxsize=max_chunks or Defaults.STREAM_QUEUE_SIZE)
+        self.path = path
+        self.received = 0
+        self.crc = 0   # of received bytes
+        self.detached = False  # download restarted, so the rest is read from path
+        self.error: Optional[BaseException] = None
+        self.cancelled = threading.Event()
+        self._buf = memoryview(b'')
+        self._eof = False
+        self._file = None
+
+    def readable(self) -> bool:
+        return True
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def put(self, pos: int, chunk: bytes):
+        """Adds chunk, which is at byte pos of the download; called by downloader"""
+        if self.detached:
+            return
+        if pos != self.received:
+            # e.g. server did not resume, and the download restarted; the parser cannot go back
+            if not self.path:
+                raise MTDataException(f'Download restarted at byte {pos:,} after {self.received:,} bytes were parsed')
+            log.info(f'Download restarted at byte {pos:,} after {self.received:,} bytes were parsed; the rest'
+                     f' is parsed after the download completes')
+            self.detached = True
+            return
+        self.received += len(chunk)
+        self.crc = zlib.crc32(chunk, self.crc)
+        if not self._put(chunk):
+            raise StreamCancelled('Reader of the stream is closed')
+
+    def run(self, download: Callable[[], None]):
+        """Runs download (which calls put()), and ends the stream; error of download is raised to the reader"""
+        try:
+            download()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def readinto(self, buf) -> int:
+        if self._file:
+            return self._file.readinto(buf)
+        while not self._buf:
+            if self._eof:
+                return 0
+            item = self.queue.get()
+            if item is None:
+                self._eof = True
+                if self.error is not None:
+                    raise self.error
+                if self.detached:
+                    self._open_file()
+                    return self._file.readinto(buf)
+                return 0
+            self._buf = memoryview(item)
+        n = min(len(buf), len(self._buf))
+        buf[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def _open_file(self):
+        """Opens the completed download, after the bytes that were read from the stream"""
+        fh = open(self.path, 'rb')
+        crc, left = 0, self.received
+        while left:
+            chunk = fh.read(min(left, 2**20))
+            if not chunk:
+                break
+            crc, left = zlib.crc32(chunk, crc), left - len(chunk)
+        if left or crc != self.crc:
+            fh.close()
+            raise MTDataException(f'{self.path} has changed during download; the parsed bytes differ from it')
+        self._file = fh
+
+    def close(self):
+        if self._file:
+            self._file.close()
+        super().close()
+
+    def drain(self):
+        """
+        Discards the rest of the stream until the download ends, even if it is closed by the reader;
+        raises the error of download, if any
+        """
+        while not self._eof:
+            if self.queue.get() is None:
+                self._eof = True
+                if self.error is not None:
+                    raise self.error
+
+    def cancel(self):
+        """Stops the downloader, e.g. when parsing failed"""
+        self.cancelled.set()
+
+
+class StreamPath:
+    """Path-like view of a TeeStream, for Parser; it can be opened only once"""
+
+    def __init__(self, name: str, stream: TeeStream, compression: str = ''):
+        """
+        :param name: name of the file, e.g. for detecting its extension
+        :param compression: '.gz', '.xz', or '' for uncompressed
+        """
+        assert not compression or compression in DECOMPRESSORS, f'{compression} is not supported'
+        self.name = name
+        self.stream = stream
+        self.compression = compression
+        self._opened = False
+
+    @property
+    def suffix(self) -> str:
+        return ''  # IO.reader() opens it with open(), which decompresses
+
+    def exists(self) -> bool:
+        return True
+
+    def open(self, mode='rt', **kwargs):
+        assert mode in ('r', 'rt', 'rb'), f'only read is supported, given: {mode}'
+        assert not self._opened, f'{self.name} is a stream; it can be read only once'
+        self._opened = True
+        stream = io.BufferedReader(self.stream, buffer_size=2**16)
+        if self.compression:
+            stream = DECOMPRESSORS[self.compression](stream)
+        if 'b' in mode:
+            return stream
+        return io.TextIOWrapper(stream, **kwargs)
+
+    def __str__(self):
+        return f'{self.name} (stream)'
@@ -26,15 +26,17 @@ def parse_tmx(data, log_every=DEF_PROGRESS):
     st = t = time.time()
     for tu in tus:
         lang_seg = {}
+        tuvs = []
         for tuv in tu.findall('tuv'):
             lang = [v for k, v in tuv.attrib.items() if k.endswith('lang')]
             seg = tuv.findtext('seg')
             if lang and seg:
-                lang = bcp47(lang[0])
-                seg = unescape(seg.strip()).replace('\n', ' ').replace('\t', ' ')
-                if lang in lang_seg:
-                    log.warning(f"Language {lang} appears twice in same translation unit.")
-                lang_seg[lang] = seg
+                tuvs.append((lang[0], seg))
+        for lang, (_, seg) in zip(bcp47.parse_many(lang for lang, _ in tuvs), tuvs):
+            seg = unescape(seg.strip()).replace('\n', ' ').replace('\t', ' ')
+            if lang in lang_seg:
+                log.warning(f"Language {lang} appears twice in same translation unit.")
+            lang_seg[lang] = seg
         yield lang_seg
         count += 1
         if log_every and (time.time() - t) > log_every:
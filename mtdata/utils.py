@@ -3,10 +3,13 @@
 # Author: Thamme Gowda [tg (at) isi (dot) edu] 
 # Created: 5/13/20
 import bz2
+import fnmatch
 import gzip
 import io
+import json
 import lzma
 import os
+import re
 import shutil
 import subprocess
 import tarfile
@@ -14,8 +17,7 @@ import zipfile
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-
-import portalocker
+from typing import List, Optional
 
 from mtdata import Defaults, log
 from mtdata.pigz import pigz, xz_subprocess, bzip2_subprocess
@@ -180,13 +182,16 @@ class ZipPath (ArchivedPath):
 
 @dataclass
 class TarPath(ArchivedPath):
+    """
+    Path of a file inside a tarball; name is a glob pattern that should match exactly one file.
+    Only the matched member is extracted (to extracted_name() dir next to the tarball), not the whole tarball.
+    The member listing of the tarball is cached (see members()), so later lookups of other members stop
+    reading the tarball as soon as the wanted member is found.
+    """
 
     def __post_init__(self):
-        self.ext_dir = self.extract()
-        matches = list(self.ext_dir.glob(self.name))
-        if len(matches) != 1:
-            raise Exception(f'expected to find exactly one path inside tarball @ {self.ext_dir}/{self.name}, but found {matches}')
-        self.child = matches[0]
+        self.child = self.extract_member()
+        self.ext_dir = self.root.parent / self.extracted_name()
         self.open = self.child.open
 
     def exists(self):
@@ -207,44 +212,110 @@ class TarPath(ArchivedPath):
         reader.close = close   # hijack
         return reader
 
-    def extract(self):
-        dir_name = self.extracted_name()
-        out_path = self.root.parent / dir_name
-        valid_path = self.root.parent / (dir_name + '.valid')
-        lock_path = self.root.parent / (dir_name + '.lock')
-        if not valid_path.exists():
-            with portalocker.Lock(lock_path, 'w', timeout=Defaults.FILE_LOCK_TIMEOUT) as _:
-                if valid_path.exists():
-                    return   # extracted by parallel process
-                log.info(f"extracting {self.root}")
-                with tarfile.open(self.root) as tar:
-                    import os
-                    def is_within_directory(directory, target):
-                        abs_directory = os.path.abspath(directory)
-                        abs_target = os.path.abspath(target)
-                        prefix = os.path.commonprefix([abs_directory, abs_target])
-                        return prefix == abs_directory
-
-                    def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-
-                        for member in tar.getmembers():
-                            member_path = os.path.join(path, member.name)
-                            if not is_within_directory(path, member_path):
-                                raise Exception("Attempted Path Traversal in Tar File")
-
-                        tar.extractall(path, members, numeric_owner=numeric_owner) 
-
-
-                    safe_extract(tar, out_path)
-                valid_path.touch()
-        return out_path
+    @classmethod
+    def glob_match(cls, name: str, pattern: str) -> bool:
+        """Matches member name with glob pattern, with the semantics of Path.glob (i.e. * does not match /)"""
+        return cls._match_parts(name.split('/'), pattern.split('/'))
+
+    @classmethod
+    def _match_parts(cls, names: List[str], patterns: List[str]) -> bool:
+        if not patterns:
+            return not names
+        if patterns[0] == '**':  # zero or more directories
+            return any(cls._match_parts(names[i:], patterns[1:]) for i in range(len(names) + 1))
+        return bool(names) and fnmatch.fnmatchcase(names[0], patterns[0]) \
+            and cls._match_parts(names[1:], patterns[1:])
+
+    @staticmethod
+    def member_name(info: tarfile.TarInfo) -> str:
+        name = info.name
+        while name.startswith('./'):
+            name = name[2:]
+        if name.startswith('/') or '..' in name.split('/'):
+            raise Exception(f"Attempted Path Traversal in Tar File: {info.name}")
+        return name
+
+    @property
+    def members_file(self) -> Path:
+        return self.root.with_name(self.root.name + '.members.json')
+
+    def members(self) -> Optional[List[str]]:
+        """Cached listing of files in the tarball; None if not cached or the tarball has changed"""
+        stat = self.root.stat()
+        try:
+            data = json.loads(self.members_file.read_text())
+        except (OSError, ValueError):
+            return None
+        if data.get('size') != stat.st_size or data.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+        return data['members']
+
+    def save_members(self, members: List[str]):
+        stat = self.root.stat()
+        tmp = self.members_file.with_name(self.members_file.name + f'.tmp{os.getpid()}')
+        tmp.write_text(json.dumps(dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, members=members)))
+        os.replace(tmp, self.members_file)
+
+    def find_member(self, members: List[str]) -> str:
+        matches = [m for m in members if self.glob_match(m, self.name)]
+        if len(matches) != 1:
+            raise Exception(f'expected to find exactly one path inside tarball @ {self.root}/{self.name},'
+                            f' but found {matches}')
+        return matches[0]
+
+    def extract_member(self) -> Path:
+        out_dir = self.root.parent / self.extracted_name()
+        if (self.root.parent / (self.extracted_name() + '.valid')).exists():  # fully extracted by older versions
+            matches = list(out_dir.glob(self.name))
+            if len(matches) != 1:
+                raise Exception(f'expected to find exactly one path inside tarball @ {out_dir}/{self.name},'
+                                f' but found {matches}')
+            return matches[0]
+        members = self.members()
+        if members is not None:
+            target = out_dir / self.find_member(members)
+            if target.exists():
+                return target
+        import portalocker
+        lock_path = self.root.parent / (self.extracted_name() + '.lock')
+        with portalocker.Lock(lock_path, 'w', timeout=Defaults.FILE_LOCK_TIMEOUT) as _:
+            members = self.members()  # parallel process may have listed it while we waited
+            wanted = members is not None and self.find_member(members)
+            if wanted and (out_dir / wanted).exists():
+                return out_dir / wanted
+            log.info(f"extracting {self.root}?{self.name}")
+            listing = []
+            with tarfile.open(self.root) as tar:
+                for info in tar:
+                    if not (info.isfile() or info.issym() or info.islnk()):
+                        continue
+                    name = self.member_name(info)
+                    listing.append(name)
+                    if (name == wanted or not wanted and self.glob_match(name, self.name)) \
+                            and not (out_dir / name).exists():
+                        target = out_dir / name
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        tmp = target.with_name(target.name + f'.tmp{os.getpid()}')
+                        with tar.extractfile(info) as inp, open(tmp, 'wb') as out:
+                            shutil.copyfileobj(inp, out, length=2**20)
+                        os.replace(tmp, target)
+                        if wanted:  # listing is known; no need to read the rest
+                            break
+            if members is None:
+                self.save_members(listing)
+                members = listing
+        return out_dir / self.find_member(members)
 
     def extracted_name(self):
+        return self.extracted_dir_name(self.root.name)
+
+    @staticmethod
+    def extracted_dir_name(name: str) -> str:
+        """Name of the dir to which members of tarball with the given file name are extracted"""
         exts = ['.tar', '.tar.gz', '.tar.bz2', '.tar.xz']
-        name = self.root.name
         dir_name = name + '-extracted'
         for ext in exts:
-            if self.root.name.endswith(ext):
+            if name.endswith(ext):
                 dir_name = name[:-len(ext)]
                 break
         return dir_name
@@ -255,6 +326,62 @@ def format_byte_size(n: int) -> str:
     for power, unit in [(12, 'TB'), (9, 'GB'), (6, 'MB'), (3, 'kB')]:
         if n >= (10 ** power):
             m = n / 10 ** power
-            return f'{m:.2f}'.rstrip('0') + f' {unit}'
+            return f'{m:.2f}'.rstrip('0').rstrip('.') + f' {unit}'
     return f'{n}B'
 
+
+def parse_byte_size(size: str) -> int:
+    """parses human readable size such as 2TB, 1.5 GiB, 500m or 1024 into byte count; units are case insensitive.
+    Inverse of format_byte_size, up to its rounding"""
+    match = re.fullmatch(r'(?i)\s*([0-9.]+)\s*([kmgtp]?)(i?)b?\s*', str(size))
+    if not match:
+        raise ValueError(f'Invalid size {size!r}; expected a number with optional unit such as kB, MB, GB, TB or GiB')
+    num, unit, binary = match.groups()
+    power = ' KMGTP'.index(unit.upper()) if unit else 0
+    return int(float(num) * (1024 if binary else 1000) ** power)
+
+
+
+class LazyProxy:
+    """Stand-in for an object that is expensive to create (e.g. dataset index).
+    The object is created by calling factory on the first access of its attributes.
+    """
+    __slots__ = ('_factory', '_obj')
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_obj', None)
+
+    def _get_obj(self):
+        if self._obj is None:
+            object.__setattr__(self, '_obj', self._factory())
+        return self._obj
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._obj is not None
+
+    def __getattr__(self, name):
+        return getattr(self._get_obj(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_obj(), name, value)
+
+    # special methods are looked up on type, not the instance, so __getattr__ doesnt cover them
+    def __contains__(self, item):
+        return item in self._get_obj()
+
+    def __getitem__(self, item):
+        return self._get_obj()[item]
+
+    def __iter__(self):
+        return iter(self._get_obj())
+
+    def __len__(self):
+        return len(self._get_obj())
+
+    def __bool__(self):
+        return bool(self._get_obj())
+
+    def __repr__(self):
+        return repr(self._get_obj()) if self.is_loaded else f'LazyProxy({self._factory!r})'
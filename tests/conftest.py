@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+#
+# Fixtures shared by all tests
+#
+# Created: 10/18/26
+
+from pathlib import Path
+
+import pytest
+
+DATA_DIR = Path(__file__).parent / 'data'
+
+
+@pytest.fixture(scope='session', autouse=True)
+def opus_index():
+    """
+    The OPUS index (resource/opus_index.tsv) is refreshed from OPUS and may be missing in a source tree;
+    a small sample in tests/data is used in its place. The index and the OPUS segment are built here, in the cache dir
+    of the tests (MTDATA), so that the CLI tests, which run in subprocesses, load them from there.
+    """
+    from mtdata.index import Index
+    from mtdata.index.opus import opus_index as opus_mod
+    with pytest.MonkeyPatch.context() as patch:
+        if not opus_mod.data_file.exists():
+            patch.setattr(opus_mod, 'data_file', DATA_DIR / 'opus_index.tsv')
+        mod_name = '.opus.opus_index'
+        Index.get_segment(mod_name, Index.get_sub_modules()[mod_name])   # the index may be older than the segment
+        Index.get_instance()
+        yield opus_mod.data_file
@@ -102,3 +102,38 @@ def test_bcp47_express():
     assert bcp47e("kn-Knda") == ('kan', 'Knda', None, 'kan_Knda')         # default script, keep
     assert bcp47e("kn_Deva_IN") == ('kan', 'Deva', 'IN', 'kan_Deva_IN')  # Non default, keep
     
+
+def test_bcp47_cache():
+    from mtdata.iso.bcp47 import BCP47Parser
+    parser = BCP47Parser()
+    tags = [f'en_{region}' for region in parser.countries] + [f'hi_{script}' for script in parser.scripts]
+    for tag in tags * 2:
+        assert parser(tag) == bcp47(tag)
+    assert len(parser._cache) == len(tags)   # no eviction
+
+def test_parse_many():
+    tags = ['en', 'en_US', 'English', bcp47('de'), 'kn-Knda-IN', 'en']
+    assert bcp47.parse_many(tags) == [bcp47(tag) for tag in tags]
+    assert bcp47.parse_many([]) == []
+    try:
+        bcp47.parse_many(['en', 'en-Latn-UK'])
+        fail("UK is not ISO country code")
+    except ValueError:
+        pass  # expected
+
+
+def test_compat_memo():
+    from mtdata.iso.bcp47 import tag_id
+    assert tag_id(bcp47('en')) == tag_id(bcp47('eng')) != tag_id(bcp47('en_US'))
+    en, en_us, en_gb, de = bcp47.parse_many(['en', 'en_US', 'en_GB', 'de'])
+    for _ in range(2):  # second round is from memo
+        assert en.is_compatible(en_us) and en_us.is_compatible(en)
+        assert not en_us.is_compatible(en_gb)
+        assert BCP47Tag.check_compat_swap((en, de), (de, en_us)) == (True, True)
+        assert BCP47Tag.check_compat_swap((en, de), (en_gb, de)) == (True, False)
+        assert BCP47Tag.check_compat_swap((en_us, de), (en_gb, de)) == (False, False)
+        try:
+            BCP47Tag.check_compat_swap((en_us, de), (en_gb, de), fail_on_incompat=True)
+            fail("Expected an exception")
+        except Exception as e:
+            assert 'Unable to match' in str(e)
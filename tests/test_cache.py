@@ -0,0 +1,767 @@
+#!/usr/bin/env python
+#
+# Tests of downloads in mtdata.cache against a local HTTP server
+# Created: 10/18/26
+
+import collections
+import email.utils
+import gzip
+import hashlib
+import io
+import os
+import socket
+import tarfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import portalocker
+import pytest
+import requests
+
+from mtdata import Defaults, MTDataUserError
+from mtdata import plan as plan_mod
+from mtdata import cache as cache_mod
+from mtdata.cache import Cache, TokenBucket, parse_content_range
+from mtdata.entry import Entry
+from mtdata.retry import breaker, parse_retry_after, RetryPolicy, HostUnavailable, HttpStatusError
+from mtdata.utils import parse_byte_size, format_byte_size, TarPath
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+    files = {}   # path -> content
+    etags = {}   # path -> etag
+    drop_after = {}  # path -> number of bytes after which connection is dropped, once
+    no_ranges = set()  # paths for which range requests are ignored
+    accept_ranges = 'bytes'  # Accept-Ranges header of paths that support ranges
+    requests = []  # (method, path, Range header)
+    errors = {}  # path -> list of statuses to respond with, before the content
+    clients = set()  # client addresses
+    delay = 0  # seconds to wait before sending body
+    stalls = {}  # path -> seconds to pause in the middle of body, once
+    retry_after = None  # Retry-After header of error responses
+    active = [0, 0]  # current, max concurrent requests
+    active_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, data: bytes, status=200, start=0, total=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', self.etags.get(self.path, '"v1"'))
+        if self.path not in self.no_ranges:
+            self.send_header('Accept-Ranges', self.accept_ranges)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{start + len(data) - 1}/{total}')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        stall = self.stalls.pop(self.path, None)
+        if stall:
+            self.wfile.write(data[:len(data) // 2])
+            self.wfile.flush()
+            time.sleep(stall)
+            try:
+                self.wfile.write(data[len(data) // 2:])
+            except OSError:  # client gave up
+                pass
+            self.close_connection = True
+            return
+        limit = self.drop_after.pop(self.path, None)
+        if limit is not None:
+            self.wfile.write(data[:limit])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+    def do_GET(self):
+        with self.active_lock:
+            self.active[0] += 1
+            self.active[1] = max(self.active)
+        try:
+            time.sleep(self.delay)
+            self.respond()
+        finally:
+            with self.active_lock:
+                self.active[0] -= 1
+
+    def respond(self):
+        rng = self.headers.get('Range')
+        self.requests.append((self.command, self.path, rng))
+        self.clients.add(self.client_address)
+        if self.path not in self.files or self.errors.get(self.path):
+            self.send_response(self.errors[self.path].pop(0) if self.errors.get(self.path) else 404)
+            if self.retry_after is not None:
+                self.send_header('Retry-After', self.retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.files[self.path]
+        if_range = self.headers.get('If-Range')
+        etag = self.etags.get(self.path, '"v1"')
+        if rng and self.path not in self.no_ranges and (not if_range or if_range == etag):
+            start, end = rng.replace('bytes=', '').split('-')
+            start, end = int(start), int(end) if end else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_body(data[start:end + 1], status=206, start=start, total=len(data))
+        else:
+            self.send_body(data)
+
+    do_HEAD = do_GET
+
+
+@pytest.fixture
+def server():
+    Handler.files.clear()
+    Handler.etags.clear()
+    Handler.drop_after.clear()
+    Handler.no_ranges.clear()
+    Handler.requests.clear()
+    Handler.errors.clear()
+    Handler.clients.clear()
+    Handler.delay = 0
+    Handler.stalls.clear()
+    Handler.retry_after = None
+    Handler.accept_ranges = 'bytes'
+    breaker.reset()
+    cache_mod.failed_heads.clear()
+    Handler.active[:] = [0, 0]
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_parse_content_range():
+    assert parse_content_range('bytes 100-199/1000') == (100, 1000)
+    assert parse_content_range('bytes */1000') == (None, 1000)
+    assert parse_content_range('bytes 0-9/*') == (0, None)
+    assert parse_content_range(None) == (None, None)
+
+
+def test_download(server, tmp_path):
+    data = os.urandom(100_000)
+    Handler.files['/data.gz'] = data
+    cache = Cache(tmp_path)
+    path = cache.get_local_path(f'{server}/data.gz')
+    assert path.read_bytes() == data
+    assert cache.get_flag_file(path).exists()
+    assert not cache.get_part_file(path).exists()
+
+
+def test_download_resume(server, tmp_path):
+    data = os.urandom(300_000)
+    Handler.files['/big.tsv'] = data
+    Handler.drop_after['/big.tsv'] = 200_000
+    cache = Cache(tmp_path)
+    path = cache.get_local_path(f'{server}/big.tsv')
+    assert path.read_bytes() == data
+    (_, _, first), (_, _, second) = Handler.requests
+    assert first is None and second.startswith('bytes=') and second != 'bytes=0-'
+    assert cache.db.get_file(cache.rel_path(path))['checksum'] == 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def test_download_resume_later(server, tmp_path):
+    """Partial content from a failed run is resumed by the next run; unless the file has changed"""
+    data = os.urandom(100_000)
+    url = f'{server}/file.txt'
+    Handler.files['/file.txt'] = data
+    cache = Cache(tmp_path)
+    path = cache.get_local_path(url, fix_missing=False)
+    path.parent.mkdir(parents=True)
+    part = cache.get_part_file(path)
+    cache.get_part_meta_file(part).write_text(f'{{"url": "{url}", "etag": "\\"v1\\""}}')
+    part.write_bytes(data[:60_000])
+    cache.download(url, path)
+    assert path.read_bytes() == data
+    assert Handler.requests[-1][2] == 'bytes=60000-'
+
+    # the file on server changed; so the partial content is discarded
+    path2 = tmp_path / 'file2.txt'
+    part = cache.get_part_file(path2)
+    cache.get_part_meta_file(part).write_text(f'{{"url": "{url}", "etag": "\\"v0\\""}}')
+    part.write_bytes(b'x' * 60_000)
+    cache.download(url, path2)
+    assert path2.read_bytes() == data
+
+
+def test_download_no_range_support(server, tmp_path):
+    data = os.urandom(100_000)
+    Handler.files['/plain.txt'] = data
+    Handler.drop_after['/plain.txt'] = 50_000
+    Handler.no_ranges.add('/plain.txt')
+    cache = Cache(tmp_path)
+    path = cache.get_local_path(f'{server}/plain.txt')
+    assert path.read_bytes() == data
+
+
+@pytest.fixture
+def segments(monkeypatch):
+    monkeypatch.setattr(cache_mod, 'download_segments', 4)
+    monkeypatch.setattr(Defaults, 'SEGMENT_MIN_SIZE', 1000)
+
+
+def test_download_segmented(server, segments, tmp_path, monkeypatch):
+    data = os.urandom(1_000_003)
+    Handler.files['/seg.tar'] = data
+    Handler.drop_after['/seg.tar'] = 10_000   # one of the segments is interrupted and resumed
+    cache = Cache(tmp_path)
+    path = cache.get_local_path(f'{server}/seg.tar')
+    assert path.read_bytes() == data
+    gets = [rng for method, _, rng in Handler.requests if method == 'GET']
+    assert len(gets) == 5 and all(gets)
+
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 0.01)
+    Handler.requests.clear()
+    Handler.files['/seg2.tar'] = data
+    Handler.errors['/seg2.tar'] = [503]   # HEAD goes through the retry policy
+    assert cache.get_local_path(f'{server}/seg2.tar').read_bytes() == data
+    sent = [(method, bool(rng)) for method, _, rng in Handler.requests]
+    assert sent == [('HEAD', False)] * 2 + [('GET', True)] * 4
+
+
+def test_download_segmented_fallback(server, segments, tmp_path):
+    cache = Cache(tmp_path)
+    small = os.urandom(100)
+    Handler.files['/small.txt'] = small
+    assert cache.get_local_path(f'{server}/small.txt').read_bytes() == small
+
+    data = os.urandom(100_000)
+    Handler.files['/norange.txt'] = data
+    Handler.no_ranges.add('/norange.txt')
+    assert cache.get_local_path(f'{server}/norange.txt').read_bytes() == data
+    assert [m for m, path, _ in Handler.requests if path == '/norange.txt'] == ['HEAD', 'GET']
+
+
+def test_keep_alive_and_retries(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 0.01)
+    cache = Cache(tmp_path)
+    files = {f'/file{i}.txt': os.urandom(1000) for i in range(5)}
+    Handler.files.update(files)
+    Handler.errors['/file2.txt'] = [503, 502]
+    for path, data in files.items():
+        assert cache.get_local_path(f'{server}{path}').read_bytes() == data
+        assert cache.head(f'{server}{path}')['length'] == len(data)   # recorded by the download
+        assert cache.head_source(f'{server}{path}')['length'] == len(data)
+    assert len(Handler.requests) == 2 * len(files) + 2
+    assert len(Handler.clients) == 1  # a single connection
+
+
+def test_parse_byte_size():
+    assert parse_byte_size('2TB') == 2 * 10**12
+    assert parse_byte_size('1.5 GiB') == 1.5 * 2**30
+    assert parse_byte_size('500M') == parse_byte_size('500m') == 500 * 10**6
+    assert parse_byte_size('10g') == parse_byte_size('10 gb') == 10 * 10**9
+    for size in [1000, 1_500_000, 2 * 10**12, 512]:
+        assert parse_byte_size(format_byte_size(size)) == size
+    assert format_byte_size(10**6) == '1 MB'
+    assert parse_byte_size(1024) == 1024
+    with pytest.raises(ValueError):
+        parse_byte_size('2 furlongs')
+
+
+def test_get_entries(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(Defaults, 'HOST_CONNECTIONS', 3)
+    monkeypatch.setattr(cache_mod, '_host_locks', {})
+    Handler.delay = 0.05
+    entries = []
+    for i in range(12):
+        Handler.files[f'/f{i}.tsv'] = f'hello{i}\tworld{i}\n'.encode()
+        entries.append(Entry(did=f'Test-data{i}-1-eng-deu', url=f'{server}/f{i}.tsv'))
+    entries.append(Entry(did='Test-missing-1-eng-deu', url=f'{server}/missing.tsv'))
+    result = Cache(tmp_path).get_entries(entries, n_jobs=8)
+    assert result.pop(entries[-1]) is None
+    for i, (entry, path) in enumerate(sorted(result.items(), key=lambda x: int(x[0].did.name[4:]))):
+        assert path.read_text() == f'hello{i}\tworld{i}\n'
+    assert Handler.active[1] == 3
+
+    # threads that meet a new host at the same time get the same semaphore
+    barrier, sems = threading.Barrier(8), []
+
+    def get_semaphore():
+        barrier.wait()
+        sems.append(cache_mod.host_semaphore('http://new.invalid/x'))
+    threads = [threading.Thread(target=get_semaphore) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(sems) == 8 and len(set(map(id, sems))) == 1
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1_000_000)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [bucket.consume(50_000) for _ in range(4)]) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.monotonic() - start >= 0.35   # 400kB at 1MB/s
+
+
+def test_schedule(server, tmp_path):
+    cache = Cache(tmp_path)
+    sizes = dict(a=5000, b=3000, c=4000, d=100, e=2000)
+    hosts = dict(a=server, b=server, c=server.replace('127.0.0.1', 'localhost'),
+                 d=server.replace('127.0.0.1', 'localhost'), e=server)
+    entries = {}
+    for name, size in sizes.items():
+        Handler.files[f'/{name}.tsv'] = os.urandom(size)
+        entries[name] = Entry(did=f'Test-{name}-1-eng-deu', url=f'{hosts[name]}/{name}.tsv')
+    cache.get_entry(entries['e'])  # cached; nothing to download
+    Handler.requests.clear()
+    order = [entry.did.name for entry in cache.schedule(list(entries.values()), n_jobs=2)]
+    assert order == ['a', 'c', 'b', 'd', 'e']
+    assert sorted(path for method, path, _ in Handler.requests) == ['/a.tsv', '/b.tsv', '/c.tsv', '/d.tsv']
+    # lengths are remembered
+    Handler.requests.clear()
+    assert cache.schedule(list(entries.values()), n_jobs=2) == [entries[n] for n in order]
+    assert not Handler.requests
+    assert cache.url_content_length(f'{server}/e.tsv') == sizes['e']  # learnt from download
+    assert cache.db.host_rate('127.0.0.1') > 0
+
+
+def test_manifest(server, tmp_path):
+    cache = Cache(tmp_path)
+    Handler.files['/m1.tsv'] = b'a\tb\n'
+    Handler.files['/m2.tsv'] = b'c\td\n' * 10
+    e1 = Entry(did='Test-m1-1-eng-deu', url=f'{server}/m1.tsv')
+    e2 = Entry(did='Test-m2-1-eng-deu', url=f'{server}/m2.tsv')
+    e3 = Entry(did='Test-m1-1-eng-fra', url=f'{server}/m1.tsv')  # same file as e1
+    assert cache.cached_entries([e1, e2]) == {e1: False, e2: False}
+    path1 = cache.get_entry(e1)
+    cache.get_entry(e3)
+    assert cache.cached_entries([e1, e2, e3]) == {e1: True, e2: False, e3: True}
+    files = cache.list_files()
+    assert len(files) == 1
+    rec = files[0]
+    assert rec['url'] == e1.url and rec['size'] == 4 and rec['throughput'] > 0
+    assert sorted(rec['dids'].split()) == sorted([str(e1.did), str(e3.did)])
+    assert tmp_path / rec['path'] == path1
+
+    # downloaded without manifest
+    path2 = cache.get_entry(e2)
+    cache.db.execute('DELETE FROM files WHERE path = ?', (cache.rel_path(path2),))
+    assert cache.scan() == 1
+    assert [rec['size'] for rec in cache.list_files()] == [40, 4]  # most recent first
+
+
+def test_gc(server, tmp_path):
+    cache = Cache(tmp_path)
+    entries = []
+    for name in 'abcd':
+        Handler.files[f'/{name}.tsv'] = os.urandom(1000)
+        entries.append(Entry(did=f'Test-{name}-1-eng-deu', url=f'{server}/{name}.tsv'))
+        cache.get_entry(entries[-1])
+        time.sleep(0.01)
+    extracted = cache.get_entry(entries[0]).parent / 'a-extracted'  # a is the most recent now
+    extracted.mkdir()
+    (extracted / 'x.txt').write_bytes(os.urandom(500))
+    hf_dir = tmp_path / 'huggingface' / 'datasets' / 'some___dataset'
+    hf_dir.mkdir(parents=True)
+    (hf_dir / 'data.arrow').write_bytes(os.urandom(700))
+    os.utime(hf_dir, (0, 0))  # least recently used
+
+    units = cache.get_gc_units()
+    assert [u['size'] for u in units] == [700, 1000, 1000, 1000, 1500]
+    # this process is using all, except HF
+    assert cache.gc(max_size=3000) == [units[0]]
+    assert not hf_dir.exists()
+
+    cache.release_leases()
+    Handler.requests.clear()
+    evicted = cache.gc(max_size=3000)
+    assert [u['path'] for u in evicted] == [units[1]['path'], units[2]['path']]
+    remaining = [cache.get_entry(e) for e in entries]
+    assert [path for _, path, _ in Handler.requests] == ['/b.tsv', '/c.tsv']  # downloaded again
+    assert all(path.exists() for path in remaining)
+
+    # leases of ended processes are ignored
+    cache.release_leases()
+    cache.db.add_lease(units[3]['files'][0], 'otherhost-1234-dead')
+    assert cache.gc(max_size=0, dry_run=True)
+    assert cache.live_leases() == []
+
+    # a lease made after gc() listed the leases is checked again by evict()
+    owner = 'otherhost-1234-live'
+    (tmp_path / '.leases').mkdir(exist_ok=True)
+    with portalocker.Lock(tmp_path / '.leases' / owner, 'a'):
+        cache.db.add_lease(units[4]['files'][0], owner)
+        assert cache.live_leases(unit=units[3]) == []   # only the owners of leases in the unit are checked
+        assert not cache.evict(units[4])
+        assert (tmp_path / units[4]['files'][0]).exists() and cache.get_entry(entries[0]) == remaining[0]
+
+
+def test_checksums(server, segments, tmp_path):
+    cache = Cache(tmp_path)
+    data = {'/c1.tsv': os.urandom(300_000), '/c2.tsv': os.urandom(5000)}
+    Handler.files.update(data)
+    Handler.files['/c3.tsv'] = data['/c2.tsv']   # same content, another URL
+    Handler.drop_after['/c1.tsv'] = 100_000   # resumed
+    Handler.no_ranges.add('/c2.tsv')
+    paths = {name: cache.get_local_path(f'{server}{name}') for name in ('/c1.tsv', '/c2.tsv', '/c3.tsv')}
+    for name, path in paths.items():
+        expected = 'sha256:' + hashlib.sha256(Handler.files[name]).hexdigest()
+        assert cache.db.get_file(cache.rel_path(path))['checksum'] == expected
+
+    assert cache.dedupe() == 5000
+    assert os.path.samefile(paths['/c2.tsv'], paths['/c3.tsv'])
+
+    with open(paths['/c1.tsv'], 'r+b') as out:  # corrupt
+        out.write(b'oops')
+    result = cache.verify(n_jobs=2)
+    assert result['failed'] == [cache.rel_path(paths['/c1.tsv'])]
+    assert len(result['ok']) == 2
+    assert (tmp_path / '.quarantine' / cache.rel_path(paths['/c1.tsv'])).exists()
+    assert not cache.get_flag_file(paths['/c1.tsv']).exists()
+    assert cache.get_local_path(f'{server}/c1.tsv').read_bytes() == data['/c1.tsv']
+
+
+def make_tar(members: dict, mode='w:gz') -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def test_tar_selective_extract(server, tmp_path):
+    members = {'corpus/train.en': b'hello\n', 'corpus/train.de': b'hallo\n', './corpus/big.bin': os.urandom(10_000),
+               'corpus/dev/dev.en': b'dev\n'}
+    Handler.files['/corpus.tar.gz'] = make_tar(members)
+    cache = Cache(tmp_path)
+    entry = Entry(did='Test-tar-1-eng-deu', url=f'{server}/corpus.tar.gz', in_paths=['corpus/*.en', 'corpus/*.de'], in_ext='txt')
+    en, de = cache.get_entry(entry)
+    assert en.read_bytes() == b'hello\n' and de.read_bytes() == b'hallo\n'
+    ext_dir = en.parent.parent
+    assert sorted(str(p.relative_to(ext_dir)) for p in ext_dir.rglob('*') if p.is_file()) == \
+           ['corpus/train.de', 'corpus/train.en']
+    tarball = cache.get_local_path(entry.url, filename=entry.filename, fix_missing=False)
+    assert TarPath(tarball, 'corpus/*.en').members() == ['corpus/train.en', 'corpus/train.de', 'corpus/big.bin',
+                                                         'corpus/dev/dev.en']
+    dev = TarPath(tarball, 'corpus/**/dev.en').child
+    assert dev.read_bytes() == b'dev\n'
+    with pytest.raises(Exception, match='exactly one'):
+        TarPath(tarball, 'corpus/*')
+
+
+def make_zip(members: dict, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression=compression) as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def remote_zip(monkeypatch):
+    monkeypatch.setattr(Defaults, 'REMOTE_ZIP_MIN_SIZE', 1000)
+    monkeypatch.setattr(Defaults, 'REMOTE_ZIP_BLOCK_SIZE', 4096)
+
+
+def range_bytes(requests):
+    total = 0
+    for method, path, rng in requests:
+        assert method == 'HEAD' or rng, f'{method} {path} without range'
+        if rng:
+            start, end = rng.replace('bytes=', '').split('-')
+            total += int(end) - int(start) + 1
+    return total
+
+
+def test_remote_zip(server, remote_zip, tmp_path):
+    members = {'corpus/train.en': b'hello\n' * 1000, 'corpus/train.de': b'hallo\n' * 1000,
+               'corpus/big.bin': os.urandom(500_000)}
+    Handler.files['/corpus.zip'] = data = make_zip(members, compression=zipfile.ZIP_STORED)
+    cache = Cache(tmp_path)
+    entry = Entry(did='Test-zip-1-eng-deu', url=f'{server}/corpus.zip', in_paths=['corpus/*.en', 'corpus/*.de'],
+                  in_ext='txt')
+    en, de = cache.get_entry(entry)
+    assert en.read_bytes() == members['corpus/train.en'] and de.read_bytes() == members['corpus/train.de']
+    assert range_bytes(Handler.requests) < len(data) // 10
+    zip_path = cache.get_local_path(entry.url, filename=entry.filename, fix_missing=False)
+    assert not zip_path.exists()
+    assert cache.cached_entries([entry]) == {entry: True}
+    assert [unit['path'] for unit in cache.get_gc_units()] == [cache.rel_path(zip_path.parent)]
+
+    Handler.requests.clear()
+    assert cache.get_entry(entry) == [en, de]
+    assert not Handler.requests   # listing and members are cached
+    plan = plan_mod.make_plan(cache, [('train', entry)])
+    assert plan.entries[0]['download'] == 0 and plan.entries[0]['extract'] == 0   # members count as cached
+    assert not Handler.requests
+
+    Handler.files['/corpus2.zip'] = data
+    Handler.no_ranges.add('/corpus2.zip')   # falls back to full download
+    entry2 = Entry(did='Test-zip-2-eng-deu', url=f'{server}/corpus2.zip', in_paths=['corpus/*.en', 'corpus/*.de'],
+                   in_ext='txt')
+    en2, de2 = cache.get_entry(entry2)
+    assert en2.root == cache.get_local_path(entry2.url, filename=entry2.filename, fix_missing=False)
+    assert en2.root.read_bytes() == data
+
+    Handler.accept_ranges = 'Bytes'   # case insensitive
+    Handler.files['/corpus3.zip'] = data
+    zip3 = tmp_path / 'corpus3.zip'
+    select = lambda names: [n for n in names if n.endswith('.en')]
+    assert cache.get_zip_members(f'{server}/corpus3.zip', zip3, select=select) is not None
+
+    Handler.requests.clear()
+    missing = f'{server}/missing.zip'
+    assert cache.get_zip_members(missing, tmp_path / 'missing.zip', select=select) is None
+    assert cache.get_zip_members(missing, tmp_path / 'missing.zip', select=select) is None
+    assert [(m, path) for m, path, _ in Handler.requests] == [('HEAD', '/missing.zip')]  # failed probe is cached
+
+
+def test_remote_zip_opus_xces(server, remote_zip, tmp_path):
+    from mtdata.opus_xces import OpusXcesParser
+    align = ('<cesAlign><linkGrp fromDoc="en/1.xml.gz" toDoc="de/1.xml.gz">'
+             '<link xtargets="1;1" certainty="0.9"/><link xtargets="2;2" certainty="0.9"/></linkGrp></cesAlign>')
+    Handler.files['/en-de.xml.gz'] = gzip.compress(align.encode())
+
+    def doc(*words):
+        return ''.join(f'<s id="{i}"><w>{w}</w></s>' for i, w in enumerate(words, 1)).join(['<text>', '</text>'])
+    for lang, words in [('en', ('hello', 'world')), ('de', ('hallo', 'welt'))]:
+        Handler.files[f'/{lang}.zip'] = make_zip({f'JW300/xml/{lang}/1.xml': doc(*words),
+                                                 f'JW300/xml/{lang}/2.xml': os.urandom(200_000)},
+                                                compression=zipfile.ZIP_STORED)
+    cache = Cache(tmp_path)
+    entry = Entry(did='Test-opus-1-eng-deu', url=f'{server}/en-de.xml.gz', in_ext='opus_xces',
+                  in_paths=[f'{server}/en.zip', f'{server}/de.zip'])
+    align_file, en_dir, de_dir = cache.get_entry(entry)
+    assert en_dir.is_dir() and de_dir.is_dir()
+    assert list(OpusXcesParser.read(align_file, en_dir, de_dir)) == [('hello', 'hallo'), ('world', 'welt')]
+    assert range_bytes(r for r in Handler.requests if r[1] != '/en-de.xml.gz') < 100_000
+
+
+def test_stream_entry(server, tmp_path, monkeypatch):
+    from mtdata.parser import Parser
+    from mtdata.streaming import StreamPath
+    rows = [[f'hello {i}', f'hallo {i}'] for i in range(20_000)]
+    data = gzip.compress(''.join(f'{en}\t{de}\n' for en, de in rows).encode())
+    Handler.files['/corpus.tsv.gz'] = data
+    Handler.drop_after['/corpus.tsv.gz'] = len(data) // 2  # resumed while parsing
+    cache = Cache(tmp_path)
+    entry = Entry(did='Test-tsv-1-eng-deu', url=f'{server}/corpus.tsv.gz')
+    assert cache.is_streamable(entry)
+    with cache.stream_entry(entry) as path:
+        assert isinstance(path, StreamPath)
+        assert list(Parser(path, ent=entry).read_segs(show_pbar=False)) == rows
+        local = cache.get_local_path(entry.url, filename=entry.filename, fix_missing=False)
+        assert not cache.get_flag_file(local).exists()   # not until the with block ends
+    assert local.read_bytes() == data and cache.get_flag_file(local).exists()
+    assert not cache.is_streamable(entry)
+    with cache.stream_entry(entry) as path:
+        assert path == local
+
+    Handler.files['/corpus2.tsv.gz'] = data
+    entry2 = Entry(did='Test-tsv-2-eng-deu', url=f'{server}/corpus2.tsv.gz')
+    with pytest.raises(ValueError):
+        with cache.stream_entry(entry2) as path:
+            for i, rec in enumerate(Parser(path, ent=entry2).read_segs(show_pbar=False)):
+                if i == 10:
+                    raise ValueError('parser error')
+    local2 = cache.get_local_path(entry2.url, filename=entry2.filename, fix_missing=False)
+    assert not cache.get_flag_file(local2).exists()
+    assert cache.get_entry(entry2).read_bytes() == data
+
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 0.01)
+    Handler.files['/corpus3.tsv.gz'] = data
+    Handler.drop_after['/corpus3.tsv.gz'] = len(data) // 2
+    Handler.no_ranges.add('/corpus3.tsv.gz')   # the retry restarts from byte 0; the rest is parsed from the file
+    entry3 = Entry(did='Test-tsv-3-eng-deu', url=f'{server}/corpus3.tsv.gz')
+    with cache.stream_entry(entry3) as path:
+        assert isinstance(path, StreamPath)
+        assert list(Parser(path, ent=entry3).read_segs(show_pbar=False)) == rows
+        assert path.stream.detached
+    assert [m for m, p, _ in Handler.requests if p == '/corpus3.tsv.gz'] == ['GET', 'GET']
+
+
+def test_retry_policy():
+    assert parse_retry_after('5') == 5
+    assert 55 < parse_retry_after(email.utils.formatdate(time.time() + 60, usegmt=True)) <= 60
+    assert parse_retry_after('soon') is None and parse_retry_after(None) is None
+    policy = RetryPolicy(backoff=1, max_wait=10)
+    assert 0.5 <= policy.wait_time(1) <= 1 and 2 <= policy.wait_time(3) <= 4
+    assert policy.wait_time(10) == 10
+    assert policy.wait_time(1, retry_after=3) == 3 and policy.wait_time(1, retry_after=100) == 10
+
+
+def test_retry_after_and_stall(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 100)  # would time out the test, unless Retry-After is used
+    monkeypatch.setattr(Defaults, 'STALL_TIMEOUT', 0.5)
+    data = os.urandom(100_000)
+    Handler.files['/busy.txt'] = Handler.files['/stall.txt'] = data
+    Handler.errors['/busy.txt'] = [429, 503]
+    Handler.retry_after = '0'
+    cache = Cache(tmp_path)
+    assert cache.get_local_path(f'{server}/busy.txt').read_bytes() == data
+    Handler.retry_after = None
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 0.01)
+    Handler.stalls['/stall.txt'] = 2
+    assert cache.get_local_path(f'{server}/stall.txt').read_bytes() == data
+    (_, _, first), (_, _, second) = [r for r in Handler.requests if r[1] == '/stall.txt']
+    assert first is None and second.startswith('bytes=')   # resumed after the stall
+
+
+def test_circuit_breaker(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 0.01)
+    monkeypatch.setattr(breaker, 'max_failures', 2)
+    data = os.urandom(1000)
+    Handler.files['/down.txt'] = Handler.files['/other.txt'] = data
+    Handler.errors['/down.txt'] = [500] * 10
+    cache = Cache(tmp_path)
+    with pytest.raises(HostUnavailable):
+        cache.get_local_path(f'{server}/down.txt')
+    assert len(Handler.requests) == 2
+    with pytest.raises(HostUnavailable):   # same host; no requests until cooldown ends
+        cache.get_local_path(f'{server}/other.txt')
+    assert len(Handler.requests) == 2
+    monkeypatch.setattr(breaker, 'cooldown', 0.01)
+    time.sleep(0.02)
+    assert cache.get_local_path(f'{server}/other.txt').read_bytes() == data  # probe succeeds; circuit closes
+    Handler.errors['/down.txt'] = [404]
+    with pytest.raises(HttpStatusError):  # not transient, so not retried
+        cache.get_local_path(f'{server}/down.txt')
+
+
+def test_head_retries(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(Defaults, 'RETRY_BACKOFF', 0.01)
+    cache = Cache(tmp_path)
+    Handler.files['/h.txt'] = os.urandom(100)
+    Handler.errors['/h.txt'] = [503]
+    assert cache.head(f'{server}/h.txt')['length'] == 100
+    assert [m for m, path, _ in Handler.requests] == ['HEAD', 'HEAD']
+
+    with socket.socket() as sock:   # a port with no server
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    url = f'http://localhost:{port}/x.txt'
+    monkeypatch.setattr(breaker, 'max_failures', Defaults.HTTP_RETRIES + 1)
+    start = time.time()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        cache.head(url)
+    assert time.time() - start < 1   # connection errors are retried by the policy only, not also by adapters
+    assert breaker.failures['localhost'] == Defaults.HTTP_RETRIES + 1
+    with pytest.raises(HostUnavailable):   # paused host fails fast
+        cache.head(url.replace('x.txt', 'y.txt'))
+
+
+def test_content_lengths(server, tmp_path, monkeypatch):
+    sizes = dict(a=1000, b=2000, c=3000, d=4000)
+    for name, size in sizes.items():
+        Handler.files[f'/{name}.tsv'] = os.urandom(size)
+    Handler.delay = 0.5
+    cache = Cache(tmp_path)
+    entries = [Entry(did=f'Test-{name}-1-eng-deu', url=f'{server}/{name}.tsv') for name in sizes]
+    entries.append(Entry(did='Test-missing-1-eng-deu', url=f'{server}/missing.tsv'))
+    start = time.time()
+    stats = cache.get_content_lengths(entries, n_jobs=8)
+    assert time.time() - start < 4 * Handler.delay   # concurrent
+    assert [s['total_bytes'] for s in stats[:4]] == list(sizes.values())
+    assert 'error' in stats[4]
+    Handler.requests.clear()
+    assert cache.get_content_lengths(entries[:4])[0]['total_bytes'] == sizes['a']
+    assert not Handler.requests   # cached
+    monkeypatch.setattr(Defaults, 'HEAD_TTL', 0)
+    assert cache.get_content_lengths(entries[:4])[1]['total_bytes'] == sizes['b']
+    assert len(Handler.requests) == 4   # expired
+
+
+def test_plan(server, tmp_path, monkeypatch):
+    Handler.files['/a.tsv.gz'] = os.urandom(3000)
+    Handler.files['/b.tar.gz'] = make_tar({'b/x.en': b'x' * 100, 'b/x.de': b'y' * 100})
+    Handler.files['/c.tmx'] = os.urandom(5000)
+    cache = Cache(tmp_path / 'cache')
+    a = Entry(did='Test-a-1-eng-deu', url=f'{server}/a.tsv.gz')
+    b = Entry(did='Test-b-1-eng-deu', url=f'{server}/b.tar.gz', in_paths=['b/*.en', 'b/*.de'], in_ext='txt')
+    c = Entry(did='Test-c-1-eng-deu', url=f'{server}/c.tmx')
+    d = Entry(did='Test-d-1-eng-deu', url=f'{server}/missing.tsv')
+    out_dir = tmp_path / 'out'
+    entries = [('train', a), ('train', b), ('test', c), ('dev', d)]
+    plan = plan_mod.make_plan(cache, entries, out_dir=out_dir, merge_train=True, n_jobs=2)
+    recs = {rec['id']: rec for rec in plan.entries}
+    assert recs['Test-a-1-eng-deu'] == dict(id='Test-a-1-eng-deu', field='train', download=3000, extract=0,
+                                            output=2 * 3 * 3000)  # decompressed; parts and merged train
+    b_size = len(Handler.files['/b.tar.gz'])
+    assert recs['Test-b-1-eng-deu']['extract'] == 3 * b_size
+    assert recs['Test-c-1-eng-deu']['output'] == int(5000 * plan_mod.TEXT_RATIOS['tmx'])
+    assert 'error' in recs['Test-d-1-eng-deu'] and plan.unknown() == ['Test-d-1-eng-deu']
+    assert plan.total('download') == 3000 + b_size + 5000
+    assert len(plan.disks) == 1 and plan.disks[0]['need'] == plan.total('download') + plan.total('extract') \
+           + plan.total('output')  # cache and output are on the same disk
+    assert plan.seconds > 0
+    assert plan.to_json()['download'] == plan.total('download')
+    assert 'TOTAL' in plan.format()
+    plan.check()
+
+    cache.get_entry(b)   # cached and extracted
+    plan = plan_mod.make_plan(cache, entries[:2], out_dir=out_dir)
+    assert [(rec['download'], rec['extract']) for rec in plan.entries] == [(3000, 0), (0, 0)]
+
+    usage = collections.namedtuple('usage', 'total used free')
+    monkeypatch.setattr(plan_mod.shutil, 'disk_usage', lambda path: usage(total=10**4, used=10**4 - 100, free=100))
+    with pytest.raises(MTDataUserError) as error:
+        plan_mod.make_plan(cache, entries[:2], out_dir=out_dir).check()
+    assert 'Not enough disk space' in error.value.msg
+    assert not plan_mod.make_plan(cache, [('train', b)], out_dir=None).shortfalls()   # nothing to download
+
+
+def test_mirrors(server, tmp_path, monkeypatch):
+    from mtdata import mirror as mirror_mod
+    from mtdata.mirror import MirrorChain
+    # a dir mirror, a read-only shared cache, and an HTTP mirror, which is served by the test server
+    mirror_dir = tmp_path / 'mirror'
+    (mirror_dir / 'example.invalid' / 'data').mkdir(parents=True)
+    (mirror_dir / 'example.invalid' / 'data' / 'a.tsv').write_bytes(b'a\tb\n')
+    shared = Cache(tmp_path / 'shared')
+    Handler.files['/shared/c.tsv'] = b'c\td\n'
+    shared_path = shared.get_local_path(f'{server}/shared/c.tsv')
+    Handler.files['/example.invalid/data/e.tsv'] = b'e\tf\n'
+    Handler.files['/origin/g.tsv'] = b'g\th\n'
+    (tmp_path / 'staged').mkdir()
+    (tmp_path / 'staged' / 'i.tsv').write_bytes(b'i\tj\n')
+    chain = MirrorChain.parse(mirrors=f'{mirror_dir},cache:{shared.root} {server}',
+                              rewrites=f'http://example.invalid/origin/=>{server}/origin/'
+                                       f' http://example.invalid/staged/=>file://{tmp_path}/staged/')
+    assert [m.kind for m in chain.mirrors] == ['dir', 'cache', 'http']
+    cache = Cache(tmp_path / 'cache', mirrors=chain)
+    Handler.requests.clear()
+
+    local = cache.get_local_path('http://example.invalid/data/a.tsv')
+    assert local.read_bytes() == b'a\tb\n' and os.path.samefile(local, mirror_dir / 'example.invalid/data/a.tsv')
+    local = cache.get_local_path(f'{server}/shared/c.tsv')
+    assert os.path.samefile(local, shared_path)
+    local = cache.get_local_path('http://example.invalid/staged/i.tsv')
+    assert local.read_bytes() == b'i\tj\n'
+    assert not Handler.requests   # linked, not downloaded
+    assert cache.head('http://example.invalid/staged/i.tsv')['length'] == 4 and not Handler.requests
+    assert not cache.is_streamable(Entry(did='Test-a-1-eng-deu', url='http://example.invalid/data/a.tsv'))
+
+    assert cache.get_local_path('http://example.invalid/data/e.tsv').read_bytes() == b'e\tf\n'
+    assert Handler.requests[-1][:2] == ('GET', '/example.invalid/data/e.tsv')   # from HTTP mirror
+    assert cache.get_local_path('http://example.invalid/origin/g.tsv').read_bytes() == b'g\th\n'
+    assert [r[1] for r in Handler.requests[-2:]] == ['/example.invalid/origin/g.tsv', '/origin/g.tsv']  # 404, next
+    assert cache.is_cached('http://example.invalid/origin/g.tsv')
+
+    src, dest = tmp_path / 'src.txt', tmp_path / 'dest.txt'
+    src.write_text('content')
+
+    def no_link(*args):
+        raise OSError('cross-device link')
+    monkeypatch.setattr(mirror_mod.os, 'link', no_link)
+    assert mirror_mod.link_file(src, dest) in ('reflink', 'symlink')
+    assert dest.read_text() == 'content'
@@ -1,5 +1,6 @@
 import json
 import subprocess
+import sys
 from typing import List
 from mtdata.index import INDEX as index
 from pathlib import Path
@@ -17,11 +18,46 @@ def shrun(cmd: List[str], capture_output=False):
 def test_cli_help():
     assert shrun(MTDATA_CMD + ['--help']) == 0
 
+def test_cli_import_time():
+    # "mtdata --help" should neither load index, recipes, nor import heavy libs
+    budget_us = 1_000_000   # cumulative import time of mtdata.main; generous for slow CI machines
+    p = subprocess.run([sys.executable, '-X', 'importtime'] + MTDATA_CMD[1:] + ['--help'],
+                       capture_output=True, text=True)
+    assert p.returncode == 0
+    cumulative = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cum_us, name = line.split(':', maxsplit=1)[1].split('|')
+        if cum_us.strip().isdigit():
+            cumulative[name.strip()] = int(cum_us)
+    for heavy in ['rich', 'pybtex', 'ruamel', 'requests', 'mtdata.index', 'mtdata.recipe', 'mtdata.data']:
+        assert heavy not in cumulative, f'{heavy} is imported in "mtdata --help"'
+    assert cumulative['mtdata.main'] < budget_us, f'mtdata.main import took {cumulative["mtdata.main"]:,}us'
+
+
 def test_cli_list():
     code, out = shrun(MTDATA_CMD + ['list', '--id'], capture_output=True)
     assert code == 0
     assert len(out.splitlines()) >= len(index.entries)
 
+def test_cli_index_parallel():
+    import os
+    import shutil
+    from mtdata.index import SEGMENTS_DIR
+    with TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, MTDATA=tmp_dir)
+        # the subprocess can not see the sample OPUS index of tests (see conftest.py); reuse the segment built from it
+        segments_dir = Path(tmp_dir) / SEGMENTS_DIR.name
+        segments_dir.mkdir()
+        for seg_file in SEGMENTS_DIR.glob('opus.opus_index.*.idx'):
+            shutil.copy(seg_file, segments_dir)
+        p = subprocess.run(MTDATA_CMD + ['index', '-j', '3'], capture_output=True, env=env)
+        assert p.returncode == 0
+        idx_files = list(Path(tmp_dir).glob('mtdata.index.*.jsonl'))
+        assert len(idx_files) == 1
+        assert len(idx_files[0].read_text(encoding='utf8').splitlines()) == len(index.entries)
+
 def test_cli_get():
     with TemporaryDirectory() as out_dir:
         did = 'OPUS-gnome-v1-eng-kan'
@@ -4,7 +4,7 @@
 # Author: Thamme Gowda
 # Created: 10/12/21
 
-from mtdata.index import is_compatible, bcp47
+from mtdata.index import is_compatible, bcp47, bitext_lang_match, get_entries, INDEX
 
 
 def test_is_compatible():
@@ -27,3 +27,199 @@ def test_is_compatible():
     assert not is_compatible(bcp47('hin_Deva_In'), bcp47('kan_Deva_IN'))
     assert not is_compatible(bcp47('hin_In'), bcp47('kan_Deva_IN'))
     assert not is_compatible(bcp47('hin'), bcp47('kan_Deva_IN'))
+
+
+def test_get_entries():
+    # posting list lookups should agree with a linear scan of the whole index
+    all_entries = list(INDEX.get_entries())
+    for pair in [('deu', 'eng'), ('eng_US', 'kan'), ('eng', 'por_BR')]:
+        pair = tuple(bcp47(lang) for lang in pair)
+        for fuzzy_match in [True, False]:
+            expected = [e.did for e in all_entries if len(e.did.langs) == 2
+                        and bitext_lang_match(pair, e.did.langs, fuzzy_match=fuzzy_match)]
+            got = [e.did for e in get_entries(langs=pair, fuzzy_match=fuzzy_match)]
+            assert got == expected
+    kan = bcp47('kan')
+    expected = [e.did for e in all_entries if len(e.did.langs) == 1 and kan.is_compatible(e.did.langs[0])]
+    assert [e.did for e in get_entries(langs=(kan,))] == expected
+
+    expected = [e.did for e in all_entries if e.did.group.lower() == 'statmt' and e.did.name == 'europarl']
+    assert expected
+    assert [e.did for e in get_entries(groups=['Statmt'], names=['europarl'])] == expected
+    assert not get_entries(groups=['Statmt'], not_groups=['statmt'])
+
+
+def test_index_store():
+    from tempfile import TemporaryDirectory
+    from pathlib import Path
+    from mtdata.index import Index, Entry, DatasetId
+
+    entries = [
+        Entry(did=DatasetId.parse('Statmt-news_commentary-16-deu-eng'), cite=('bojar-etal-2017-findings',),
+              url='http://data.statmt.org/news-commentary/v16/training/news-commentary-v16.de-en.tsv.gz'),
+        Entry(did=DatasetId.parse('OPUS-gnome-v1-eng_US-kan'), url='https://example.com/gnome.zip',
+              in_paths=['*.en_US', '*.kn'], in_ext='txt', cols=(1, 0)),
+        Entry(did=DatasetId.parse('Leipzig-news-2020_10k-kan'), url='https://example.com/news.tar.gz',
+              in_paths=['*/*-sentences.txt'], in_ext='tsv', cols=(1,), meta=dict(fields={'doc_id': 2})),
+    ]
+    index = Index()
+    for ent in entries:
+        index.add_entry(ent)
+    with TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'index.idx'
+        index.save(path)
+        loaded = Index.load(path)
+        assert len(loaded) == len(entries)
+        assert DatasetId.parse('Statmt-news_commentary-16-eng-deu') not in loaded
+        for ent, got in zip(entries, loaded.get_entries()):
+            assert ent.did in loaded
+            assert got.did == ent.did
+            for field in Entry.__slots__:
+                assert getattr(got, field) == getattr(ent, field), field
+            assert loaded[ent.did].url == ent.url
+
+
+def test_index_store_types():
+    # entry classes and tuple fields survive the round trip through the index file
+    from tempfile import TemporaryDirectory
+    from pathlib import Path
+    from mtdata.index import Index, Entry, DatasetId
+    from mtdata.index.neulab_tedtalks import NoisyEntry
+
+    entries = [
+        NoisyEntry(did=DatasetId.parse('Neulab-tedtalks_train-1-eng-deu'), url='http://example.com/ted_talks.tar.gz',
+                   in_paths=('all_talks_train.tsv',), in_ext='tsv', cols=(1, 16), cite=('Ye2018WordEmbeddings',)),
+        Entry(did=DatasetId.parse('StanfordNLP-wmt15_train-1-eng-ces'), ext='txt', cite=('luong2016acl_hybrid',),
+              url=('https://example.com/train.en', 'https://example.com/train.cs')),
+    ]
+    index = Index()
+    for ent in entries:
+        index.add_entry(ent)
+    with TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'index.idx'
+        index.save(path)
+        loaded = Index.load(path)
+        noisy, multi = [loaded[ent.did] for ent in entries]
+        assert type(noisy) is NoisyEntry and noisy.is_noisy('__NULL__', 'x')
+        assert noisy.in_paths == ('all_talks_train.tsv',) and noisy.cols == (1, 16)
+        assert type(multi) is Entry and multi.url == entries[1].url
+        assert str(multi) == str(entries[1])   # as in "mtdata list"
+
+
+def test_index_segments():
+    from tempfile import TemporaryDirectory
+    from pathlib import Path
+    import pytest
+    from mtdata.index import Index, Entry, DatasetId, fingerprint
+
+    def make_segment(path, *dids):
+        index = Index()
+        for did in dids:
+            index.add_entry(Entry(did=DatasetId.parse(did), url=f'https://example.com/{did}.tsv'))
+        index.save(path)
+        return path
+
+    with TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        src = tmp_dir / 'mtdata_plugin.py'
+        src.write_text('def load_all(index): pass\n')
+        fp1 = fingerprint(src, tmp_dir / 'missing.tsv')
+        assert fp1 == fingerprint(src, tmp_dir / 'missing.tsv')
+        src.write_text('def load_all(index): pass  # edited\n')
+        assert fp1 != fingerprint(src, tmp_dir / 'missing.tsv')
+
+        # shared code that shapes entries is part of every fingerprint
+        sub_modules = Index.get_sub_modules()
+        opus_files = {(p.parent.name, p.name) for p in sub_modules['.opus.opus_index']}
+        assert {('mtdata', 'parser.py'), ('iso', 'bcp47.py'), ('opus', '__init__.py')} <= opus_files
+
+        seg1 = make_segment(tmp_dir / 'a.idx', 'Mine-corpus-1-deu-eng', 'Mine-corpus-1-fra-eng')
+        seg2 = make_segment(tmp_dir / 'b.idx', 'Other-corpus-1-deu-eng')
+        merged = tmp_dir / 'merged.idx'
+        Index.merge([seg1, seg2], merged)
+        index = Index.load(merged)
+        assert len(index) == 3
+        assert DatasetId.parse('Other-corpus-1-deu-eng') in index
+        assert index[DatasetId.parse('Mine-corpus-1-fra-eng')].url == 'https://example.com/Mine-corpus-1-fra-eng.tsv'
+
+        dup = make_segment(tmp_dir / 'c.idx', 'Mine-corpus-1-fra-eng')
+        with pytest.raises(AssertionError):
+            Index.merge([seg1, dup], tmp_dir / 'dup.idx')
+
+
+def test_search():
+    from mtdata.index.store import tokenize
+    assert tokenize('Statmt-news_commentary-16-deu-eng') == ['statmt', 'news', 'commentary', '16', 'deu', 'eng']
+    for query in ['news_commentary', 'news_comm', 'news comentary']:  # exact, prefix, typo
+        entries = get_entries(langs=(bcp47('deu'), bcp47('eng')), query=query)
+        assert entries, f'no results for {query}'
+        assert entries[0].did.name.startswith('news_commentary'), query
+    exact = get_entries(query='europarl v10', langs=(bcp47('deu'), bcp47('eng')))
+    assert str(exact[0].did) == 'Statmt-europarl-10-deu-eng'
+    assert not get_entries(query='zzzzqqqq')
+
+
+def test_sqlite_index():
+    from tempfile import TemporaryDirectory
+    from pathlib import Path
+    from mtdata.index import count_entries
+    from mtdata.index.sqldb import SqlIndex
+
+    with TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'index.sqlite'
+        SqlIndex.create(INDEX.entries, path, stamp='test')
+        assert SqlIndex.is_valid(path, 'test')
+        assert not SqlIndex.is_valid(path, 'other')
+        db = SqlIndex(path)
+        queries = [dict(), dict(langs=(bcp47('deu'), bcp47('eng'))), dict(langs=(bcp47('eng'), bcp47('deu')), strict=True),
+                   dict(langs=(bcp47('eng'),)), dict(groups=['statmt'], not_names=['europarl']),
+                   dict(names=['news_commentary'], langs=(bcp47('en'), bcp47('de')), fuzzy_match=True),
+                   dict(not_groups=['opus', 'flores'])]
+        for query in queries:
+            expected = [str(e.did) for e in get_entries(**query)]
+            assert [str(e.did) for e in db.select(**query)] == expected, query
+            assert len(db.ids(**query)) == len(expected)
+            for by in ['langs', 'name', 'group']:
+                assert db.count(by, **query) == count_entries(by, **query), (query, by)
+        db.con.close()
+
+
+def test_reference_db():
+    from tempfile import TemporaryDirectory
+    from pathlib import Path
+    import subprocess
+    import sys
+    from mtdata.index import ReferenceDb, REFS_FILE
+
+    with TemporaryDirectory() as tmp_dir:
+        cache_file = Path(tmp_dir) / 'refs.bib.json'
+        bibtex = ReferenceDb.load_bibtex(REFS_FILE, cache_file=cache_file)
+        assert cache_file.exists()
+        assert ReferenceDb.load_bibtex(REFS_FILE, cache_file=cache_file) == bibtex
+        assert bibtex['tiedemann2012parallel'].startswith('@inproceedings{tiedemann2012parallel,')
+    refs = ReferenceDb()
+    assert 'Tiedemann2012Parallel' in refs   # case insensitive, same as bibtex
+    assert refs.get_bibtex('TIEDEMANN2012PARALLEL') == bibtex['tiedemann2012parallel']
+    entry = refs['tiedemann2012parallel']   # pybtex entry, parsed lazily
+    assert entry.fields['title'] and entry.persons['author']
+    assert entry.to_string(bib_format='bibtex') == refs.get_bibtex('tiedemann2012parallel')
+    # once cached, pybtex is not needed
+    code = ('import sys; from mtdata.index import ReferenceDb; ReferenceDb().get_bibtex("tiedemann2012parallel");'
+            'assert "pybtex" not in sys.modules')
+    assert subprocess.run([sys.executable, '-c', code]).returncode == 0
+
+
+def test_index_build_keeps_other_segments(tmp_path, monkeypatch):
+    import mtdata.index as index_mod
+    from mtdata.index import Index
+    monkeypatch.setattr(index_mod, 'SEGMENTS_DIR', tmp_path)
+    monkeypatch.setattr(Index, 'get_sub_modules', classmethod(lambda cls: {'.opus': [], 'mtdata_here': []}))
+    current = {'.opus': tmp_path / 'opus.new.idx', 'mtdata_here': tmp_path / 'mtdata_here.new.idx'}
+    monkeypatch.setattr(Index, 'get_segment', classmethod(lambda cls, mod_name, files: current[mod_name]))
+    monkeypatch.setattr(Index, 'merge', classmethod(lambda cls, segments, path: None))
+    for name in ['opus.new', 'opus.old', 'mtdata_here.new', 'mtdata_here.old', 'mtdata_elsewhere.fp']:
+        (tmp_path / f'{name}.idx').touch()
+    Index.build(tmp_path / 'index.idx')
+    # older fingerprints of current modules are removed; plugins of other working dirs are kept
+    assert sorted(p.name for p in tmp_path.glob('*.idx')) == \
+           ['mtdata_elsewhere.fp.idx', 'mtdata_here.new.idx', 'opus.new.idx']
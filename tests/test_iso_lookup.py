@@ -36,4 +36,15 @@ def test_bcp47():
 
     # language with an hyphen in their name should work as well
     assert iso3_code('Teke-Tsaayi') == "tyi"
-    assert iso3_code('Umbu-Ungu') == "ubu"
\ No newline at end of file
+    assert iso3_code('Umbu-Ungu') == "ubu"
+
+def test_lookup_tables():
+    # lookup.bin is generated; it must be rebuilt with "python -m mtdata.iso.lookup" when the sources change
+    from mtdata.iso.lookup import lookup_file, compile_tables, resolve_iso3, get_tables
+    assert lookup_file.read_bytes() == compile_tables(), 'lookup.bin is outdated; run python -m mtdata.iso.lookup'
+    iso3 = get_tables()['iso3']
+    for key in ['kn', 'kannada', 'nepali (individual)', 'jp', 'iw', 'zho', 'alumu-tesu']:
+        assert iso3.get(key) == resolve_iso3(key)
+    assert 'Latn' in get_tables()['scripts']
+    assert get_tables()['default_scripts']['kan'] == 'Knda'
+    assert 'UK' not in get_tables()['countries']